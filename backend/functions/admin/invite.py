@@ -8,6 +8,7 @@ from security import (
     format_response,
     format_error,
     validate_input,
+    parse_body,
     require_admin,
     ValidationError
 )
@@ -42,7 +43,7 @@ def lambda_handler(event, context):
 
         # Parse and Validate request body
         try:
-            body = json.loads(event.get('body', '{}'))
+            body = parse_body(event)
         except json.JSONDecodeError:
             return format_error(400, "Invalid JSON in request body", method='POST')
             
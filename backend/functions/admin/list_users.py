@@ -72,7 +72,7 @@ def lambda_handler(event, context):
         return format_response(200, {
             'users': users,
             'count': len(users)
-        })
+        }, event=event)
 
     except Exception as e:
         return format_error(500, "An unexpected error occurred", internal_error=e)
\ No newline at end of file
@@ -0,0 +1,205 @@
+# functions/archive/archiver.py
+"""
+Scheduled: move notes older than ARCHIVE_AFTER_DAYS to the archive bucket.
+
+Notes not yet archived carry archive_shard (stamped when the note is written,
+removed when it is stubbed), so they and only they are in the sparse
+archive-index. Each run queries every shard for timestamps before the cutoff
+rather than scanning the table. Notes written before the index existed are
+given a shard once with {"backfill_shards": true}.
+"""
+import boto3
+import hashlib
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from archive_store import ARCHIVE_BUCKET, ARCHIVED_BODY_FIELDS, write_archive
+
+NOTES_TABLE = os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod')
+dynamodb = boto3.resource('dynamodb')
+notes_table = dynamodb.Table(NOTES_TABLE)
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '90'))
+MAX_ROWS_PER_FILE = int(os.environ.get('ARCHIVE_MAX_ROWS_PER_FILE', '1000'))
+MAX_BUFFERED_ROWS = int(os.environ.get('ARCHIVE_MAX_BUFFERED_ROWS', '5000'))
+# Must match note_outbox.ARCHIVE_SHARDS (both read the ARCHIVE_SHARDS global)
+ARCHIVE_SHARDS = int(os.environ.get('ARCHIVE_SHARDS', '16'))
+ARCHIVE_INDEX = 'archive-index'
+BATCH_GET_LIMIT = 100
+BATCH_GET_RETRIES = 4
+
+# Leave time to flush the buffered partitions before the Lambda times out
+SAFETY_MARGIN_MS = 90 * 1000
+
+
+def stub_note(note, key, row):
+    """
+    Swap the archived columns for a pointer (the note keeps its ttl). Returns
+    False if the note changed since it was read - regenerated or
+    section-edited, so the archived row is stale - and is left for the next run.
+    """
+    remove = ', '.join(f"#f{i}" for i in range(len(ARCHIVED_BODY_FIELDS)))
+    names = {f"#f{i}": field for i, field in enumerate(ARCHIVED_BODY_FIELDS)}
+    values = {
+        ':ref': {'bucket': ARCHIVE_BUCKET, 'key': key, 'row': row},
+        ':now': datetime.utcnow().isoformat()
+    }
+    condition = 'attribute_exists(user_id) AND attribute_not_exists(archive_ref)'
+    if 'version' in note:
+        condition += ' AND version = :seen'
+        values[':seen'] = note['version']
+    else:
+        condition += ' AND attribute_not_exists(version)'
+
+    try:
+        notes_table.update_item(
+            Key={'user_id': note['user_id'], 'timestamp': note['timestamp']},
+            # Dropping archive_shard takes the note out of the archive-index
+            UpdateExpression=f"SET archive_ref = :ref, archived_at = :now REMOVE {remove}, archive_shard",
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            print(f"Skipping {note['user_id']}#{note['timestamp']}: changed since it was read")
+            return False
+        raise
+
+
+def flush_partition(user_id, month, notes):
+    """Write archive files for one partition, then slim the hot items down"""
+    stubbed = 0
+    for start in range(0, len(notes), MAX_ROWS_PER_FILE):
+        chunk = notes[start:start + MAX_ROWS_PER_FILE]
+        # Archive first: a crash before stubbing just leaves an unreferenced file
+        key = write_archive(user_id, month, chunk)
+        for row, note in enumerate(chunk):
+            try:
+                if stub_note(note, key, row):
+                    stubbed += 1
+            except Exception as e:
+                print(f"Error stubbing {user_id}#{note['timestamp']}: {str(e)}")
+    return stubbed
+
+
+def get_notes(keys):
+    """BatchGetItem full notes for index keys, retrying unprocessed keys"""
+    notes = []
+    for start in range(0, len(keys), BATCH_GET_LIMIT):
+        request = {NOTES_TABLE: {'Keys': keys[start:start + BATCH_GET_LIMIT], 'ConsistentRead': True}}
+        for attempt in range(BATCH_GET_RETRIES + 1):
+            if attempt:
+                time.sleep(0.1 * (2 ** attempt))
+            response = dynamodb.meta.client.batch_get_item(RequestItems=request)
+            notes.extend(response.get('Responses', {}).get(NOTES_TABLE, []))
+            request = response.get('UnprocessedKeys') or {}
+            if not request:
+                break
+        else:
+            raise RuntimeError("Could not read notes to archive (unprocessed keys)")
+    return notes
+
+
+def due_keys(shard, cutoff, start_key=None):
+    """One page of keys in a shard of the archive-index older than the cutoff"""
+    query_args = {
+        'IndexName': ARCHIVE_INDEX,
+        'KeyConditionExpression': Key('archive_shard').eq(shard) & Key('timestamp').lt(cutoff)
+    }
+    if start_key:
+        query_args['ExclusiveStartKey'] = start_key
+    response = notes_table.query(**query_args)
+    keys = [{'user_id': k['user_id'], 'timestamp': k['timestamp']} for k in response.get('Items', [])]
+    return keys, response.get('LastEvaluatedKey')
+
+
+def backfill_shards(deadline):
+    """One-off: put notes written before the archive-index into it"""
+    scan_args = {
+        'ProjectionExpression': 'user_id, #ts',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'},
+        'FilterExpression': Attr('archive_ref').not_exists() & Attr('archive_shard').not_exists()
+    }
+    backfilled = 0
+    while time.time() < deadline:
+        response = notes_table.scan(**scan_args)
+        for note in response.get('Items', []):
+            digest = hashlib.sha256(f"{note['user_id']}#{note['timestamp']}".encode('utf-8')).digest()
+            try:
+                notes_table.update_item(
+                    Key={'user_id': note['user_id'], 'timestamp': note['timestamp']},
+                    UpdateExpression='SET archive_shard = :shard',
+                    ConditionExpression='attribute_exists(user_id) AND attribute_not_exists(archive_ref)',
+                    ExpressionAttributeValues={':shard': int.from_bytes(digest[:4], 'big') % ARCHIVE_SHARDS}
+                )
+                backfilled += 1
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    raise
+        if 'LastEvaluatedKey' not in response:
+            print(f"Archiver: backfilled {backfilled} shards, finished")
+            return {'backfilled': backfilled, 'finished': True}
+        scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    print(f"Archiver: backfilled {backfilled} shards, out of time")
+    return {'backfilled': backfilled, 'finished': False}
+
+
+def lambda_handler(event, context):
+    """Scheduled: move notes older than ARCHIVE_AFTER_DAYS to the archive bucket"""
+    event = event or {}
+    age_days = int(event.get('archive_after_days', ARCHIVE_AFTER_DAYS))
+    cutoff = (datetime.utcnow() - timedelta(days=age_days)).isoformat()
+
+    if context is not None:
+        deadline = time.time() + (context.get_remaining_time_in_millis() - SAFETY_MARGIN_MS) / 1000
+    else:
+        deadline = float('inf')
+
+    if event.get('backfill_shards'):
+        return backfill_shards(deadline)
+
+    partitions = defaultdict(list)
+    buffered = 0
+    archived = 0
+    read = 0
+
+    def flush_all():
+        nonlocal buffered, archived
+        for (user_id, month), notes in partitions.items():
+            archived += flush_partition(user_id, month, notes)
+        partitions.clear()
+        buffered = 0
+
+    # Archived notes leave the index, so a run cut short resumes next time
+    finished = False
+    shard, start_key = 0, None
+    while time.time() < deadline:
+        keys, start_key = due_keys(shard, cutoff, start_key)
+        for note in get_notes(keys):
+            # Skip any stubbed since the index was read
+            if 'archive_ref' in note:
+                continue
+            month = note['timestamp'][:7]
+            partitions[(note['user_id'], month)].append(note)
+            buffered += 1
+        read += len(keys)
+
+        if buffered >= MAX_BUFFERED_ROWS:
+            flush_all()
+
+        if not start_key:
+            shard += 1
+            if shard >= ARCHIVE_SHARDS:
+                finished = True
+                break
+
+    flush_all()
+
+    print(f"Archiver: cutoff={cutoff} read={read} archived={archived} finished={finished}")
+    return {'archived': archived, 'read': read, 'finished': finished}
@@ -0,0 +1,153 @@
+import gzip
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import boto3
+
+# Cold tier for old notes: gzip'd column-oriented files partitioned by user/month.
+# The hot table keeps a slim stub whose archive_ref points at (file, row).
+ARCHIVE_BUCKET = os.environ.get('ARCHIVE_BUCKET', 'scribe32-notes-archive-prod')
+ARCHIVE_FORMAT_VERSION = 1
+
+# Columns moved to the archive and removed from the stub
+ARCHIVED_BODY_FIELDS = ('soap_note', 'transcript', 'soap_note_ref', 'transcript_ref')
+
+# Columns stored in each archive file (one list per column)
+ARCHIVE_COLUMNS = (
+    'timestamp', 'patient_name', 'patient_id', 'template_id', 'template_name',
+    'provider_email', 'created_at'
+) + ARCHIVED_BODY_FIELDS
+
+FETCH_WORKERS = 8
+CACHE_MAX_FILES = 32
+
+s3 = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def partition_prefix(user_id, month):
+    """month is 'YYYY-MM' (the first 7 characters of the note timestamp)"""
+    return f"archive/user_id={user_id}/month={month}/"
+
+
+def encode_archive(user_id, month, notes):
+    """Serialize notes column-by-column and gzip the result"""
+    payload = {
+        'v': ARCHIVE_FORMAT_VERSION,
+        'user_id': user_id,
+        'month': month,
+        'count': len(notes),
+        'columns': {col: [note.get(col) for note in notes] for col in ARCHIVE_COLUMNS}
+    }
+    data = json.dumps(payload, default=_json_default, separators=(',', ':')).encode('utf-8')
+    return gzip.compress(data, compresslevel=9)
+
+
+def decode_archive(data):
+    payload = json.loads(gzip.decompress(data).decode('utf-8'))
+    if payload.get('v') != ARCHIVE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported archive format: {payload.get('v')}")
+    return payload
+
+
+def write_archive(user_id, month, notes):
+    """Write one archive file for a user/month partition. Returns its key."""
+    key = f"{partition_prefix(user_id, month)}notes-{uuid.uuid4().hex[:12]}.json.gz"
+    s3.put_object(
+        Bucket=ARCHIVE_BUCKET,
+        Key=key,
+        Body=encode_archive(user_id, month, notes),
+        ContentType='application/json',
+        ContentEncoding='gzip',
+        ServerSideEncryption='aws:kms'
+    )
+    return key
+
+
+def load_archive(bucket, key):
+    """Fetch and decode an archive file (small LRU across warm invocations)"""
+    cache_key = f"{bucket}/{key}"
+    with _cache_lock:
+        payload = _cache.get(cache_key)
+        if payload is not None:
+            _cache.move_to_end(cache_key)
+            return payload
+
+    response = s3.get_object(Bucket=bucket, Key=key)
+    payload = decode_archive(response['Body'].read())
+
+    with _cache_lock:
+        _cache[cache_key] = payload
+        _cache.move_to_end(cache_key)
+        while len(_cache) > CACHE_MAX_FILES:
+            _cache.popitem(last=False)
+    return payload
+
+
+def is_archived_stub(item):
+    return isinstance(item.get('archive_ref'), dict)
+
+
+def _mark_unavailable(stub):
+    for field in ('soap_note', 'transcript'):
+        if not stub.get(field) and not stub.get(f"{field}_ref"):
+            stub[field] = ''
+            stub[f"{field}_error"] = 'unavailable'
+
+
+def restore_archived(items):
+    """
+    Read through to the archive for stub items, filling the archived columns
+    back in. Archive files are fetched in parallel. Bodies that cannot be
+    restored are left empty and reported via '<field>_error', as
+    resolve_bodies does. Mutates and returns items.
+    """
+    stubs = [item for item in items if is_archived_stub(item)]
+    if not stubs:
+        return items
+
+    files = {(s['archive_ref'].get('bucket', ARCHIVE_BUCKET), s['archive_ref']['key']) for s in stubs}
+
+    def fetch(location):
+        try:
+            return location, load_archive(*location)
+        except Exception as e:
+            print(f"Error loading archive {location[1]}: {str(e)}")
+            return location, None
+
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(files))) as pool:
+        payloads = dict(pool.map(fetch, files))
+
+    for stub in stubs:
+        ref = stub['archive_ref']
+        payload = payloads.get((ref.get('bucket', ARCHIVE_BUCKET), ref['key']))
+        if not payload:
+            _mark_unavailable(stub)
+            continue
+
+        row = int(ref['row'])
+        columns = payload['columns']
+        if row >= payload['count'] or columns['timestamp'][row] != stub.get('timestamp'):
+            print(f"Archive row mismatch for {stub.get('user_id')}#{stub.get('timestamp')}")
+            _mark_unavailable(stub)
+            continue
+
+        for col in ARCHIVED_BODY_FIELDS:
+            value = columns.get(col, [None] * payload['count'])[row]
+            if value is not None and not stub.get(col):
+                stub[col] = value
+
+    return items
@@ -0,0 +1,123 @@
+# functions/export/export.py
+import json
+import boto3
+import os
+import uuid
+from botocore.exceptions import ClientError
+from export_pipeline import FORMATS, new_job, export_key, json_default, output_keys
+from security import format_response, format_error, parse_body, require_admin, ValidationError
+
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+EXPORT_BUCKET = os.environ.get('EXPORT_BUCKET', 'scribe32-exports-prod')
+EXPORT_WORKER_FUNCTION = os.environ.get('EXPORT_WORKER_FUNCTION', 'scribe32-export-worker-prod')
+DEFAULT_SCAN_SEGMENTS = int(os.environ.get('EXPORT_SCAN_SEGMENTS', '8'))
+DOWNLOAD_URL_SECONDS = 3600
+
+
+def lambda_handler(event, context):
+    """Start an export (POST /admin/exports) or check on one (GET /admin/exports/{export_id})"""
+    http_method = event.get('httpMethod', 'GET')
+
+    # Handle OPTIONS preflight
+    if http_method == 'OPTIONS':
+        return format_response(200, {}, method='POST')
+
+    try:
+        # Admin only endpoint
+        try:
+            user_info = require_admin(event)
+        except ValidationError as e:
+            return format_error(403, e.message, method=http_method)
+
+        if http_method == 'POST':
+            return start_export(event, user_info)
+
+        path_params = event.get('pathParameters') or {}
+        export_id = path_params.get('export_id')
+        if http_method == 'GET' and export_id:
+            return get_export(export_id, event)
+
+        return format_error(405, f"Method {http_method} not allowed", method=http_method)
+
+    except Exception as e:
+        return format_error(500, "An unexpected error occurred", internal_error=e, method=http_method)
+
+
+def start_export(event, user_info):
+    """Write the initial manifest and hand the job to the export worker"""
+    try:
+        body = parse_body(event)
+    except json.JSONDecodeError:
+        return format_error(400, "Invalid JSON in request body", method='POST')
+
+    fmt = body.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return format_error(400, f"Unsupported format '{fmt}'. Use one of: {', '.join(FORMATS)}", method='POST')
+
+    try:
+        segments = max(1, min(int(body.get('segments', DEFAULT_SCAN_SEGMENTS)), 64))
+    except (ValueError, TypeError):
+        segments = DEFAULT_SCAN_SEGMENTS
+
+    export_id = uuid.uuid4().hex
+    job = new_job(export_id, fmt, segments, user_info['email'], user_id=body.get('user_id'))
+
+    try:
+        s3.put_object(
+            Bucket=EXPORT_BUCKET,
+            Key=export_key(export_id, 'manifest.json'),
+            Body=json.dumps(job, default=json_default).encode('utf-8'),
+            ContentType='application/json',
+            ServerSideEncryption='aws:kms'
+        )
+        lambda_client.invoke(
+            FunctionName=EXPORT_WORKER_FUNCTION,
+            InvocationType='Event',
+            Payload=json.dumps({'export_id': export_id})
+        )
+    except Exception as e:
+        return format_error(500, "Failed to start export", internal_error=e, method='POST')
+
+    return format_response(202, {
+        'message': 'Export started',
+        'export_id': export_id,
+        'format': fmt,
+        'status': job['status']
+    }, method='POST')
+
+
+def get_export(export_id, event):
+    """Return export progress, plus download links once complete"""
+    try:
+        response = s3.get_object(Bucket=EXPORT_BUCKET, Key=export_key(export_id, 'manifest.json'))
+        job = json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return format_error(404, "Export not found")
+        return format_error(500, "Failed to read export status", internal_error=e)
+
+    result = {
+        'export_id': export_id,
+        'status': job['status'],
+        'format': job['format'],
+        'records': job['records'],
+        'parts': len(output_keys(job)),
+        'segments_done': sum(1 for s in job['segments'].values() if s['done']),
+        'total_segments': job['total_segments'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at']
+    }
+
+    if job['status'] == 'complete':
+        result['downloads'] = [
+            s3.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': EXPORT_BUCKET, 'Key': key},
+                ExpiresIn=DOWNLOAD_URL_SECONDS
+            )
+            for key in output_keys(job)
+        ]
+
+    return format_response(200, result, event=event)
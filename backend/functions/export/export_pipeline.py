@@ -0,0 +1,259 @@
+# functions/export/export_pipeline.py
+import csv
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from archive_store import restore_archived
+from body_store import resolve_bodies
+
+FORMATS = {
+    'ndjson': {'extension': 'ndjson', 'content_type': 'application/x-ndjson'},
+    'csv': {'extension': 'csv', 'content_type': 'text/csv'},
+}
+
+# Column order for CSV output (NDJSON carries the same fields)
+EXPORT_FIELDS = [
+    'user_id', 'timestamp', 'patient_name', 'patient_id', 'template_id',
+    'template_name', 'provider_email', 'created_at', 'soap_note', 'transcript'
+]
+
+# S3 rejects multipart parts under 5 MiB (except the last)
+MIN_PART_BYTES = 5 * 1024 * 1024
+DEFAULT_PART_BYTES = 8 * 1024 * 1024
+# Shared across the segment streams of one invocation
+DEFAULT_BUFFER_BYTES = 128 * 1024 * 1024
+DEFAULT_PAGE_SIZE = 500
+
+
+def json_default(value):
+    """DynamoDB numbers come back as Decimal"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def export_key(export_id, name):
+    return f"exports/{export_id}/{name}"
+
+
+def new_job(export_id, fmt, total_segments, requested_by, user_id=None):
+    """Initial manifest; doubles as the resumable checkpoint"""
+    now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    # Per-user exports are a single key-ordered query rather than a parallel scan
+    total_segments = 1 if user_id else total_segments
+    return {
+        'export_id': export_id,
+        'format': fmt,
+        'status': 'queued',
+        'user_id': user_id,
+        'requested_by': requested_by,
+        'created_at': now,
+        'updated_at': now,
+        'total_segments': total_segments,
+        'segments': {
+            str(i): {'last_key': None, 'key': None, 'upload_id': None, 'parts': 0, 'records': 0, 'done': False}
+            for i in range(total_segments)
+        },
+        'records': 0,
+        'invocations': 0
+    }
+
+
+# ========================================
+# Generator pipeline: pages -> lines -> parts
+# ========================================
+
+def read_pages(table, segment, total_segments, start_key=None, user_id=None, page_size=DEFAULT_PAGE_SIZE):
+    """Yield (items, last_evaluated_key) one DynamoDB page at a time"""
+    kwargs = {'Limit': page_size}
+    if user_id:
+        kwargs['KeyConditionExpression'] = Key('user_id').eq(user_id)
+    else:
+        kwargs['Segment'] = segment
+        kwargs['TotalSegments'] = total_segments
+
+    last_key = start_key
+    while True:
+        if last_key:
+            kwargs['ExclusiveStartKey'] = last_key
+        response = table.query(**kwargs) if user_id else table.scan(**kwargs)
+        last_key = response.get('LastEvaluatedKey')
+        yield response.get('Items', []), last_key
+        if not last_key:
+            return
+
+
+def encode_ndjson(items):
+    for item in items:
+        record = {field: item.get(field) for field in EXPORT_FIELDS}
+        yield json.dumps(record, default=json_default, separators=(',', ':')) + '\n'
+
+
+def encode_csv(items):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for item in items:
+        writer.writerow(['' if item.get(f) is None else item.get(f) for f in EXPORT_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def csv_header():
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(EXPORT_FIELDS)
+    return buffer.getvalue()
+
+
+ENCODERS = {'ndjson': encode_ndjson, 'csv': encode_csv}
+
+
+def output_keys(job):
+    """Download objects of an export, one per segment that had records"""
+    return sorted(state['key'] for state in job['segments'].values() if state['done'] and state.get('key'))
+
+
+class PartWriter:
+    """
+    One segment's output file, written as an S3 multipart upload. Encoded lines
+    are buffered up to a part; the upload id and part count live in the
+    segment's checkpoint, so the stream survives a re-invocation.
+    """
+
+    def __init__(self, sink, export_id, segment, fmt, state):
+        self.sink = sink
+        self.fmt = fmt
+        self.key = state.get('key') or export_key(export_id, f"part-{segment:03d}.{FORMATS[fmt]['extension']}")
+        self.upload_id = state.get('upload_id')
+        self.parts = state.get('parts', 0)
+        self.chunks = []
+        self.size = 0
+        if self.fmt == 'csv' and self.parts == 0:
+            self.add(csv_header())
+
+    def add(self, line):
+        data = line.encode('utf-8')
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def flush(self):
+        """Upload the buffered lines as the next part"""
+        if not self.chunks:
+            return
+        if self.upload_id is None:
+            self.upload_id = self.sink.start(self.key, FORMATS[self.fmt]['content_type'])
+        self.parts += 1
+        self.sink.upload_part(self.key, self.upload_id, self.parts, b''.join(self.chunks))
+        self.chunks = []
+        self.size = 0
+
+    def finish(self):
+        """Upload the last part and complete the object. Returns its key, or None when empty."""
+        self.flush()
+        if self.upload_id is None:
+            return None
+        self.sink.complete(self.key, self.upload_id)
+        return self.key
+
+
+# ========================================
+# Job runner
+# ========================================
+
+class ExportRunner:
+    """
+    Runs the scan segments of one export in parallel, each as one multipart
+    stream. Parts are only uploaded on page boundaries and the checkpoint (last
+    key, upload id and part count per segment) is saved right after, so it always
+    matches exactly what has been uploaded; records buffered when time runs out
+    are dropped and re-read by the next invocation.
+
+    Memory: each stream buffers about a part (plus the page that fills it), and
+    at most buffer_bytes / (2 * part_bytes) streams run at once - the other
+    segments wait their turn.
+
+    Every stream reads through `table`, so it must be safe to share between
+    threads (a PooledTable, not a boto3 Table resource).
+    """
+
+    def __init__(self, table, sink, save_manifest, job, part_bytes=DEFAULT_PART_BYTES,
+                 page_size=DEFAULT_PAGE_SIZE, buffer_bytes=DEFAULT_BUFFER_BYTES):
+        self.table = table
+        self.sink = sink
+        self.save_manifest = save_manifest
+        self.job = job
+        self.part_bytes = max(part_bytes, MIN_PART_BYTES)
+        self.page_size = page_size
+        self.max_streams = max(1, buffer_bytes // (2 * self.part_bytes))
+        self.lock = threading.Lock()
+
+    def checkpoint(self, segment, last_key, writer, records, key=None):
+        with self.lock:
+            state = self.job['segments'][str(segment)]
+            state['last_key'] = last_key
+            state['records'] += records
+            state['done'] = last_key is None
+            state['upload_id'] = None if state['done'] else writer.upload_id
+            state['parts'] = writer.parts
+            if state['done']:
+                state['key'] = key
+            self.job['records'] += records
+            self.job['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            self.save_manifest(self.job)
+
+    def export_segment(self, segment, deadline):
+        """Export one scan segment until it is exhausted or the deadline passes"""
+        state = self.job['segments'][str(segment)]
+        if state['done']:
+            return True
+        # Queued behind the other streams until the time ran out
+        if time.time() >= deadline:
+            return False
+
+        fmt = self.job['format']
+        encode = ENCODERS[fmt]
+        writer = PartWriter(self.sink, self.job['export_id'], segment, fmt, state)
+        pending_records = 0
+
+        pages = read_pages(
+            self.table, segment, self.job['total_segments'],
+            start_key=state['last_key'], user_id=self.job.get('user_id'), page_size=self.page_size
+        )
+        for items, last_key in pages:
+            restore_archived(items)
+            resolve_bodies(items)
+            for line in encode(items):
+                writer.add(line)
+            pending_records += len(items)
+
+            if last_key is None:
+                self.checkpoint(segment, None, writer, pending_records, key=writer.finish())
+            elif writer.size >= self.part_bytes:
+                writer.flush()
+                self.checkpoint(segment, last_key, writer, pending_records)
+                pending_records = 0
+                if time.time() >= deadline:
+                    return False
+            elif time.time() >= deadline:
+                # Too small for a part: the next invocation re-reads these pages
+                return False
+        return True
+
+    def run(self, deadline):
+        """Returns True when every segment has been exported"""
+        self.job['status'] = 'running'
+        self.job['invocations'] += 1
+        self.save_manifest(self.job)
+
+        pending = [int(s) for s, state in self.job['segments'].items() if not state['done']]
+        with ThreadPoolExecutor(max_workers=max(1, min(len(pending), self.max_streams))) as pool:
+            results = list(pool.map(lambda s: self.export_segment(s, deadline), pending))
+
+        complete = all(results)
+        self.job['status'] = 'complete' if complete else 'running'
+        self.save_manifest(self.job)
+        return complete
@@ -0,0 +1,242 @@
+import base64
+import binascii
+import gzip
+import json
+import os
+import time
+import traceback
+
+# Brotli is optional - not bundled with the Lambda runtime
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def get_allowed_origins():
+    """Get allowed origins from environment or use defaults."""
+    env_origins = os.environ.get('ALLOWED_ORIGINS', '')
+    if env_origins:
+        return [o.strip() for o in env_origins.split(',')]
+    
+    # Default for development
+    return [
+        'http://localhost:5173',
+        'http://localhost:3000',
+    ]
+
+ALLOWED_ORIGINS = get_allowed_origins()
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+
+def get_cors_headers(method='GET'):
+    """Generate CORS headers for responses."""
+    # In production, we should ideally echo the request origin if it matches our allowlist
+    # For now, we'll use the first allowed origin or '*'
+    origin = ALLOWED_ORIGINS[0] if ALLOWED_ORIGINS else '*'
+    
+    return {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': origin,
+        'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token',
+        'Access-Control-Allow-Methods': f'{method},OPTIONS'
+    }
+
+def get_header(event, name):
+    """Case-insensitive request header lookup."""
+    headers = (event or {}).get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def choose_encoding(accept_encoding):
+    """Pick the best supported encoding from an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if token:
+            weights[token] = q
+
+    supported = ['br', 'gzip'] if brotli else ['gzip']
+    best, best_q = None, 0.0
+    for encoding in supported:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def accepts_json(event):
+    """
+    API Gateway only decodes a base64 body for requests whose Accept header
+    names a binary media type, and only application/json is declared binary.
+    """
+    accept = get_header(event, 'Accept') or ''
+    return accept.split(',')[0].split(';')[0].strip().lower() == 'application/json'
+
+def compress_response(response, event):
+    """Compress the response body in place if the client accepts it and it is large enough."""
+    raw = response['body'].encode('utf-8')
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+
+    response['headers']['Vary'] = 'Accept, Accept-Encoding'
+    encoding = choose_encoding(get_header(event, 'Accept-Encoding'))
+    if not encoding or not accepts_json(event):
+        return response
+
+    started = time.perf_counter()
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    encode_ms = (time.perf_counter() - started) * 1000
+
+    print(f"Compressed response: encoding={encoding} raw_bytes={len(raw)} "
+          f"compressed_bytes={len(compressed)} ratio={len(raw) / max(len(compressed), 1):.2f} "
+          f"encode_ms={encode_ms:.2f}")
+
+    response['headers']['Content-Encoding'] = encoding
+    response['body'] = base64.b64encode(compressed).decode('ascii')
+    response['isBase64Encoded'] = True
+    return response
+
+def format_response(status_code, body, method='GET', event=None):
+    """
+    Format a consistent API Gateway response.
+    Pass the request event to allow Accept-Encoding based compression.
+    """
+    response = {
+        'statusCode': status_code,
+        'headers': get_cors_headers(method),
+        'body': json.dumps(body)
+    }
+    if event is not None:
+        compress_response(response, event)
+    return response
+
+def format_error(status_code, message, internal_error=None, method='GET'):
+    """Format a secure error response, masking internal details in production."""
+    is_prod = os.environ.get('STAGE') == 'prod'
+    
+    response_body = {
+        'error': message
+    }
+    
+    if internal_error and not is_prod:
+        response_body['details'] = str(internal_error)
+        response_body['trace'] = traceback.format_exc()
+        
+    if internal_error:
+        print(f"Error: {message} | Internal Error: {str(internal_error)}")
+    else:
+        print(f"Error: {message}")
+        
+    return format_response(status_code, response_body, method)
+
+def validate_input(data, required_fields):
+    """Validate that required fields are present in the input data."""
+    if not data:
+        return False, "Missing request body"
+    
+    missing_fields = [field for field in required_fields if field not in data or data[field] is None]
+    
+    if missing_fields:
+        return False, f"Missing required fields: {', '.join(missing_fields)}"
+    
+    return True, None
+
+def parse_body(event):
+    """
+    Parse the JSON request body.
+    Handles base64-encoded bodies (the API treats application/json as binary).
+    Raises json.JSONDecodeError on malformed input, including bad base64 or UTF-8.
+    """
+    body = event.get('body')
+    if body is None:
+        return {}
+    if isinstance(body, dict):
+        return body
+    if event.get('isBase64Encoded'):
+        try:
+            body = base64.b64decode(body, validate=True).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError) as e:
+            raise json.JSONDecodeError(f"Undecodable request body: {e}", str(body), 0) from e
+    return json.loads(body or '{}')
+
+class ValidationError(Exception):
+    """Custom exception for validation errors."""
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+def get_user_info(event):
+    """
+    Extract user info from Cognito authorizer claims.
+    Returns dict with user_id, email, and is_admin.
+    """
+    try:
+        # Support both REST API and HTTP API authorizer formats
+        rc = event.get('requestContext', {})
+        authorizer = rc.get('authorizer', {}) or {}
+        claims = authorizer.get('claims') or authorizer.get('jwt', {}).get('claims') or {}
+        
+        if not claims:
+            raise ValidationError('Authentication required')
+            
+        user_id = claims.get('sub')
+        email = claims.get('email') or claims.get('cognito:username') or 'unknown@example.com'
+        
+        # Get groups from token
+        groups_raw = claims.get('cognito:groups', [])
+        
+        # Handle groups as string or list
+        groups = []
+        if isinstance(groups_raw, str):
+            try:
+                groups = json.loads(groups_raw)
+            except:
+                groups = [g.strip() for g in groups_raw.split(',')]
+        elif isinstance(groups_raw, list):
+            groups = groups_raw
+        
+        # Check if user is in Admin group
+        is_admin = any(
+            str(g).strip().lower() == 'admin' 
+            for g in groups
+        )
+        
+        return {
+            'user_id': user_id,
+            'email': email,
+            'is_admin': is_admin,
+            'groups': groups
+        }
+    except ValidationError:
+        raise
+    except (KeyError, TypeError) as e:
+        raise ValidationError('Authentication required')
+
+
+def require_admin(event):
+    """
+    Check if user is admin. Raises ValidationError if not.
+    Returns user_info if admin.
+    """
+    user_info = get_user_info(event)
+    
+    if not user_info['is_admin']:
+        raise ValidationError('Admin access required')
+    
+    return user_info
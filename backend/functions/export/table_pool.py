@@ -0,0 +1,43 @@
+"""
+DynamoDB tables that can be shared between threads.
+
+boto3 resources are not thread-safe, and the section, fan-out, regeneration,
+note-write and rollup threads all reach the same module-level tables. A
+PooledTable hands each call a Table (on its own session) that no other thread
+is using, then takes it back. The pool grows to the peak concurrency once per
+container, so warm requests pay nothing for it.
+"""
+import threading
+
+import boto3
+
+
+class PooledTable:
+    """Drop-in for dynamodb.Table(name): table.get_item(...), table.query(...), ..."""
+
+    def __init__(self, name):
+        self.name = name
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _borrow(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return boto3.session.Session().resource('dynamodb').Table(self.name)
+
+    def _release(self, table):
+        with self._lock:
+            self._free.append(table)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        def call(*args, **kwargs):
+            table = self._borrow()
+            try:
+                return getattr(table, attr)(*args, **kwargs)
+            finally:
+                self._release(table)
+        return call
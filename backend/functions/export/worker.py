@@ -0,0 +1,110 @@
+# functions/export/worker.py
+import json
+import boto3
+import os
+import time
+from export_pipeline import DEFAULT_BUFFER_BYTES, DEFAULT_PART_BYTES, ExportRunner, export_key, json_default, \
+    output_keys
+from table_pool import PooledTable
+
+# The segment streams scan in parallel; boto3 resources are not thread-safe
+notes_table = PooledTable(os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod'))
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+EXPORT_BUCKET = os.environ.get('EXPORT_BUCKET', 'scribe32-exports-prod')
+PART_BYTES = int(os.environ.get('EXPORT_PART_BYTES', str(DEFAULT_PART_BYTES)))
+# Cap on the encoded records buffered across all segment streams
+BUFFER_BYTES = int(os.environ.get('EXPORT_BUFFER_BYTES', str(DEFAULT_BUFFER_BYTES)))
+
+# Stop this long before the Lambda timeout so the last part and checkpoint get written
+SAFETY_MARGIN_MS = 60 * 1000
+
+
+def put_object(key, data, content_type):
+    s3.put_object(
+        Bucket=EXPORT_BUCKET,
+        Key=key,
+        Body=data,
+        ContentType=content_type,
+        ServerSideEncryption='aws:kms'
+    )
+
+
+class MultipartSink:
+    """S3 multipart uploads for the segment streams (the client is thread-safe)"""
+
+    def start(self, key, content_type):
+        response = s3.create_multipart_upload(
+            Bucket=EXPORT_BUCKET,
+            Key=key,
+            ContentType=content_type,
+            ServerSideEncryption='aws:kms'
+        )
+        return response['UploadId']
+
+    def upload_part(self, key, upload_id, number, data):
+        s3.upload_part(Bucket=EXPORT_BUCKET, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+
+    def complete(self, key, upload_id):
+        # The ETags come from S3 rather than the manifest, which stays small
+        parts = []
+        for page in s3.get_paginator('list_parts').paginate(Bucket=EXPORT_BUCKET, Key=key, UploadId=upload_id):
+            parts.extend({'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in page.get('Parts', []))
+        s3.complete_multipart_upload(
+            Bucket=EXPORT_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(parts, key=lambda p: p['PartNumber'])}
+        )
+
+
+def load_manifest(export_id):
+    response = s3.get_object(Bucket=EXPORT_BUCKET, Key=export_key(export_id, 'manifest.json'))
+    return json.loads(response['Body'].read())
+
+
+def save_manifest(job):
+    put_object(
+        export_key(job['export_id'], 'manifest.json'),
+        json.dumps(job, default=json_default).encode('utf-8'),
+        'application/json'
+    )
+
+
+def lambda_handler(event, context):
+    """Run (or resume) an export job from its checkpoint manifest"""
+    export_id = event['export_id']
+    job = load_manifest(export_id)
+
+    if job['status'] in ('complete', 'failed'):
+        return {'export_id': export_id, 'status': job['status']}
+
+    if context is not None:
+        deadline = time.time() + (context.get_remaining_time_in_millis() - SAFETY_MARGIN_MS) / 1000
+    else:
+        deadline = float('inf')
+
+    runner = ExportRunner(notes_table, MultipartSink(), save_manifest, job, part_bytes=PART_BYTES,
+                          buffer_bytes=BUFFER_BYTES)
+    try:
+        complete = runner.run(deadline)
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        save_manifest(job)
+        print(f"Export {export_id} failed: {str(e)}")
+        raise
+
+    print(f"Export {export_id}: {job['records']} records, {len(output_keys(job))} files, "
+          f"complete={complete}, invocation={job['invocations']}")
+
+    if not complete:
+        # Out of time - continue from the checkpoint in a fresh invocation
+        lambda_client.invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({'export_id': export_id})
+        )
+
+    return {'export_id': export_id, 'status': job['status'], 'records': job['records']}
@@ -0,0 +1,364 @@
+# functions/generate/bedrock_guard.py
+"""
+Resilience around every Bedrock call.
+
+- Retries: throttles and transient 5xx are retried with exponential backoff and
+  full jitter, but only while the Lambda has time left for another call.
+- Circuit breaker (per model, per container): after BREAKER_FAILURE_THRESHOLD
+  transient failures within BREAKER_WINDOW_SECONDS with no success in between
+  (sporadic throttles don't trip it), calls fail fast with
+  CircuitOpenError for BREAKER_COOLDOWN_SECONDS, then one probe call decides
+  whether to close it again.
+- Rate limiter: a token bucket per model, shared by all containers through one
+  DynamoDB item, keeps requests and tokens per minute under the account's
+  Bedrock quotas (BEDROCK_RPM_LIMIT / BEDROCK_TPM_LIMIT; 0 disables). Each
+  container leases capacity for up to LEASE_REQUESTS calls at a time, so most
+  calls never touch the item; lost update races back off with jitter.
+
+CircuitOpenError and RateLimitedError count as fallback errors for
+model_router, so a request moves to the next model instead of failing.
+
+Every guarded call emits one CloudWatch Embedded Metric Format line
+(namespace METRICS_NAMESPACE) with attempts, retries, throttles, backoff,
+limiter wait and breaker state.
+"""
+import json
+import os
+import random
+import threading
+import time
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+from model_router import error_code, timed_request
+from table_pool import PooledTable
+
+RETRY_ERROR_CODES = {
+    'ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException',
+    'InternalServerException', 'ModelNotReadyException', 'ModelTimeoutException'
+}
+THROTTLE_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException'}
+
+MAX_RETRIES = int(os.environ.get('BEDROCK_MAX_RETRIES', '3'))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+# Don't start an attempt unless this much of the invocation is left afterwards
+MIN_ATTEMPT_SECONDS = 5.0
+
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_WINDOW_SECONDS = 30
+BREAKER_COOLDOWN_SECONDS = int(os.environ.get('BREAKER_COOLDOWN_SECONDS', '20'))
+
+RPM_LIMIT = int(os.environ.get('BEDROCK_RPM_LIMIT', '0'))
+TPM_LIMIT = int(os.environ.get('BEDROCK_TPM_LIMIT', '0'))
+LIMITER_MAX_WAIT_SECONDS = 10.0
+LIMITER_BACKOFF_BASE_SECONDS = 0.02
+LIMITER_BACKOFF_MAX_SECONDS = 0.5
+# Capacity taken from the shared bucket per round trip, spent locally until it
+# runs out or expires (unspent capacity is forfeited, so keep leases short)
+LEASE_REQUESTS = int(os.environ.get('BEDROCK_LEASE_REQUESTS', '4'))
+LEASE_SECONDS = 5.0
+RATE_LIMIT_TABLE = os.environ.get('GENERATION_CACHE_TABLE', 'DentalScribeGenerationCache-prod')
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DentalScribe')
+
+limiter_table = PooledTable(RATE_LIMIT_TABLE)
+
+
+class CircuitOpenError(Exception):
+    """Bedrock calls for this model are failing; not attempted"""
+
+
+class RateLimitedError(Exception):
+    """The shared rate limit had no capacity within the wait allowed"""
+
+
+def is_retryable(error):
+    return error_code(error) in RETRY_ERROR_CODES or type(error).__name__ in (
+        'ReadTimeoutError', 'ConnectTimeoutError', 'EndpointConnectionError')
+
+
+# ========================================
+# Invocation deadline
+# ========================================
+
+# One invocation at a time per container; section/map worker threads share it
+_deadline = {'at': None}
+
+
+def set_deadline(context):
+    """Bound retries and limiter waits by this invocation's remaining time"""
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        _deadline['at'] = time.time() + context.get_remaining_time_in_millis() / 1000
+    else:
+        _deadline['at'] = None
+
+
+def remaining_seconds():
+    return None if _deadline['at'] is None else _deadline['at'] - time.time()
+
+
+def has_time_for(wait_seconds):
+    remaining = remaining_seconds()
+    return remaining is None or remaining - wait_seconds >= MIN_ATTEMPT_SECONDS
+
+
+# ========================================
+# Circuit breaker
+# ========================================
+
+class CircuitBreaker:
+    """closed -> open after repeated failures -> half_open (one probe) -> closed/open"""
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        self.state = 'closed'
+        self.failures = []
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open':
+                if time.time() - self.opened_at < BREAKER_COOLDOWN_SECONDS:
+                    return False
+                self._transition('half_open')
+            if self.state == 'half_open':
+                if self.probing:
+                    return False
+                self.probing = True
+            return True
+
+    def release(self):
+        """The call said nothing about health (never sent, or a 4xx)"""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.probing = False
+            self.failures = []
+            if self.state != 'closed':
+                self._transition('closed')
+
+    def record_failure(self):
+        with self.lock:
+            now = time.time()
+            self.probing = False
+            if self.state == 'half_open':
+                self.opened_at = now
+                self._transition('open')
+                return
+            self.failures = [t for t in self.failures if now - t < BREAKER_WINDOW_SECONDS] + [now]
+            if self.state == 'closed' and len(self.failures) >= BREAKER_FAILURE_THRESHOLD:
+                self.opened_at = now
+                self._transition('open')
+
+    def _transition(self, state):
+        print(f"Circuit breaker {self.model_id}: {self.state} -> {state}")
+        self.state = state
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(model_id):
+    with _breakers_lock:
+        if model_id not in _breakers:
+            _breakers[model_id] = CircuitBreaker(model_id)
+        return _breakers[model_id]
+
+
+# ========================================
+# Shared token bucket
+# ========================================
+
+def _refill(item, now):
+    """Current (requests, tokens) in the bucket"""
+    if not item:
+        return float(RPM_LIMIT), float(TPM_LIMIT)
+    elapsed = max(now - float(item['updated_at']), 0.0)
+    requests = min(float(RPM_LIMIT), float(item['requests']) + elapsed * RPM_LIMIT / 60)
+    tokens = min(float(TPM_LIMIT), float(item['tokens']) + elapsed * TPM_LIMIT / 60)
+    return requests, tokens
+
+
+_leases = {}
+_leases_lock = threading.Lock()
+
+
+def _take_lease(model_id, tokens):
+    """Spend one request and `tokens` from this container's lease if it covers them"""
+    with _leases_lock:
+        lease = _leases.get(model_id)
+        if not lease or lease['expires_at'] < time.time():
+            return False
+        if lease['requests'] < 1 or lease['tokens'] < tokens:
+            return False
+        lease['requests'] -= 1
+        lease['tokens'] -= tokens
+        return True
+
+
+def _grant_lease(model_id, requests, tokens):
+    """Add newly leased capacity to whatever unexpired lease is left"""
+    now = time.time()
+    with _leases_lock:
+        lease = _leases.get(model_id)
+        if lease and lease['expires_at'] >= now:
+            requests += lease['requests']
+            tokens += lease['tokens']
+        _leases[model_id] = {'requests': requests, 'tokens': tokens, 'expires_at': now + LEASE_SECONDS}
+
+
+def acquire_capacity(model_id, tokens):
+    """
+    Take one request and `tokens` tokens from the model's bucket, waiting for
+    a refill if needed. Returns seconds waited; raises RateLimitedError.
+    Fails open if the table is unavailable.
+    """
+    if not RPM_LIMIT and not TPM_LIMIT:
+        return 0.0
+
+    key = f"ratelimit#{model_id}"
+    # A single request larger than the bucket could never be admitted
+    tokens = min(tokens, TPM_LIMIT) if TPM_LIMIT else 0
+    if _take_lease(model_id, tokens):
+        return 0.0
+    started = time.time()
+    conflicts = 0
+
+    while True:
+        try:
+            item = limiter_table.get_item(Key={'cache_key': key}, ConsistentRead=True).get('Item')
+        except Exception as e:
+            print(f"Error reading rate limit: {str(e)}")
+            return time.time() - started
+
+        now = time.time()
+        available_requests, available_tokens = _refill(item, now)
+        wait = 0.0
+        if RPM_LIMIT and available_requests < 1:
+            wait = (1 - available_requests) * 60 / RPM_LIMIT
+        if TPM_LIMIT and available_tokens < tokens:
+            wait = max(wait, (tokens - available_tokens) * 60 / TPM_LIMIT)
+
+        if wait > 0:
+            waited = now - started
+            if waited + wait > LIMITER_MAX_WAIT_SECONDS or not has_time_for(wait):
+                raise RateLimitedError(f"No Bedrock capacity for {model_id} within {LIMITER_MAX_WAIT_SECONDS}s")
+            time.sleep(wait + random.uniform(0, 0.05))
+            continue
+
+        # Lease what this container will likely need next, but never more than is there
+        lease_requests = min(float(LEASE_REQUESTS), available_requests) if RPM_LIMIT else 0.0
+        lease_tokens = min(tokens * LEASE_REQUESTS, available_tokens) if TPM_LIMIT else 0.0
+        update = {
+            'cache_key': key,
+            'requests': Decimal(str(round(available_requests - max(lease_requests, 1 if RPM_LIMIT else 0), 3))),
+            'tokens': Decimal(str(round(available_tokens - max(lease_tokens, tokens), 3))),
+            'updated_at': Decimal(str(round(now, 3)))
+        }
+        try:
+            # Optimistic concurrency: lose the race and we re-read
+            if item:
+                limiter_table.put_item(
+                    Item=update,
+                    ConditionExpression='updated_at = :seen',
+                    ExpressionAttributeValues={':seen': item['updated_at']}
+                )
+            else:
+                limiter_table.put_item(Item=update, ConditionExpression='attribute_not_exists(cache_key)')
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                print(f"Error updating rate limit: {str(e)}")
+                return time.time() - started
+            # Another container won; back off so contenders don't retry in lockstep
+            conflicts += 1
+            delay = random.uniform(0, min(LIMITER_BACKOFF_MAX_SECONDS, LIMITER_BACKOFF_BASE_SECONDS * (2 ** conflicts)))
+            if time.time() - started + delay > LIMITER_MAX_WAIT_SECONDS or not has_time_for(delay):
+                raise RateLimitedError(f"Rate limit for {model_id} too contended to update")
+            time.sleep(delay)
+            continue
+        except Exception as e:
+            print(f"Error updating rate limit: {str(e)}")
+            return time.time() - started
+
+        # This call is paid for; keep the rest for the next ones
+        _grant_lease(model_id, lease_requests - 1 if RPM_LIMIT else float('inf'),
+                     lease_tokens - tokens if TPM_LIMIT else float('inf'))
+        return time.time() - started
+
+
+# ========================================
+# Guarded call + metrics
+# ========================================
+
+def emit_metrics(model_id, metrics):
+    """CloudWatch Embedded Metric Format: metrics straight from the log line"""
+    units = {'BackoffMs': 'Milliseconds', 'LimiterWaitMs': 'Milliseconds'}
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                # Per model, plus an undimensioned aggregate for alarms
+                'Dimensions': [['ModelId'], []],
+                'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in metrics]
+            }]
+        },
+        'ModelId': model_id,
+        **metrics
+    }))
+
+
+def guarded_call(model_id, call, tokens=0, retry=True):
+    """
+    Run `call()` (one Bedrock request for model_id) behind the breaker and the
+    rate limiter. With retry=False (a fallback model is next) transient errors
+    are raised at once; otherwise they are retried while time allows.
+    """
+    breaker = breaker_for(model_id)
+    metrics = {'Attempts': 0, 'Retries': 0, 'Throttles': 0, 'BackoffMs': 0, 'LimiterWaitMs': 0,
+               'BreakerRejected': 0, 'BreakerOpen': 0, 'Failures': 0}
+    try:
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                metrics['BreakerRejected'] = 1
+                raise CircuitOpenError(f"Circuit open for {model_id}")
+
+            try:
+                metrics['LimiterWaitMs'] += int(acquire_capacity(model_id, tokens) * 1000)
+                metrics['Attempts'] += 1
+                result = timed_request(call)
+            except RateLimitedError:
+                breaker.release()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # A request problem, not a Bedrock health problem
+                    breaker.release()
+                    raise
+                breaker.record_failure()
+                metrics['Failures'] += 1
+                if error_code(e) in THROTTLE_ERROR_CODES:
+                    metrics['Throttles'] += 1
+
+                attempt += 1
+                delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+                if not retry or attempt > MAX_RETRIES or breaker.state == 'open' or not has_time_for(delay):
+                    raise
+                print(f"Bedrock {model_id} {error_code(e)}, retry {attempt}/{MAX_RETRIES} in {delay:.2f}s")
+                metrics['Retries'] += 1
+                metrics['BackoffMs'] += int(delay * 1000)
+                time.sleep(delay)
+                continue
+
+            breaker.record_success()
+            return result
+    finally:
+        metrics['BreakerOpen'] = 1 if breaker.state == 'open' else 0
+        emit_metrics(model_id, metrics)
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+# Large note bodies are kept in S3 with a pointer in the DynamoDB item.
+# S3_ENDPOINT_URL points the client at MinIO/moto when running locally.
+NOTE_BODIES_BUCKET = os.environ.get('NOTE_BODIES_BUCKET', 'scribe32-note-bodies-prod')
+OFFLOAD_THRESHOLD_BYTES = int(os.environ.get('OFFLOAD_THRESHOLD_BYTES', str(32 * 1024)))
+BODY_FIELDS = ('transcript', 'soap_note')
+
+PREFETCH_WORKERS = 16
+CACHE_MAX_ENTRIES = 256
+
+s3 = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None)
+
+# Bodies are immutable and addressed by hash, so cached entries never go stale
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def ref_field(field):
+    return f"{field}_ref"
+
+
+def body_key(user_id, timestamp, field, digest):
+    return f"notes/{user_id}/{timestamp}/{field}-{digest[:16]}.txt"
+
+
+def offload_bodies(item):
+    """
+    Move body fields above the size threshold to S3, replacing them with a
+    pointer ({bucket, key, sha256, size}). Mutates and returns the item.
+    """
+    for field in BODY_FIELDS:
+        value = item.get(field)
+        if not value:
+            continue
+
+        data = value.encode('utf-8')
+        if len(data) <= OFFLOAD_THRESHOLD_BYTES:
+            continue
+
+        digest = hashlib.sha256(data).hexdigest()
+        key = body_key(item.get('user_id'), item.get('timestamp'), field, digest)
+        s3.put_object(
+            Bucket=NOTE_BODIES_BUCKET,
+            Key=key,
+            Body=data,
+            ContentType='text/plain; charset=utf-8',
+            ServerSideEncryption='aws:kms'
+        )
+
+        del item[field]
+        item[ref_field(field)] = {
+            'bucket': NOTE_BODIES_BUCKET,
+            'key': key,
+            'sha256': digest,
+            'size': len(data)
+        }
+        _cache_put(digest, value)
+
+    return item
+
+
+def _cache_get(digest):
+    with _cache_lock:
+        value = _cache.get(digest)
+        if value is not None:
+            _cache.move_to_end(digest)
+        return value
+
+
+def _cache_put(digest, value):
+    with _cache_lock:
+        _cache[digest] = value
+        _cache.move_to_end(digest)
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+def load_body(ref):
+    """Fetch an offloaded body, verifying its hash"""
+    digest = ref['sha256']
+    cached = _cache_get(digest)
+    if cached is not None:
+        return cached
+
+    response = s3.get_object(Bucket=ref.get('bucket', NOTE_BODIES_BUCKET), Key=ref['key'])
+    data = response['Body'].read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"Hash mismatch for offloaded body {ref['key']}")
+
+    value = data.decode('utf-8')
+    _cache_put(digest, value)
+    return value
+
+
+def resolve_bodies(items, fields=BODY_FIELDS):
+    """
+    Fill offloaded body fields back in, fetching all pointers in parallel.
+    Bodies that fail to load are left empty and reported via '<field>_error'.
+    Mutates and returns the items.
+    """
+    pending = [
+        (item, field)
+        for item in items
+        for field in fields
+        if not item.get(field) and isinstance(item.get(ref_field(field)), dict)
+    ]
+    if not pending:
+        return items
+
+    def fetch(entry):
+        item, field = entry
+        try:
+            item[field] = load_body(item[ref_field(field)])
+        except Exception as e:
+            print(f"Error loading offloaded {field}: {str(e)}")
+            item[field] = ''
+            item[f"{field}_error"] = 'unavailable'
+
+    with ThreadPoolExecutor(max_workers=min(PREFETCH_WORKERS, len(pending))) as pool:
+        list(pool.map(fetch, pending))
+
+    return items
+
+
+def delete_bodies(user_id, timestamp):
+    """
+    Delete every body stored for a note, current and earlier versions alike
+    (they share the note's prefix). Returns the number of objects deleted.
+    """
+    prefix = body_key(user_id, timestamp, '', '').rsplit('/', 1)[0] + '/'
+    deleted = 0
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=NOTE_BODIES_BUCKET, Prefix=prefix):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if not keys:
+            continue
+        response = s3.delete_objects(Bucket=NOTE_BODIES_BUCKET, Delete={'Objects': keys, 'Quiet': True})
+        errors = response.get('Errors', [])
+        if errors:
+            raise RuntimeError(f"Could not delete {len(errors)} bodies under {prefix}: {errors[0].get('Code')}")
+        deleted += len(keys)
+    return deleted
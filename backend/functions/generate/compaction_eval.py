@@ -0,0 +1,81 @@
+# functions/generate/compaction_eval.py
+"""
+Compare notes generated with and without transcript compaction.
+
+    python compaction_eval.py [fixtures_dir] [--offline]
+
+Each fixture is a JSON file: {template_id, patient_name, transcript,
+must_include: [facts that belong in the note]}. The default set lives in
+backend/fixtures/compaction.
+
+For every fixture this reports the tokens compaction saved, whether every
+must_include fact survived in the compacted transcript, and (unless
+--offline) the fact recall of the note generated each way plus how similar
+the two notes are. Uses real Bedrock, or FAKE_BEDROCK=on for a dry run.
+"""
+import difflib
+import glob
+import json
+import os
+import sys
+
+import handler
+from transcript_compactor import compact
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'fixtures', 'compaction')
+
+
+def recall(text, facts):
+    lowered = ' '.join((text or '').lower().split())
+    found = [fact for fact in facts if fact.lower() in lowered]
+    return len(found) / len(facts) if facts else 1.0, [f for f in facts if f not in found]
+
+
+def generate(fixture, compaction):
+    handler.TRANSCRIPT_COMPACTION = compaction
+    template = handler.get_template(fixture.get('template_id', 'default_soap'))
+    return handler.sanitize_note(handler.generate_note(
+        template, fixture['transcript'], fixture.get('patient_name', 'UNKNOWN')))
+
+
+def evaluate(path, offline=False):
+    with open(path) as f:
+        fixture = json.load(f)
+    facts = fixture.get('must_include', [])
+    compacted, stats = compact(fixture['transcript'])
+    transcript_recall, transcript_missing = recall(compacted, facts)
+
+    row = {
+        'fixture': os.path.basename(path),
+        'original_tokens': stats['original_tokens'],
+        'tokens_saved': stats['tokens_saved'],
+        'saved_pct': round(100.0 * stats['tokens_saved'] / max(stats['original_tokens'], 1), 1),
+        'transcript_fact_recall': transcript_recall,
+        'transcript_missing': transcript_missing
+    }
+    if not offline:
+        raw_note = generate(fixture, compaction=False)
+        compact_note = generate(fixture, compaction=True)
+        row['note_recall_raw'], row['missing_raw'] = recall(raw_note, facts)
+        row['note_recall_compacted'], row['missing_compacted'] = recall(compact_note, facts)
+        row['note_similarity'] = round(difflib.SequenceMatcher(None, raw_note, compact_note).ratio(), 3)
+    return row
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    offline = '--offline' in sys.argv
+    paths = sorted(glob.glob(os.path.join(args[0] if args else DEFAULT_FIXTURES, '*.json')))
+    if not paths:
+        sys.exit("No fixtures found")
+
+    rows = [evaluate(path, offline) for path in paths]
+    for row in rows:
+        print(json.dumps(row))
+
+    total = sum(r['original_tokens'] for r in rows)
+    saved = sum(r['tokens_saved'] for r in rows)
+    print(f"\n{len(rows)} fixtures: {saved}/{total} transcript tokens saved ({100.0 * saved / max(total, 1):.1f}%)")
+    if any(r['transcript_missing'] for r in rows):
+        print("WARNING: compaction dropped must_include facts - see transcript_missing")
+        sys.exit(1)
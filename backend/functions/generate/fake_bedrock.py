@@ -0,0 +1,127 @@
+# functions/generate/fake_bedrock.py
+"""
+Local stand-in for the bedrock-runtime client that injects failures.
+
+FAKE_BEDROCK=on makes handler.py use it instead of Bedrock:
+  FAKE_BEDROCK_THROTTLE_RATE   fraction of calls that raise ThrottlingException (0.2)
+  FAKE_BEDROCK_ERROR_RATE      fraction that raise ServiceUnavailableException (0)
+  FAKE_BEDROCK_LATENCY_MS      per-call latency (200)
+
+`python fake_bedrock.py` drives bedrock_guard through a throttle storm and an
+outage and prints what the retries and the circuit breaker did.
+"""
+import io
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+FAKE_NOTE = """SUBJECTIVE:
+Patient presents for routine examination. No complaints.
+
+OBJECTIVE:
+Oral exam within normal limits.
+
+ASSESSMENT:
+Healthy dentition.
+
+PLAN:
+Recall in 6 months.
+END OF NOTE"""
+
+
+class FakeBedrock:
+    def __init__(self, throttle_rate=0.2, error_rate=0.0, latency_ms=200, seed=None):
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.latency_ms = latency_ms
+        self.random = random.Random(seed)
+        self.outage_until = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            throttle_rate=float(os.environ.get('FAKE_BEDROCK_THROTTLE_RATE', '0.2')),
+            error_rate=float(os.environ.get('FAKE_BEDROCK_ERROR_RATE', '0')),
+            latency_ms=int(os.environ.get('FAKE_BEDROCK_LATENCY_MS', '200'))
+        )
+
+    def outage(self, seconds):
+        """Every call fails with ServiceUnavailableException for `seconds`"""
+        self.outage_until = time.time() + seconds
+
+    def _maybe_fail(self, operation):
+        with self.lock:
+            self.calls += 1
+            roll = self.random.random()
+        if time.time() < self.outage_until or roll < self.error_rate:
+            raise ClientError({'Error': {'Code': 'ServiceUnavailableException',
+                                         'Message': 'Fake Bedrock unavailable'}}, operation)
+        if roll < self.error_rate + self.throttle_rate:
+            raise ClientError({'Error': {'Code': 'ThrottlingException',
+                                         'Message': 'Too many requests (fake)'}}, operation)
+
+    def _usage(self, body):
+        request = json.loads(body)
+        input_tokens = len(json.dumps(request.get('messages', ''))) // 4
+        return request, {'input_tokens': input_tokens, 'output_tokens': len(FAKE_NOTE) // 4}
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self._maybe_fail('InvokeModel')
+        time.sleep(self.latency_ms / 1000)
+        _, usage = self._usage(body)
+        payload = {'content': [{'type': 'text', 'text': FAKE_NOTE}], 'stop_reason': 'end_turn',
+                   'model': modelId, 'usage': usage}
+        return {'body': io.BytesIO(json.dumps(payload).encode('utf-8'))}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self._maybe_fail('InvokeModelWithResponseStream')
+        _, usage = self._usage(body)
+
+        def events():
+            def chunk(payload):
+                return {'chunk': {'bytes': json.dumps(payload).encode('utf-8')}}
+            yield chunk({'type': 'message_start', 'message': {'usage': {'input_tokens': usage['input_tokens']}}})
+            words = FAKE_NOTE.split(' ')
+            for i, word in enumerate(words):
+                time.sleep(self.latency_ms / 1000 / len(words))
+                yield chunk({'type': 'content_block_delta',
+                             'delta': {'type': 'text_delta', 'text': word if i == 0 else ' ' + word}})
+            yield chunk({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+                         'usage': {'output_tokens': usage['output_tokens']}})
+
+        return {'body': events()}
+
+
+if __name__ == '__main__':
+    import bedrock_guard
+
+    # Compress time so the run takes seconds
+    bedrock_guard.BACKOFF_BASE_SECONDS = 0.02
+    bedrock_guard.BREAKER_COOLDOWN_SECONDS = 1
+    fake = FakeBedrock(throttle_rate=0.4, latency_ms=5, seed=7)
+    body = json.dumps({'messages': [{'role': 'user', 'content': 'hi'}]})
+
+    def run(label, count):
+        outcomes = {}
+        for _ in range(count):
+            try:
+                bedrock_guard.guarded_call('fake-model', lambda: fake.invoke_model(modelId='fake-model', body=body))
+                outcome = 'ok'
+            except Exception as e:
+                outcome = bedrock_guard.error_code(e)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        print(f"== {label}: {outcomes} (fake calls so far: {fake.calls}, "
+              f"breaker: {bedrock_guard.breaker_for('fake-model').state})")
+
+    run('40% throttling, retried with backoff', 20)
+    fake.outage(1.5)
+    run('outage: breaker opens and fails fast', 20)
+    time.sleep(1.6)
+    fake.throttle_rate = 0.0
+    run('recovered: half-open probe closes the breaker', 5)
@@ -0,0 +1,245 @@
+# functions/generate/generation_cache.py
+"""
+Content-addressed cache of generated notes.
+
+The key is a hash of everything that determines the output: the user, the
+normalized transcript, the patient name (it is in the prompt), the template
+content, the model, the sampling temperature and the generation mode. Any
+template edit therefore produces new keys - nothing has to be invalidated.
+
+Lookups hit an in-process LRU first, then a DynamoDB table whose items expire
+via TTL.
+
+The same table holds single-flight lock items ("flight#<hash>") so identical
+requests arriving together share one generation and one saved note.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+from table_pool import PooledTable
+
+GENERATION_CACHE_TABLE = os.environ.get('GENERATION_CACHE_TABLE', 'DentalScribeGenerationCache-prod')
+GENERATION_CACHE_TTL_HOURS = int(os.environ.get('GENERATION_CACHE_TTL_HOURS', '24'))
+GENERATION_CACHE_ENABLED = os.environ.get('GENERATION_CACHE', 'on').lower() != 'off'
+LOCAL_CACHE_MAX_ENTRIES = 256
+CACHE_KEY_VERSION = 1
+
+# Single-flight: a leader's lock outlives any synchronous generation; identical
+# requests within FLIGHT_WINDOW_SECONDS of a finished (or queued) one reuse it.
+FLIGHT_LOCK_SECONDS = 75
+FLIGHT_WINDOW_SECONDS = int(os.environ.get('SINGLE_FLIGHT_WINDOW_SECONDS', '30'))
+FLIGHT_POLL_SECONDS = 0.25
+
+cache_table = PooledTable(GENERATION_CACHE_TABLE)
+
+_local = OrderedDict()
+_local_lock = threading.Lock()
+_stats = {'local_hits': 0, 'table_hits': 0, 'misses': 0}
+
+
+def normalize_transcript(transcript):
+    """Whitespace-insensitive: re-submits that only differ in spacing share a key"""
+    return ' '.join((transcript or '').split())
+
+
+def template_fingerprint(template):
+    return hashlib.sha256(
+        json.dumps([template.get('name', ''), template.get('example_output', '')]).encode('utf-8')
+    ).hexdigest()
+
+
+def cache_key(user_id, transcript, patient_name, template, model_id, temperature, mode):
+    payload = json.dumps([
+        CACHE_KEY_VERSION,
+        user_id,
+        normalize_transcript(transcript),
+        patient_name,
+        template_fingerprint(template),
+        model_id,
+        temperature,
+        mode
+    ], separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _local_put(key, note, expires_at):
+    with _local_lock:
+        _local[key] = (note, expires_at)
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_CACHE_MAX_ENTRIES:
+            _local.popitem(last=False)
+
+
+def get_cached(key):
+    """Return the cached note text or None"""
+    if not GENERATION_CACHE_ENABLED:
+        return None
+
+    now = time.time()
+    with _local_lock:
+        entry = _local.get(key)
+        if entry and entry[1] > now:
+            _local.move_to_end(key)
+            _stats['local_hits'] += 1
+            return entry[0]
+        if entry:
+            del _local[key]
+
+    try:
+        item = cache_table.get_item(Key={'cache_key': key}).get('Item')
+    except Exception as e:
+        print(f"Error reading generation cache: {str(e)}")
+        item = None
+
+    # TTL deletion is lazy, so check expiry ourselves
+    if item and int(item.get('ttl', 0)) > now:
+        _local_put(key, item['note'], int(item['ttl']))
+        _stats['table_hits'] += 1
+        return item['note']
+
+    _stats['misses'] += 1
+    return None
+
+
+def put_cached(key, note):
+    if not GENERATION_CACHE_ENABLED or not note:
+        return
+
+    expires_at = int(time.time() + GENERATION_CACHE_TTL_HOURS * 3600)
+    _local_put(key, note, expires_at)
+    try:
+        cache_table.put_item(Item={
+            'cache_key': key,
+            'note': note,
+            'created_at': datetime.utcnow().isoformat(),
+            'ttl': expires_at
+        })
+    except Exception as e:
+        # The cache is an optimization - never fail a generation over it
+        print(f"Error writing generation cache: {str(e)}")
+
+
+def cache_stats():
+    return dict(_stats)
+
+
+# ========================================
+# Single-flight coalescing
+# ========================================
+
+def flight_key(user_id, body, mode, force):
+    """Identity of a request as the client sent it (mode: sync / stream / async)"""
+    payload = json.dumps([
+        CACHE_KEY_VERSION,
+        user_id,
+        normalize_transcript(body.get('transcript')),
+        body.get('patient_name', 'UNKNOWN'),
+        body.get('patient_id'),
+        body.get('template_id', 'default_soap'),
+        bool(body.get('sections')),
+        mode,
+        force
+    ], separators=(',', ':'), default=str)
+    return 'flight#' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _read_flight(key):
+    item = cache_table.get_item(Key={'cache_key': key}, ConsistentRead=True).get('Item')
+    if item and int(item.get('ttl', 0)) > time.time():
+        return item
+    return None
+
+
+def acquire_flight(key, job_id=None):
+    """
+    Try to become the leader for this request. Returns (True, None) for the
+    leader, or (False, flight_item) when another request already holds it.
+    Queued/streamed leaders record their job_id so followers can share the job.
+    """
+    now = int(time.time())
+    item = {
+        'cache_key': key,
+        'status': 'pending',
+        'started_at': now,
+        'ttl': now + (FLIGHT_WINDOW_SECONDS if job_id else FLIGHT_LOCK_SECONDS)
+    }
+    if job_id:
+        item['job_id'] = job_id
+
+    for _ in range(2):
+        try:
+            cache_table.put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(cache_key) OR #ttl < :now',
+                ExpressionAttributeNames={'#ttl': 'ttl'},
+                ExpressionAttributeValues={':now': now}
+            )
+            return True, None
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                print(f"Error acquiring generation lock: {str(e)}")
+                return True, None
+        except Exception as e:
+            # Fail open: without the lock table we just lose coalescing
+            print(f"Error acquiring generation lock: {str(e)}")
+            return True, None
+
+        existing = _read_flight(key)
+        if existing:
+            return False, existing
+        # The holder finished or gave up between our put and read - try again
+
+    return True, None
+
+
+def complete_flight(key, result, job_id=None):
+    """
+    Publish the leader's response (including its saved note id) for
+    FLIGHT_WINDOW_SECONDS. Streamed jobs keep their job_id so later identical
+    requests share the finished job.
+    """
+    item = {
+        'cache_key': key,
+        'status': 'done',
+        'result': result,
+        'ttl': int(time.time()) + FLIGHT_WINDOW_SECONDS
+    }
+    if job_id:
+        item['job_id'] = job_id
+    try:
+        cache_table.put_item(Item=item)
+    except Exception as e:
+        print(f"Error completing generation lock: {str(e)}")
+
+
+def abandon_flight(key):
+    """Release the lock after a failure so a follower can take over"""
+    try:
+        cache_table.delete_item(Key={'cache_key': key})
+    except Exception as e:
+        print(f"Error releasing generation lock: {str(e)}")
+
+
+def wait_for_flight(key, deadline):
+    """
+    Poll until the leader publishes its result. Returns the finished flight
+    item, or None if the lock disappears (leader failed) or the deadline passes.
+    """
+    while time.time() < deadline:
+        try:
+            item = _read_flight(key)
+        except Exception as e:
+            print(f"Error reading generation lock: {str(e)}")
+            return None
+        if not item:
+            return None
+        if item.get('status') == 'done':
+            return item
+        time.sleep(FLIGHT_POLL_SECONDS)
+    return None
@@ -2,15 +2,112 @@
 import json
 import boto3
 import os
-import re
+from botocore.config import Config
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from security import format_response, format_error, validate_input, get_user_info, ValidationError
+from decimal import Decimal
+from bedrock_guard import guarded_call, set_deadline
+from body_store import offload_bodies, resolve_bodies
+from generation_cache import (
+    FLIGHT_LOCK_SECONDS, abandon_flight, acquire_flight, cache_key, cache_stats, complete_flight,
+    flight_key, get_cached, put_cached, wait_for_flight
+)
+from length_profile import END_SENTINEL, PROFILE_PREFIX, plan_output, record_output
+from live_draft import (
+    LIVE_SOURCE_LABEL, MAX_SEGMENT_CHARS, SegmentOrderError, append_segment, build_live_source, fold_summary,
+    get_session, live_source, needs_fold
+)
+from long_transcript import REDUCE_SOURCE_LABEL, estimate_tokens, extract_facts, is_long_transcript
+from metering import Meter, Rollups, practice_of, record_rollups
+from note_outbox import NoteWrite
+from model_router import (
+    LATENCY_BUDGET_SECONDS, choose_route, default_route, record_call, run_with_fallback, within_budget
+)
+from note_sanitizer import MarkdownSanitizer, sanitize
+from note_versions import write_version
+from sections import (
+    build_section_edit_prompt, clean_section, edit_budget, find_section, generate_sections, parse_sections,
+    splice_section, split_note
+)
+from transcript_compactor import CHITCHAT_PLACEHOLDER, COMPACTION_VERSION, compact
+from security import format_response, format_error, validate_input, parse_body, get_user_info, ValidationError
+from table_pool import PooledTable
 
-# Initialize clients
-bedrock = boto3.client('bedrock-runtime', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
-dynamodb = boto3.resource('dynamodb')
-notes_table = dynamodb.Table(os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod'))
-templates_table = dynamodb.Table(os.environ.get('TEMPLATES_TABLE', 'DentalScribeTemplates-prod'))
+# Initialize clients. Retries are done by bedrock_guard (deadline-aware, with
+# jitter), so botocore makes a single attempt.
+bedrock = boto3.client(
+    'bedrock-runtime',
+    region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+    config=Config(retries={'total_max_attempts': 1})
+)
+# For calls that have a fallback model. read_timeout bounds each socket read;
+# the budget itself is enforced on the wall clock by within_budget
+bedrock_budgeted = boto3.client(
+    'bedrock-runtime',
+    region_name=os.environ.get('AWS_REGION', 'us-east-1'),
+    config=Config(read_timeout=LATENCY_BUDGET_SECONDS, retries={'total_max_attempts': 1})
+)
+if os.environ.get('FAKE_BEDROCK', 'off').lower() == 'on':
+    # Local runs: canned notes with injected throttles (see fake_bedrock.py)
+    from fake_bedrock import FakeBedrock
+    bedrock = bedrock_budgeted = FakeBedrock.from_env()
+# Shared with the section, fan-out, write and rollup threads (see table_pool.py)
+notes_table = PooledTable(os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod'))
+templates_table = PooledTable(os.environ.get('TEMPLATES_TABLE', 'DentalScribeTemplates-prod'))
+jobs_table = PooledTable(os.environ.get('JOBS_TABLE', 'DentalScribeGenerationJobs-prod'))
+lambda_client = boto3.client('lambda')
+# SQS_ENDPOINT_URL points the client at ElasticMQ when running locally
+sqs = boto3.client('sqs', endpoint_url=os.environ.get('SQS_ENDPOINT_URL') or None)
+GENERATION_QUEUE_URL = os.environ.get('GENERATION_QUEUE_URL', '')
+
+# Use Claude Haiku for fast, cost-effective generation. This is the primary
+# model; model_router.py may route a request to FAST_MODEL_ID / FALLBACK_MODEL_ID.
+MODEL_ID = os.environ.get('MODEL_ID', 'us.anthropic.claude-haiku-4-5-20251001-v1:0')
+DEFAULT_MAX_TOKENS = 2000
+TEMPERATURE = 0.1
+
+# Deterministic filler / duplicate / small-talk removal before the transcript
+# reaches the model (see transcript_compactor.py); TRANSCRIPT_COMPACTION=off disables
+TRANSCRIPT_COMPACTION = os.environ.get('TRANSCRIPT_COMPACTION', 'on').lower() != 'off'
+
+# Output cut off at max_tokens is continued from where it stopped (assistant prefill)
+MAX_CONTINUATIONS = 1
+
+# Section mode: generate each template section concurrently (opt in per request
+# with ?sections=1, or for every request with SECTIONED_GENERATION=on)
+SECTIONED_GENERATION = os.environ.get('SECTIONED_GENERATION', 'off').lower() == 'on'
+
+# template_ids: [...] generates one note per template from the same transcript, concurrently
+MAX_FANOUT_TEMPLATES = int(os.environ.get('MAX_FANOUT_TEMPLATES', '4'))
+
+# Prompt caching: the static system prefix is marked cacheable for model families
+# that support it on Bedrock. PROMPT_CACHING=off disables the markers.
+PROMPT_CACHING = os.environ.get('PROMPT_CACHING', 'auto').lower()
+PROMPT_CACHE_MODEL_FAMILIES = (
+    'claude-3-5-haiku', 'claude-3-7-sonnet', 'claude-haiku-4', 'claude-sonnet-4', 'claude-opus-4'
+)
+
+# Warm-container template cache. Entries are served without any read for
+# TEMPLATE_CACHE_TTL_SECONDS; after that one read of the version item (bumped by
+# the templates handler on every write) revalidates the whole cache.
+TEMPLATE_CACHE_TTL_SECONDS = float(os.environ.get('TEMPLATE_CACHE_TTL_SECONDS', '10'))
+TEMPLATE_CACHE_MAX_ENTRIES = int(os.environ.get('TEMPLATE_CACHE_MAX_ENTRIES', '128'))
+TEMPLATES_VERSION_ID = '__version__'
+
+_template_cache = OrderedDict()
+_template_cache_state = {'version': None, 'validated_at': 0.0, 'hits': 0, 'misses': 0}
+
+# Streaming mode: how often partial text is pushed to the job item for polling clients
+STREAM_FLUSH_SECONDS = float(os.environ.get('STREAM_FLUSH_SECONDS', '0.25'))
+JOB_TTL_HOURS = 24
+
+# Queued jobs: GET /jobs/{job_id}?wait=N long-polls, capped below the API Gateway timeout
+JOB_LONG_POLL_SECONDS = 20
+JOB_POLL_INTERVAL_SECONDS = 0.5
 
 # Default templates (same as in templates handler)
 DEFAULT_TEMPLATES = {
@@ -83,34 +180,97 @@ RECOMMENDATIONS:
 }
 
 
-def get_template(template_id):
-    """Fetch template by ID - check defaults first, then DynamoDB"""
-    
-    # Check if it's a default template
+def get_templates_version():
+    """Current templates version stamp (0 if no template has been written yet)"""
+    response = templates_table.get_item(
+        Key={'template_id': TEMPLATES_VERSION_ID},
+        ProjectionExpression='version'
+    )
+    return int(response.get('Item', {}).get('version', 0))
+
+
+def validate_template_cache():
+    """Drop cached templates if the version stamp moved since the last check"""
+    now = time.monotonic()
+    state = _template_cache_state
+    if now - state['validated_at'] < TEMPLATE_CACHE_TTL_SECONDS:
+        return
+
+    try:
+        version = get_templates_version()
+    except Exception as e:
+        # Can't validate - don't trust the cache
+        print(f"Error reading templates version: {str(e)}")
+        _template_cache.clear()
+        state['validated_at'] = 0.0
+        return
+
+    if version != state['version']:
+        _template_cache.clear()
+        state['version'] = version
+    state['validated_at'] = now
+
+
+def find_template(template_id):
+    """
+    Template by ID - defaults first, then the warm cache, then DynamoDB.
+    None if there is no such template; read errors are raised.
+    """
     if template_id in DEFAULT_TEMPLATES:
         return DEFAULT_TEMPLATES[template_id]
-    
-    # Try to fetch from DynamoDB
+
+    # Reserved ids (version stamp, length profiles) are not templates
+    if template_id == TEMPLATES_VERSION_ID or template_id.startswith(PROFILE_PREFIX):
+        return None
+
+    validate_template_cache()
+    cached = _template_cache.get(template_id)
+    if cached is not None:
+        _template_cache.move_to_end(template_id)
+        _template_cache_state['hits'] += 1
+        print(f"Template cache hit: {template_id} (hits={_template_cache_state['hits']} "
+              f"misses={_template_cache_state['misses']})")
+        return cached
+
+    _template_cache_state['misses'] += 1
+    print(f"Template cache miss: {template_id} (hits={_template_cache_state['hits']} "
+          f"misses={_template_cache_state['misses']})")
+
+    template = templates_table.get_item(Key={'template_id': template_id}).get('Item')
+    if not template:
+        return None
+    resolved = {
+        'name': template.get('name', 'Custom Template'),
+        'example_output': template.get('example_output', '')
+    }
+    _template_cache[template_id] = resolved
+    while len(_template_cache) > TEMPLATE_CACHE_MAX_ENTRIES:
+        _template_cache.popitem(last=False)
+    return resolved
+
+
+def get_template(template_id):
+    """Fetch template by ID, falling back to default SOAP when it is missing or unreadable"""
     try:
-        response = templates_table.get_item(Key={'template_id': template_id})
-        template = response.get('Item')
-        if template:
-            return {
-                'name': template.get('name', 'Custom Template'),
-                'example_output': template.get('example_output', '')
-            }
+        template = find_template(template_id)
     except Exception as e:
         print(f"Error fetching template: {str(e)}")
-    
-    # Fallback to default SOAP
-    return DEFAULT_TEMPLATES['default_soap']
+        template = None
+    return template or DEFAULT_TEMPLATES['default_soap']
+
 
+def build_prompt(template, transcript, patient_name, source_label='TRANSCRIPT'):
+    """
+    Build the prompt for Bedrock using the template's example output.
 
-def build_prompt(template, transcript, patient_name):
-    """Build the prompt for Bedrock using the template's example output"""
+    Returns {'system': ..., 'user': ...}. The system part depends only on the
+    template, so it is identical across visits and can be served from the
+    Bedrock prompt cache; everything visit-specific goes in the user message.
+    A prompt may also carry 'max_tokens' (default DEFAULT_MAX_TOKENS) and
+    'stop_sequences'.
+    """
     
     example = template.get('example_output', '')
-    template_name = template.get('name', 'Clinical Note')
     
     system_prompt = f"""You are an expert Dental Scribe AI.
 
@@ -122,8 +282,6 @@ IMPORTANT: Format your output EXACTLY like the example below. Match the section
 {example}
 ===== END EXAMPLE =====
 
-Generate a note for patient "{patient_name}" following the exact format shown above.
-
 Key guidelines:
 - Use the same section headers as the example
 - Match the formatting style (bullets, numbering, etc.)
@@ -132,23 +290,479 @@ Key guidelines:
 - Use proper dental terminology
 - Include specific tooth numbers when mentioned
 - Note any procedures performed or recommended
+- "{CHITCHAT_PLACEHOLDER}" marks social conversation removed from the transcript; do not mention it
+- When the note is complete, write {END_SENTINEL} on its own line and nothing after it
 """
 
-    return system_prompt
+    user_prompt = f"""Generate a note for patient "{patient_name}" following the exact format shown in the example.
+
+{source_label}:
+{transcript}"""
+
+    return {'system': system_prompt, 'user': user_prompt, 'stop_sequences': [END_SENTINEL]}
+
+
+def prepare_prompt(template, transcript, patient_name, live=None, meter=None):
+    """
+    Prompt for the final note, with max_tokens sized from the template's length
+    profile and the transcript (see length_profile.py). Long transcripts are
+    first reduced to clinical facts extracted from chunks in parallel (see
+    long_transcript.py). Transcripts are compacted first unless disabled.
+
+    live: (facts, tail) from a live drafting session (see live_draft.py) - the
+    note is written from the facts summarized during the visit plus the tail.
+    meter: a metering.Meter; every Bedrock call made for the note adds to it.
+    """
+    compaction = None
+    whole = transcript
+    if live:
+        # Only the tail still needs to go in the prompt
+        facts, transcript = live
+    if TRANSCRIPT_COMPACTION:
+        transcript, compaction = compact(transcript)
+        print(json.dumps({'event': 'transcript_compaction', 'template': template.get('name'), **compaction}))
+        whole = compact(whole)[0] if live else transcript
+
+    # Length profiles are calibrated on whole (compacted) transcripts
+    plan = plan_output(templates_table, template, whole)
+
+    if live:
+        source = build_live_source(facts, transcript)
+        print(json.dumps({'event': 'live_draft', 'template': template.get('name'),
+                          'facts_tokens': estimate_tokens(facts), 'tail_tokens': estimate_tokens(transcript),
+                          'transcript_tokens': plan['transcript_tokens']}))
+        prompt = build_prompt(template, source, patient_name, source_label=LIVE_SOURCE_LABEL)
+    elif is_long_transcript(transcript):
+        facts = extract_facts(transcript, lambda p: invoke_model(dict(p, meter=meter)))
+        prompt = build_prompt(template, facts, patient_name, source_label=REDUCE_SOURCE_LABEL)
+    else:
+        prompt = build_prompt(template, transcript, patient_name)
+
+    prompt['max_tokens'] = plan['max_tokens']
+    prompt['plan'] = plan
+    prompt['compaction'] = compaction
+    prompt['meter'] = meter
+    prompt['route'] = choose_route(
+        plan['transcript_tokens'], len(parse_sections(template.get('example_output', ''))),
+        plan['predicted_tokens']
+    )
+    return prompt
+
+
+def wants_sections(event, body):
+    params = event.get('queryStringParameters') or {}
+    value = params.get('sections', body.get('sections'))
+    if value is None:
+        return SECTIONED_GENERATION
+    return str(value).lower() in ('1', 'true')
+
+
+def generate_note(template, transcript, patient_name, sectioned=False, live=None, meter=None):
+    """Blocking generation. Returns the raw (unsanitized) note text."""
+    prompt = prepare_prompt(template, transcript, patient_name, live=live, meter=meter)
+
+    visit_summary = None
+    if sectioned:
+        sections = parse_sections(template.get('example_output', ''))
+        if len(sections) >= 2:
+            try:
+                visit_summary, usage = generate_sections(prompt, sections, patient_name, invoke_model,
+                                                         prompt.get('max_tokens', DEFAULT_MAX_TOKENS))
+            except Exception as e:
+                print(f"Sectioned generation failed, falling back to a single call: {str(e)}")
+
+    if visit_summary is None:
+        visit_summary, usage = invoke_model(prompt)
+    record_output(templates_table, template, prompt['plan'], usage.get('output_tokens'),
+                  truncated=usage.get('stop_reason') == 'max_tokens')
+    return visit_summary
+
+
+def is_forced(event, body):
+    """force=true skips the generation cache (e.g. an explicit "regenerate")"""
+    params = event.get('queryStringParameters') or {}
+    return str(params.get('force', body.get('force', ''))).lower() in ('1', 'true')
+
+
+def note_cache_key(user_id, template, transcript, patient_name, sectioned, live=False):
+    mode = 'sections' if sectioned else 'single'
+    if TRANSCRIPT_COMPACTION:
+        # Compacted and raw transcripts produce different notes
+        mode += '+' + COMPACTION_VERSION
+    if live:
+        mode += '+live'
+    return cache_key(user_id, transcript, patient_name, template, MODEL_ID, TEMPERATURE, mode)
+
+
+def cacheable(meter):
+    """
+    Only notes written entirely by the primary model are cached: the key names
+    MODEL_ID, and a fast-tier or fallback note must not be served for 24 h to
+    requests that should get the primary.
+    """
+    model_ids = meter.to_item()['model_ids']
+    if model_ids == [MODEL_ID]:
+        return True
+    print(f"Not caching note from {model_ids} (primary is {MODEL_ID})")
+    return False
+
+
+def generate_cached(user_id, template, transcript, patient_name, sectioned=False, force=False, live=None,
+                    meter=None):
+    """
+    Sanitized note for this request, from the generation cache unless force is
+    set. Returns (note, cached, key); a fresh note is not stored under key yet -
+    persist_note does that while the note write is in flight. Phases are timed
+    into `meter` when given.
+    """
+    meter = meter or Meter()
+    key = note_cache_key(user_id, template, transcript, patient_name, sectioned, live=bool(live))
+    if not force:
+        started = time.time()
+        with meter.phase('cache_lookup'):
+            cached = get_cached(key)
+        if cached is not None:
+            print(f"Generation cache hit in {int((time.time() - started) * 1000)} ms {cache_stats()}")
+            return cached, True, key
+
+    with meter.phase('model'):
+        raw = generate_note(template, transcript, patient_name, sectioned=sectioned, live=live, meter=meter)
+    with meter.phase('sanitize'):
+        visit_summary = sanitize_note(raw)
+    return visit_summary, False, key
+
+
+def supports_prompt_cache(model_id):
+    if PROMPT_CACHING == 'off':
+        return False
+    return any(family in model_id for family in PROMPT_CACHE_MODEL_FAMILIES)
+
+
+def build_bedrock_body(prompt, model_id=MODEL_ID, prefill=None):
+    """prefill: text the model already produced, to continue a truncated answer"""
+    system_block = {"type": "text", "text": prompt['system']}
+    if supports_prompt_cache(model_id):
+        # Everything up to and including this block is cached
+        system_block["cache_control"] = {"type": "ephemeral"}
+
+    messages = [{
+        "role": "user",
+        "content": prompt['user']
+    }]
+    if prefill:
+        messages.append({"role": "assistant", "content": prefill})
+
+    body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": prompt.get('max_tokens', DEFAULT_MAX_TOKENS),
+        "system": [system_block],
+        "messages": messages,
+        "temperature": TEMPERATURE
+    }
+    if prompt.get('stop_sequences'):
+        body["stop_sequences"] = prompt['stop_sequences']
+    return json.dumps(body)
+
+
+# Cumulative prompt-cache counters for this warm container
+PROMPT_CACHE_STATS = {'calls': 0, 'input_tokens': 0, 'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0}
+_usage_lock = threading.Lock()  # map-reduce calls log usage from worker threads
+
+
+def log_usage(usage, model_id=MODEL_ID):
+    """Log token usage including prompt-cache reads/writes"""
+    usage = usage or {}
+    with _usage_lock:
+        PROMPT_CACHE_STATS['calls'] += 1
+        for key in ('input_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens'):
+            PROMPT_CACHE_STATS[key] += int(usage.get(key, 0) or 0)
+
+        total_input = (PROMPT_CACHE_STATS['input_tokens'] + PROMPT_CACHE_STATS['cache_read_input_tokens']
+                       + PROMPT_CACHE_STATS['cache_creation_input_tokens'])
+        hit_ratio = PROMPT_CACHE_STATS['cache_read_input_tokens'] / total_input if total_input else 0.0
+
+    print(f"Bedrock usage: model={model_id} input_tokens={usage.get('input_tokens', 0)} "
+          f"cache_read_input_tokens={usage.get('cache_read_input_tokens', 0)} "
+          f"cache_creation_input_tokens={usage.get('cache_creation_input_tokens', 0)} "
+          f"output_tokens={usage.get('output_tokens', 0)} "
+          f"container_cache_hit_ratio={hit_ratio:.2f} container_calls={PROMPT_CACHE_STATS['calls']}")
+
+
+def add_usage(total, usage, stop_reason, continuations):
+    """Sum token counts across continuation calls into `total`"""
+    for key, value in (usage or {}).items():
+        if isinstance(value, (int, float)):
+            total[key] = total.get(key, 0) + value
+    total['stop_reason'] = stop_reason
+    total['continuations'] = continuations
+
+
+def quota_tokens(prompt):
+    """Tokens a call counts against the TPM quota: input plus the max_tokens reservation"""
+    return int(estimate_tokens(prompt['system']) + estimate_tokens(prompt['user'])
+               + prompt.get('max_tokens', DEFAULT_MAX_TOKENS))
+
+
+def invoke_model(prompt):
+    """
+    Run a blocking Bedrock generation. Returns (raw note text, usage).
+    An answer cut off at max_tokens is continued up to MAX_CONTINUATIONS times.
+    """
+    text = ''
+    total_usage = {}
+    route = prompt.get('route') or default_route()
+
+    for attempt in range(MAX_CONTINUATIONS + 1):
+        # The API rejects an assistant prefill that ends in whitespace
+        text = text.rstrip()
+
+        def call(model_id, last):
+            def request():
+                response = (bedrock if last else bedrock_budgeted).invoke_model(
+                    modelId=model_id,
+                    contentType='application/json',
+                    accept='application/json',
+                    body=build_bedrock_body(prompt, model_id, prefill=text or None)
+                )
+                return json.loads(response['body'].read())
+            # Retry in place only on the last candidate; otherwise the next model is the retry
+            return guarded_call(model_id, request if last else lambda: within_budget(request),
+                                tokens=quota_tokens(prompt), retry=last)
+
+        response_body, model_id, candidate, latency_ms = run_with_fallback(route, call)
+        usage = response_body.get('usage', {})
+        log_usage(usage, model_id)
+        record_call(route, model_id, candidate, True, latency_ms, usage.get('output_tokens'))
+        if prompt.get('meter'):
+            prompt['meter'].add_call(model_id, usage, latency_ms)
+        total_usage['model_id'] = model_id
+        # A continuation stays on the model that wrote the first part
+        route = dict(route, candidates=route['candidates'][route['candidates'].index(model_id):])
+
+        # Handle response format
+        if 'content' in response_body:
+            text += response_body['content'][0]['text']
+        else:
+            text += response_body.get('completion', '')
+
+        stop_reason = response_body.get('stop_reason')
+        add_usage(total_usage, usage, stop_reason, attempt)
+        if stop_reason != 'max_tokens':
+            break
+        print(f"Output hit max_tokens={prompt.get('max_tokens', DEFAULT_MAX_TOKENS)} (attempt {attempt + 1})")
+
+    return text, total_usage
+
+
+def stream_model(prompt, usage=None):
+    """
+    Yield text deltas as Bedrock produces them; token usage is collected into
+    `usage`. An answer cut off at max_tokens is continued like invoke_model.
+    """
+    usage = {} if usage is None else usage
+    text = ''
+    route = prompt.get('route') or default_route()
+
+    for attempt in range(MAX_CONTINUATIONS + 1):
+        prefill = text.rstrip() or None
+
+        # Throttling etc. surfaces when the stream is opened, so fallback happens
+        # before any text is sent; a stream that fails midway is not replayed
+        def call(model_id, last):
+            return guarded_call(model_id, lambda: bedrock.invoke_model_with_response_stream(
+                modelId=model_id,
+                contentType='application/json',
+                accept='application/json',
+                body=build_bedrock_body(prompt, model_id, prefill=prefill)
+            ), tokens=quota_tokens(prompt), retry=last)
+
+        response, model_id, candidate, open_ms = run_with_fallback(route, call)
+        started = time.time()
+        usage['model_id'] = model_id
+
+        call_usage = {}
+        stop_reason = None
+        for stream_event in response['body']:
+            chunk = stream_event.get('chunk')
+            if not chunk:
+                continue
+            payload = json.loads(chunk['bytes'])
+            event_type = payload.get('type')
+            if event_type == 'content_block_delta':
+                delta = payload.get('delta', {}).get('text')
+                if delta:
+                    text += delta
+                    yield delta
+            elif event_type == 'message_start':
+                call_usage.update(payload.get('message', {}).get('usage', {}))
+            elif event_type == 'message_delta':
+                call_usage.update(payload.get('usage', {}))
+                stop_reason = payload.get('delta', {}).get('stop_reason', stop_reason)
+
+        log_usage(call_usage, model_id)
+        # Opening the stream plus reading it, without limiter waits or backoff
+        latency_ms = open_ms + (time.time() - started) * 1000
+        record_call(route, model_id, candidate, True, latency_ms, call_usage.get('output_tokens'))
+        if prompt.get('meter'):
+            prompt['meter'].add_call(model_id, call_usage, latency_ms)
+        route = dict(route, candidates=route['candidates'][route['candidates'].index(model_id):])
+        add_usage(usage, call_usage, stop_reason, attempt)
+        if stop_reason != 'max_tokens':
+            break
+        print(f"Output hit max_tokens={prompt.get('max_tokens', DEFAULT_MAX_TOKENS)} (attempt {attempt + 1})")
+
+
+def sanitize_note(visit_summary):
+    """Sanitize Markdown to ensure plain text output"""
+    return sanitize(visit_summary)
+
+
+def save_note(user_id, user_email, body, template, visit_summary, timestamp=None, meter=None):
+    """
+    Start saving the note to DynamoDB in the background (see note_outbox.py).
+    Returns (timestamp, NoteWrite); call wait() on it for the persistence status
+    before responding. The meter's tokens and latencies so far are stored on
+    the note (see metering.py).
+    """
+    timestamp = timestamp or datetime.utcnow().isoformat()
+    ttl = int((datetime.now() + timedelta(days=365)).timestamp())
+
+    item = {
+        'user_id': user_id,
+        'timestamp': timestamp,
+        'patient_name': body.get('patient_name', 'UNKNOWN'),
+        'patient_id': body.get('patient_id'),
+        'transcript': body.get('transcript'),
+        'soap_note': visit_summary,
+        'template_id': body.get('template_id', 'default_soap'),
+        'template_name': template.get('name', 'Unknown'),
+        'provider_email': user_email,
+        'practice_id': body.get('practice_id'),
+        'ttl': ttl,
+        'created_at': timestamp
+    }
+    if meter is not None:
+        item['metering'] = meter.to_item()
+
+    # Big bodies go to S3 on the write thread too
+    return timestamp, NoteWrite(item)
+
+
+def persist_note(user_id, user_email, body, template, visit_summary, meter, cached, key=None, timestamp=None):
+    """
+    Save the note, storing the cache entry and usage rollups while the write is
+    in flight. Returns (timestamp, persistence); never raises.
+    """
+    try:
+        timestamp, write = save_note(user_id, user_email, body, template, visit_summary,
+                                     timestamp=timestamp, meter=meter)
+    except Exception as e:
+        print(f"Error saving note: {str(e)}")
+        timestamp, write = None, None
+
+    rollups = Rollups(meter, user_id, body.get('practice_id'), cached=cached)
+    if key and not cached and cacheable(meter):
+        put_cached(key, visit_summary)
+
+    persistence = write.wait() if write else 'failed'
+    rollups.wait()
+    return timestamp, persistence
+
+
+def note_result(user_id, template, visit_summary, timestamp, persistence):
+    """
+    persistence: 'saved', 'pending' (the write was still in flight; the outbox
+    has a copy), 'queued' (the outbox will write it) or 'failed'
+    """
+    persisted = persistence in ('saved', 'pending', 'queued')
+    return {
+        'note': visit_summary,
+        'timestamp': timestamp if persisted else None,
+        'note_id': f"{user_id}#{timestamp}" if persisted else None,
+        'template_used': template.get('name', 'Unknown'),
+        'saved': persistence == 'saved',
+        'persistence': persistence
+    }
+
+
+def get_request_user(event):
+    """Get User Info (Safely)"""
+    try:
+        user_info = get_user_info(event)
+        return user_info['user_id'], user_info['email']
+    except ValidationError:
+        # Fallback for testing/dev if no authorizer
+        return "test-user", "test@example.com"
+
+
+def follow_flight(flight, context):
+    """
+    Follower side of request coalescing: wait for the leader's result, taking
+    over the flight if the leader fails. Returns (result, leader) - the
+    published result (None if there is none), and whether this request now
+    holds the flight. (None, False) means time ran out while another request
+    was still generating.
+    """
+    if context is not None:
+        deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - 5
+    else:
+        deadline = time.time() + FLIGHT_LOCK_SECONDS
+
+    while True:
+        done = wait_for_flight(flight, deadline)
+        if done:
+            return done['result'], False
+        if time.time() >= deadline:
+            return None, False
+        # The leader failed - generate this one ourselves, unless another
+        # follower got there first
+        leader, existing = acquire_flight(flight)
+        if leader:
+            return None, True
+        if existing.get('status') == 'done':
+            return existing['result'], False
+
+
+def coalesced_response(result, event):
+    result = dict(result, coalesced=True)
+    return format_response(200, json.loads(json.dumps(result, default=_decimal_default)),
+                           method='POST', event=event)
 
 
 def lambda_handler(event, context):
+    set_deadline(context)
+
+    # Async streaming worker invocation (see start_stream_job)
+    if event.get('stream_job_id'):
+        return run_stream_job(event)
+
+    # Async live-draft summary fold (see live_segment)
+    if event.get('live_fold_session_id'):
+        return run_live_fold(event)
+
     # Handle OPTIONS preflight
     if event.get('httpMethod') == 'OPTIONS':
         return format_response(200, {}, method='POST')
 
+    # Poll a queued job or a streaming generation
+    if event.get('httpMethod') == 'GET':
+        path_params = event.get('pathParameters') or {}
+        if event.get('resource') == '/jobs/{job_id}':
+            return get_job(event, path_params.get('job_id'))
+        return get_stream_job(event, path_params.get('job_id'))
+
+    if event.get('resource') == '/generate-note/section':
+        return regenerate_section(event)
+
+    if event.get('resource') == '/generate-note/live/{session_id}/segments':
+        return live_segment(event, context)
+
+    # Whether this request holds the coalescing flight (released if anything fails)
+    holding = False
     try:
         # 1. Parse and Validate Input
         try:
-            if 'body' in event and isinstance(event['body'], str):
-                body = json.loads(event['body'])
-            else:
-                body = event.get('body', {})
+            body = parse_body(event)
         except json.JSONDecodeError:
             return format_error(400, "Invalid JSON in request body", method='POST')
 
@@ -161,117 +775,652 @@ def lambda_handler(event, context):
         template_id = body.get('template_id', 'default_soap')
 
         # 2. Get User Info (Safely)
+        user_id, user_email = get_request_user(event)
+        body['practice_id'] = practice_of(event)
+
+        params = event.get('queryStringParameters') or {}
+        body['sections'] = wants_sections(event, body)
+        body['force'] = is_forced(event, body)
+
+        if body.get('template_ids') is not None:
+            return generate_fanout(event, context, body, params, user_id, user_email)
+
+        if str(params.get('stream', body.get('stream', ''))).lower() in ('1', 'true'):
+            return start_stream_job(event, context, body, user_id, user_email)
+
+        if str(params.get('async', body.get('async', ''))).lower() in ('1', 'true'):
+            return enqueue_job(body, user_id, user_email, body['sections'], body['force'])
+
+        # 3. Coalesce with an identical request that is already generating
+        flight = flight_key(user_id, body, 'sync', body['force'])
+        leader, _ = acquire_flight(flight)
+        if not leader:
+            result, leader = follow_flight(flight, context)
+            if result is not None:
+                return coalesced_response(result, event)
+            if not leader:
+                return format_error(503, "An identical request is still generating; retry shortly",
+                                    method='POST')
+        holding = True
+
+        # 4. Fetch the template
+        meter = Meter()
         try:
-            user_info = get_user_info(event)
-            user_id = user_info['user_id']
-            user_email = user_info['email']
-        except ValidationError:
-            # Fallback for testing/dev if no authorizer
-            user_id = "test-user"
-            user_email = "test@example.com"
-
-        # 3. Fetch the template
-        try:
-            template = get_template(template_id)
+            with meter.phase('template_fetch'):
+                template = get_template(template_id)
         except Exception as e:
+            abandon_flight(flight)
             return format_error(500, "Failed to fetch template", internal_error=e, method='POST')
-        
-        # 4. Build the prompt
-        system_prompt = build_prompt(template, transcript, patient_name)
 
-        # 5. Generate note using Bedrock
+        # 5. Build the prompt and generate note using Bedrock (or the generation cache)
         try:
-            bedrock_body = json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 2000,
-                "messages": [{
-                    "role": "user",
-                    "content": f"{system_prompt}\n\nTRANSCRIPT:\n{transcript}"
-                }],
-                "temperature": 0.1
-            })
+            visit_summary, cached, key = generate_cached(
+                user_id, template, transcript, patient_name,
+                sectioned=body['sections'], force=body['force'], live=load_live(body, user_id, transcript),
+                meter=meter
+            )
+        except Exception as e:
+            abandon_flight(flight)
+            return format_error(500, "Failed to generate note via AI", internal_error=e, method='POST')
 
-            # Use Claude Haiku for fast, cost-effective generation
-            model_id = os.environ.get('MODEL_ID', 'us.anthropic.claude-haiku-4-5-20251001-v1:0')
+        # 6. Auto-save to DynamoDB (bounded wait; the outbox takes over on failure)
+        timestamp, persistence = persist_note(user_id, user_email, body, template, visit_summary, meter,
+                                              cached, key=key)
 
-            response = bedrock.invoke_model(
-                modelId=model_id,
-                contentType='application/json',
-                accept='application/json',
-                body=bedrock_body
+        result = note_result(user_id, template, visit_summary, timestamp, persistence)
+        result['cached'] = cached
+        response = format_response(200, result, method='POST', event=event)
+        complete_flight(flight, result)
+        return response
+
+    except Exception as e:
+        if holding:
+            abandon_flight(flight)
+        return format_error(500, "An unexpected error occurred", internal_error=e, method='POST')
+
+
+# ========================================
+# Multi-template fan-out
+# ========================================
+
+def generate_fanout(event, context, body, params, user_id, user_email):
+    """
+    {transcript, template_ids: [...]} - one note per template, generated
+    concurrently and each saved as its own note, so the request takes about as
+    long as the slowest template. Returns {'notes': [...]} in template_ids
+    order; a template that fails gets an 'error' entry instead of failing the
+    others. Blocking only (no stream / async).
+    """
+    template_ids = body.get('template_ids')
+    if not isinstance(template_ids, list) or not template_ids or \
+            not all(isinstance(t, str) and t for t in template_ids):
+        return format_error(400, "template_ids must be a non-empty list of template IDs", method='POST')
+    template_ids = list(dict.fromkeys(template_ids))
+    if len(template_ids) > MAX_FANOUT_TEMPLATES:
+        return format_error(400, f"At most {MAX_FANOUT_TEMPLATES} template_ids per request", method='POST')
+    for mode in ('stream', 'async'):
+        if str(params.get(mode, body.get(mode, ''))).lower() in ('1', 'true'):
+            return format_error(400, f"template_ids cannot be combined with {mode}", method='POST')
+
+    flight = flight_key(user_id, dict(body, template_id=','.join(template_ids)), 'fanout', body['force'])
+    leader, _ = acquire_flight(flight)
+    if not leader:
+        result, leader = follow_flight(flight, context)
+        if result is not None:
+            return coalesced_response(result, event)
+        if not leader:
+            return format_error(503, "An identical request is still generating; retry shortly", method='POST')
+
+    try:
+        return run_fanout(event, body, user_id, user_email, template_ids, flight)
+    except Exception:
+        abandon_flight(flight)
+        raise
+
+
+def run_fanout(event, body, user_id, user_email, template_ids, flight):
+    """The leader's side of generate_fanout"""
+    transcript = body.get('transcript')
+    patient_name = body.get('patient_name', 'UNKNOWN')
+    live = load_live(body, user_id, transcript)
+    started = datetime.utcnow()
+    # Fetched up front: the template cache is not shared across threads
+    templates = {}
+    meters = {template_id: Meter() for template_id in template_ids}
+    for template_id in template_ids:
+        try:
+            with meters[template_id].phase('template_fetch'):
+                templates[template_id] = get_template(template_id)
+        except Exception as e:
+            print(f"Error fetching template {template_id}: {str(e)}")
+
+    def run(index):
+        template_id = template_ids[index]
+        template = templates.get(template_id)
+        meter = meters[template_id]
+        if template is None:
+            return {'template_id': template_id, 'error': 'Failed to fetch template'}
+        template_started = time.time()
+        try:
+            visit_summary, cached, key = generate_cached(
+                user_id, template, transcript, patient_name,
+                sectioned=body['sections'], force=body['force'], live=live, meter=meter
             )
+        except Exception as e:
+            print(f"Fan-out template {template_id} failed: {str(e)}")
+            return {'template_id': template_id, 'error': 'Failed to generate note via AI'}
+
+        # Distinct sort keys: the notes are saved in the same instant
+        timestamp, persistence = persist_note(
+            user_id, user_email, dict(body, template_id=template_id), template, visit_summary, meter, cached,
+            key=key, timestamp=(started + timedelta(microseconds=index)).isoformat()
+        )
+        result = note_result(user_id, template, visit_summary, timestamp, persistence)
+        result.update(template_id=template_id, cached=cached,
+                      latency_ms=int((time.time() - template_started) * 1000))
+        return result
+
+    with ThreadPoolExecutor(max_workers=len(template_ids)) as pool:
+        notes = list(pool.map(run, range(len(template_ids))))
+
+    wall_ms = int((datetime.utcnow() - started).total_seconds() * 1000)
+    print(json.dumps({'event': 'template_fanout', 'templates': len(template_ids), 'wall_ms': wall_ms,
+                      'sum_ms': sum(n.get('latency_ms', 0) for n in notes),
+                      'failed': sum(1 for n in notes if 'error' in n)}))
 
-            response_body = json.loads(response['body'].read())
+    if all('error' in note for note in notes):
+        abandon_flight(flight)
+        return format_error(500, "Failed to generate note via AI", method='POST')
 
-            # Handle response format
-            if 'content' in response_body:
-                visit_summary = response_body['content'][0]['text']
-            else:
-                visit_summary = response_body.get('completion', '')
+    result = {'notes': notes}
+    response = format_response(200, result, method='POST', event=event)
+    complete_flight(flight, result)
+    return response
+
+
+# ========================================
+# Section regeneration
+# ========================================
+
+def regenerate_section(event):
+    """
+    POST /generate-note/section {section, new_information, soap_note | note_id,
+    template_id?, patient_name?}
+
+    Rewrites one section of an existing note to include new information and
+    splices it back, so output tokens (and latency) scale with the section, not
+    the note. With note_id the saved note is updated as a new version.
+    """
+    try:
+        body = parse_body(event)
+    except json.JSONDecodeError:
+        return format_error(400, "Invalid JSON in request body", method='POST')
+
+    is_valid, error_msg = validate_input(body, ['section', 'new_information'])
+    if not is_valid:
+        return format_error(400, error_msg, method='POST')
+    if not str(body['new_information']).strip():
+        return format_error(400, "new_information is empty", method='POST')
+
+    user_id, _ = get_request_user(event)
+    note = None
+    if body.get('note_id'):
+        owner, _, timestamp = str(body['note_id']).partition('#')
+        if owner != user_id or not timestamp:
+            return format_error(404, "Note not found", method='POST')
+        try:
+            note = notes_table.get_item(Key={'user_id': user_id, 'timestamp': timestamp}).get('Item')
+            if note:
+                resolve_bodies([note], fields=('soap_note',))
         except Exception as e:
-            return format_error(500, "Failed to generate note via AI", internal_error=e, method='POST')
+            return format_error(500, "Failed to read note", internal_error=e, method='POST')
+        if not note or note.get('archive_ref'):
+            return format_error(404, "Note not found", method='POST')
+        soap_note = note.get('soap_note')
+    else:
+        soap_note = body.get('soap_note')
+    if not soap_note:
+        return format_error(400, "Missing required fields: soap_note or note_id", method='POST')
+
+    blocks = split_note(soap_note)
+    headers = [header for header, _ in blocks if header]
+    index = find_section(blocks, body['section'])
+    if index is None:
+        return format_error(400, f"Section not found in note. Sections: {', '.join(headers)}", method='POST')
+
+    header = blocks[index][0]
+    template_id = body.get('template_id') or (note or {}).get('template_id') or 'default_soap'
+    patient_name = body.get('patient_name') or (note or {}).get('patient_name') or 'UNKNOWN'
+    new_information = str(body['new_information']).strip()
+
+    try:
+        template = get_template(template_id)
+        base = build_prompt(template, '', patient_name)
+        max_tokens = edit_budget(estimate_tokens(blocks[index][1]), estimate_tokens(new_information),
+                                 DEFAULT_MAX_TOKENS)
+        prompt = build_section_edit_prompt(base, header, headers, soap_note, new_information,
+                                           patient_name, max_tokens)
+        started = time.time()
+        text, usage = invoke_model(prompt)
+    except Exception as e:
+        return format_error(500, "Failed to regenerate section via AI", internal_error=e, method='POST')
 
-        # Sanitize Markdown to ensure plain text output
-        txt = visit_summary or ""
-        # Remove fenced code blocks (``` or ~~~)
-        txt = re.sub(r"```(?:\\w+)?\n?([\s\S]*?)\n?```", r"\\1", txt)
-        txt = re.sub(r"~~~(?:\\w+)?\n?([\s\S]*?)\n?~~~", r"\\1", txt)
-        # Inline code backticks
-        txt = re.sub(r"`([^`]+)`", r"\\1", txt)
-        # Headers and blockquotes
-        txt = re.sub(r"^[ \t]{0,3}#{1,6}[ \t]*", "", txt, flags=re.MULTILINE)
-        txt = re.sub(r"^[ \t]*>[ \t]?", "", txt, flags=re.MULTILINE)
-        # Images and links
-        txt = re.sub(r"!\[([^\]]*)\]\([^)]+\)", r"\\1", txt)
-        txt = re.sub(r"\[([^\]]+)\]\([^)]+\)", r"\\1", txt)
-        # Bold/italic emphasis
-        txt = re.sub(r"\*\*([^*]+)\*\*", r"\\1", txt)
-        txt = re.sub(r"__([^_]+)__", r"\\1", txt)
-        txt = re.sub(r"_([^_]+)_", r"\\1", txt)
-        txt = re.sub(r"\*([^*]+)\*", r"\\1", txt)
-        # Normalize bullet markers to '- ' (keep numeric lists as-is)
-        txt = re.sub(r"^[ \t]*[\*\+-][ \t]+", "- ", txt, flags=re.MULTILINE)
-        # Horizontal rules
-        txt = re.sub(r"^[ \t]*([-*_]){3,}[ \t]*$", "", txt, flags=re.MULTILINE)
-        # Remove table border pipes at line start/end
-        txt = re.sub(r"^\|", "", txt, flags=re.MULTILINE)
-        txt = re.sub(r"\|$", "", txt, flags=re.MULTILINE)
-        # Collapse excessive blank lines and trim
-        txt = re.sub(r"\n\s*\n\s*\n+", "\n\n", txt)
-        txt = re.sub(r"[ \t]+$", "", txt, flags=re.MULTILINE)
-        visit_summary = txt.strip()
-
-        # 6. Auto-save to DynamoDB
+    section = sanitize_note(clean_section(text, header, headers))
+    updated = splice_section(blocks, index, section)
+    print(json.dumps({
+        'event': 'section_regeneration', 'section': header, 'max_tokens': max_tokens,
+        'output_tokens': usage.get('output_tokens'), 'note_tokens': estimate_tokens(soap_note),
+        'latency_ms': int((time.time() - started) * 1000)
+    }))
+
+    result = {'note': updated, 'section': header, 'section_text': section, 'saved': False}
+    if note is not None:
         try:
-            timestamp = datetime.utcnow().isoformat()
-            ttl = int((datetime.now() + timedelta(days=365)).timestamp())
+            version = write_version(note, template, updated, edited_at=datetime.utcnow().isoformat(),
+                                    edited_section=header)
+        except Exception as e:
+            return format_error(500, "Failed to save note", internal_error=e, method='POST')
+        if version is None:
+            return format_error(409, "Note changed while the section was regenerated; try again", method='POST')
+        result.update(note_id=f"{user_id}#{note['timestamp']}", version=version, saved=True)
 
-            item = {
-                'user_id': user_id,
-                'timestamp': timestamp,
-                'patient_name': patient_name,
-                'patient_id': body.get('patient_id'),
-                'transcript': transcript,
-                'soap_note': visit_summary,
-                'template_id': template_id,
-                'template_name': template.get('name', 'Unknown'),
-                'provider_email': user_email,
-                'ttl': ttl,
-                'created_at': timestamp
-            }
-
-            notes_table.put_item(Item=item)
+    return format_response(200, result, method='POST', event=event)
+
+
+# ========================================
+# Live drafting (see live_draft.py)
+# ========================================
+
+def live_segment(event, context):
+    """
+    POST /generate-note/live/{session_id}/segments {seq, text, final?}
+
+    Append one transcript segment recorded during the visit. When enough
+    unsummarized text has built up, an async invocation of this function folds
+    it into the session's fact summary; the response doesn't wait for it.
+    """
+    session_id = (event.get('pathParameters') or {}).get('session_id')
+    if not session_id:
+        return format_error(400, "Session ID is required", method='POST')
+
+    try:
+        body = parse_body(event)
+    except json.JSONDecodeError:
+        return format_error(400, "Invalid JSON in request body", method='POST')
+
+    is_valid, error_msg = validate_input(body, ['seq', 'text'])
+    if not is_valid:
+        return format_error(400, error_msg, method='POST')
+    try:
+        seq = int(body['seq'])
+    except (ValueError, TypeError):
+        return format_error(400, "seq must be an integer", method='POST')
+    text = str(body['text'])
+    if seq < 0 or len(text) > MAX_SEGMENT_CHARS:
+        return format_error(400, f"seq must be >= 0 and text at most {MAX_SEGMENT_CHARS} characters",
+                            method='POST')
+
+    user_id, _ = get_request_user(event)
+    try:
+        session, duplicate = append_segment(session_id, user_id, seq, text)
+    except LookupError:
+        return format_error(404, "Live session not found", method='POST')
+    except SegmentOrderError as e:
+        return format_response(409, {'error': str(e), 'expected_seq': e.expected_seq}, method='POST')
+    except Exception as e:
+        return format_error(500, "Failed to store transcript segment", internal_error=e, method='POST')
+
+    # The last segment goes straight into the final note; don't start a fold for it
+    folding = False
+    if not duplicate and not body.get('final') and needs_fold(session) and context is not None:
+        try:
+            lambda_client.invoke(
+                FunctionName=context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps({'live_fold_session_id': session_id, 'user_id': user_id,
+                                    'practice_id': practice_of(event)})
+            )
+            folding = True
         except Exception as e:
-            # We still return the note even if save fails, but log it
-            print(f"Error saving to DynamoDB: {str(e)}")
+            # Not fatal: the next segment tries again, and the tail covers it
+            print(f"Error starting live fold for {session_id}: {str(e)}")
+
+    return format_response(200, {
+        'session_id': session_id,
+        'next_seq': int(session.get('next_seq', 0)),
+        'summarized_through': int(session.get('summarized_through', 0)),
+        'duplicate': duplicate,
+        'folding': folding
+    }, method='POST')
 
-        return format_response(200, {
-            'note': visit_summary,
-            'timestamp': timestamp if 'timestamp' in locals() else None,
-            'note_id': f"{user_id}#{timestamp}" if 'timestamp' in locals() else None,
-            'template_used': template.get('name', 'Unknown'),
-            'saved': 'timestamp' in locals()
-        }, method='POST')
 
+def run_live_fold(event):
+    session_id = event['live_fold_session_id']
+    meter = Meter()
+
+    def prepare(text):
+        return compact(text)[0] if TRANSCRIPT_COMPACTION else text
+
+    def invoke(prompt):
+        return invoke_model({**prompt, 'meter': meter})
+
+    try:
+        folded = fold_summary(session_id, invoke, prepare=prepare)
+        return {'session_id': session_id, 'folded': folded}
     except Exception as e:
-        return format_error(500, "An unexpected error occurred", internal_error=e, method='POST')
+        print(f"Live fold {session_id} failed: {str(e)}")
+        return {'session_id': session_id, 'folded': 0}
+    finally:
+        # The fold's Bedrock usage belongs to the session's owner
+        if meter.calls and event.get('user_id'):
+            record_rollups(meter, event.get('user_id'), event.get('practice_id'), counts_note=False)
+
+
+def load_live(body, user_id, transcript):
+    """(facts, tail) from the request's live session, or None for a normal generation"""
+    session_id = body.get('live_session_id')
+    if not session_id:
+        return None
+    try:
+        return live_source(get_session(session_id, user_id), transcript)
+    except Exception as e:
+        print(f"Error loading live session {session_id}: {str(e)}")
+        return None
+
+
+# ========================================
+# Streaming generation
+# ========================================
+
+def start_stream_job(event, context, body, user_id, user_email):
+    """
+    Create a job item and hand generation to an async invocation of this function.
+    The client polls GET /generate-note/stream/{job_id}?offset=N for new text.
+    An identical request already streaming gets that job id instead of a new job.
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+
+    flight = flight_key(user_id, body, 'stream', body.get('force'))
+    leader, existing = acquire_flight(flight, job_id=job_id)
+    if not leader:
+        if existing.get('job_id'):
+            return format_response(202, {'job_id': existing['job_id'], 'status': 'pending', 'coalesced': True},
+                                   method='POST')
+        # Held without a job to share; starting another would generate twice
+        return format_error(409, "An identical request is already in progress; try again", method='POST')
+
+    try:
+        jobs_table.put_item(Item={
+            'job_id': job_id,
+            'kind': 'stream',
+            'status': 'pending',
+            'user_id': user_id,
+            'text': '',
+            'created_at': now.isoformat(),
+            'ttl': int((now + timedelta(hours=JOB_TTL_HOURS)).timestamp())
+        })
+        lambda_client.invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps({
+                'stream_job_id': job_id,
+                'flight': flight,
+                'body': body,
+                'user_id': user_id,
+                'user_email': user_email,
+                'requested_at': time.time()
+            })
+        )
+    except Exception as e:
+        abandon_flight(flight)
+        return format_error(500, "Failed to start streaming generation", internal_error=e, method='POST')
+
+    return format_response(202, {'job_id': job_id, 'status': 'pending'}, method='POST')
+
+
+def update_job(job_id, **fields):
+    names = {f"#{k}": k for k in fields}
+    values = {f":{k}": v for k, v in fields.items()}
+    jobs_table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET ' + ', '.join(f"#{k} = :{k}" for k in fields),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def run_stream_job(event):
+    """
+    Stream the model output into the job item, then sanitize and save the note.
+    Publishes or releases the request's flight like the blocking path does.
+    """
+    job_id = event['stream_job_id']
+    flight = event.get('flight')
+    body = event['body']
+    user_id = event['user_id']
+    user_email = event['user_email']
+    started = time.time()
+    meter = Meter()
+    # Time spent waiting for the async invocation (on the note, not rolled up)
+    meter.record('queue', (started - event.get('requested_at', started)) * 1000)
+
+    try:
+        with meter.phase('template_fetch'):
+            template = get_template(body.get('template_id', 'default_soap'))
+        transcript = body.get('transcript')
+        patient_name = body.get('patient_name', 'UNKNOWN')
+        first_token_at = None
+        update_job(job_id, status='streaming')
+
+        live = load_live(body, user_id, transcript)
+        key = note_cache_key(user_id, template, transcript, patient_name, body.get('sections'), live=bool(live))
+        with meter.phase('cache_lookup'):
+            visit_summary = None if body.get('force') else get_cached(key)
+        cached = visit_summary is not None
+
+        if cached:
+            first_token_at = time.time()
+        elif body.get('sections'):
+            # Sections are generated concurrently, so there is no single stream to relay
+            with meter.phase('model'):
+                raw = generate_note(template, transcript, patient_name, sectioned=True, live=live, meter=meter)
+            with meter.phase('sanitize'):
+                visit_summary = sanitize_note(raw)
+            first_token_at = time.time()
+        else:
+            model_started = time.time()
+            prompt = prepare_prompt(template, transcript, patient_name, live=live, meter=meter)
+
+            # Sanitize as we go so pollers never see raw Markdown
+            sanitizer = MarkdownSanitizer()
+            parts = []
+            last_flush = 0.0
+
+            usage = {}
+            for delta in stream_model(prompt, usage):
+                parts.append(sanitizer.feed(delta))
+                now = time.time()
+                if first_token_at is None:
+                    first_token_at = now
+                # Push the first token immediately, then at most every STREAM_FLUSH_SECONDS
+                if last_flush == 0.0 or now - last_flush >= STREAM_FLUSH_SECONDS:
+                    update_job(job_id, text=''.join(parts))
+                    last_flush = now
+
+            parts.append(sanitizer.finish())
+            visit_summary = ''.join(parts)
+            # Sanitizing is interleaved with the stream, so it is part of 'model' here
+            meter.record('model', (time.time() - model_started) * 1000)
+            record_output(templates_table, template, prompt['plan'], usage.get('output_tokens'),
+                          truncated=usage.get('stop_reason') == 'max_tokens')
+
+        timestamp, persistence = persist_note(user_id, user_email, body, template, visit_summary, meter,
+                                              cached, key=key)
+
+        ttft_ms = int((first_token_at - started) * 1000) if first_token_at else None
+        total_ms = int((time.time() - started) * 1000)
+        queue_ms = int((started - event.get('requested_at', started)) * 1000)
+        print(f"Stream job {job_id}: queue_ms={queue_ms} ttft_ms={ttft_ms} total_ms={total_ms} "
+              f"chars={len(visit_summary)} cached={cached}")
+
+        result = note_result(user_id, template, visit_summary, timestamp, persistence)
+        result['cached'] = cached
+        update_job(
+            job_id,
+            status='complete',
+            text=visit_summary,
+            result=result,
+            ttft_ms=ttft_ms,
+            total_ms=total_ms
+        )
+        if flight:
+            complete_flight(flight, result, job_id=job_id)
+        return {'job_id': job_id, 'status': 'complete'}
+
+    except Exception as e:
+        print(f"Stream job {job_id} failed: {str(e)}")
+        if flight:
+            abandon_flight(flight)
+        update_job(job_id, status='failed', error='Failed to generate note via AI')
+        return {'job_id': job_id, 'status': 'failed'}
+
+
+def get_stream_job(event, job_id):
+    """Return text produced since ?offset=N, plus the final result once complete"""
+    if not job_id:
+        return format_error(400, "Job ID is required")
+
+    user_id, _ = get_request_user(event)
+    params = event.get('queryStringParameters') or {}
+    try:
+        offset = max(0, int(params.get('offset', 0)))
+    except (ValueError, TypeError):
+        offset = 0
+
+    try:
+        job = jobs_table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item')
+    except Exception as e:
+        return format_error(500, "Failed to read generation job", internal_error=e)
+
+    if not job or job.get('user_id') != user_id:
+        return format_error(404, "Job not found")
+
+    text = job.get('text', '')
+    response = {
+        'job_id': job_id,
+        'status': job.get('status'),
+        'delta': text[offset:],
+        'offset': len(text)
+    }
+    if job.get('status') == 'complete':
+        # Streamed text is already sanitized; the result carries note metadata too
+        response['result'] = job.get('result')
+    elif job.get('status') == 'failed':
+        response['error'] = job.get('error')
+
+    return format_response(200, json.loads(json.dumps(response, default=_decimal_default)), event=event)
+
+
+def _decimal_default(value):
+    if isinstance(value, Decimal):
+        return int(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# ========================================
+# Queued generation (processed by worker.py)
+# ========================================
+
+def enqueue_job(body, user_id, user_email, sectioned, force):
+    """
+    Store the request in a job item and queue the job id for the worker.
+    The client polls GET /jobs/{job_id}, optionally long-polling with ?wait=N.
+    An identical request queued moments ago gets that job id instead of a new job.
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.utcnow()
+
+    flight = flight_key(user_id, body, 'async', force)
+    leader, existing = acquire_flight(flight, job_id=job_id)
+    if not leader:
+        if existing.get('job_id'):
+            return format_response(202, {'job_id': existing['job_id'], 'status': 'queued', 'coalesced': True},
+                                   method='POST')
+        # Held without a job to share; queueing another would generate twice
+        return format_error(409, "An identical request is already in progress; try again", method='POST')
+
+    request = {
+        'user_id': user_id,
+        'timestamp': f"jobs/{job_id}",
+        'transcript': body.get('transcript'),
+        'patient_name': body.get('patient_name', 'UNKNOWN'),
+        'patient_id': body.get('patient_id'),
+        'template_id': body.get('template_id', 'default_soap'),
+        'practice_id': body.get('practice_id')
+    }
+
+    try:
+        # Keep the job item under the 400 KB limit - big transcripts go to S3
+        offload_bodies(request)
+        jobs_table.put_item(Item={
+            'job_id': job_id,
+            'kind': 'async',
+            'status': 'queued',
+            'user_id': user_id,
+            'user_email': user_email,
+            'request': request,
+            'sections': sectioned,
+            'force': force,
+            'attempts': 0,
+            'created_at': now.isoformat(),
+            'ttl': int((now + timedelta(hours=JOB_TTL_HOURS)).timestamp())
+        })
+        sqs.send_message(
+            QueueUrl=GENERATION_QUEUE_URL,
+            MessageBody=json.dumps({'job_id': job_id, 'requested_at': time.time()})
+        )
+    except Exception as e:
+        abandon_flight(flight)
+        return format_error(500, "Failed to queue note generation", internal_error=e, method='POST')
+
+    return format_response(202, {'job_id': job_id, 'status': 'queued'}, method='POST')
+
+
+def get_job(event, job_id):
+    """Job status, plus the result once complete. ?wait=N blocks until it finishes or N seconds pass."""
+    if not job_id:
+        return format_error(400, "Job ID is required")
+
+    user_id, _ = get_request_user(event)
+    params = event.get('queryStringParameters') or {}
+    try:
+        wait = min(max(0.0, float(params.get('wait', 0))), JOB_LONG_POLL_SECONDS)
+    except (ValueError, TypeError):
+        wait = 0.0
+    deadline = time.time() + wait
+
+    while True:
+        try:
+            job = jobs_table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item')
+        except Exception as e:
+            return format_error(500, "Failed to read generation job", internal_error=e)
+
+        if not job or job.get('user_id') != user_id:
+            return format_error(404, "Job not found")
+
+        if job.get('status') in ('complete', 'failed') or time.time() + JOB_POLL_INTERVAL_SECONDS > deadline:
+            break
+        time.sleep(JOB_POLL_INTERVAL_SECONDS)
+
+    response = {
+        'job_id': job_id,
+        'status': job.get('status'),
+        'attempts': job.get('attempts', 0)
+    }
+    if job.get('status') == 'complete':
+        response['result'] = job.get('result')
+    elif job.get('status') == 'failed':
+        response['error'] = job.get('error')
+
+    return format_response(200, json.loads(json.dumps(response, default=_decimal_default)), event=event)
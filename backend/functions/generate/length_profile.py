@@ -0,0 +1,177 @@
+# functions/generate/length_profile.py
+"""
+Output-length planning for note generation.
+
+Each template has a learned length profile (EWMA of output tokens, their
+variance and the transcript size they came from), stored in TemplatesTable
+under a reserved "__profile__#<template fingerprint>" id - editing a template
+starts a fresh profile. Until a profile has enough samples, a prior based on
+the size of the template's example output is used.
+
+max_tokens is the predicted length plus headroom, so short notes are not given
+(and billed against) a 2000-token ceiling, and long notes get enough room.
+
+Samples are folded into the container's copy of the profile and written back
+in batches - after PROFILE_FLUSH_SAMPLES samples or PROFILE_FLUSH_SECONDS -
+on a background thread, never on the response path. A container that is
+recycled loses at most a batch, which a running statistic can afford.
+"""
+import hashlib
+import json
+import math
+import threading
+import time
+from datetime import datetime
+
+from long_transcript import estimate_tokens
+
+PROFILE_PREFIX = '__profile__#'
+
+MIN_OUTPUT_TOKENS = 400
+MAX_OUTPUT_TOKENS = 4000
+HEADROOM = 1.25
+PROFILE_MIN_SAMPLES = 3
+EWMA_ALPHA = 0.2
+
+# Filled-in notes run a few times longer than the bracketed example
+PRIOR_EXPANSION = 4.0
+PRIOR_TRANSCRIPT_TOKENS = 1500
+# Below this, transcript size doesn't noticeably change note length
+MIN_SCALING_INPUT_TOKENS = 500
+
+# The prompt asks the model to end with this line; it doubles as a stop sequence
+END_SENTINEL = 'END OF NOTE'
+
+# Profiles with no unflushed samples are re-read after this
+PROFILE_CACHE_SECONDS = 300
+PROFILE_FLUSH_SAMPLES = 20
+PROFILE_FLUSH_SECONDS = 300
+# key -> (profile, loaded_at); key -> unflushed sample count
+_profiles = {}
+_pending = {}
+_last_flush = time.time()
+_lock = threading.Lock()
+_flushing = threading.Lock()
+
+
+def profile_id(template):
+    digest = hashlib.sha256(
+        json.dumps([template.get('name', ''), template.get('example_output', '')]).encode('utf-8')
+    ).hexdigest()
+    return PROFILE_PREFIX + digest[:32]
+
+
+def load_profile(table, template):
+    """Profile item for a template (cached briefly per container), or None"""
+    key = profile_id(template)
+    with _lock:
+        cached = _profiles.get(key)
+        # Unflushed samples make the local copy the newer one
+        if cached and (_pending.get(key) or time.time() - cached[1] < PROFILE_CACHE_SECONDS):
+            return cached[0]
+
+    try:
+        profile = table.get_item(Key={'template_id': key}).get('Item')
+    except Exception as e:
+        print(f"Error reading length profile: {str(e)}")
+        profile = None
+
+    with _lock:
+        if not _pending.get(key):
+            _profiles[key] = (profile, time.time())
+        return _profiles.get(key, (profile,))[0]
+
+
+def predict_output_tokens(template, transcript_tokens, profile):
+    """Expected output tokens for this template and transcript size"""
+    if profile and int(profile.get('samples', 0)) >= PROFILE_MIN_SAMPLES:
+        mean = float(profile['mean_output'])
+        spread = math.sqrt(max(float(profile.get('var_output', 0)), 0.0))
+        typical_input = max(float(profile.get('mean_input', 0)), MIN_SCALING_INPUT_TOKENS)
+        expected = mean + 2 * spread
+    else:
+        expected = estimate_tokens(template.get('example_output', '')) * PRIOR_EXPANSION + 200
+        typical_input = PRIOR_TRANSCRIPT_TOKENS
+
+    # Notes grow sub-linearly with transcript length
+    if transcript_tokens > typical_input:
+        expected *= math.sqrt(transcript_tokens / typical_input)
+    return int(expected)
+
+
+def plan_output(table, template, transcript):
+    """Returns {'max_tokens', 'predicted_tokens', 'transcript_tokens'} for one request"""
+    transcript_tokens = estimate_tokens(transcript)
+    predicted = predict_output_tokens(template, transcript_tokens, load_profile(table, template))
+    max_tokens = min(MAX_OUTPUT_TOKENS, max(MIN_OUTPUT_TOKENS, int(predicted * HEADROOM)))
+    return {'max_tokens': max_tokens, 'predicted_tokens': predicted, 'transcript_tokens': transcript_tokens}
+
+
+def record_output(table, template, plan, output_tokens, truncated=False):
+    """Log predicted vs actual for calibration and fold the sample into the profile"""
+    print(f"Output length: template={template.get('name')} predicted={plan['predicted_tokens']} "
+          f"max_tokens={plan['max_tokens']} actual={output_tokens} truncated={truncated} "
+          f"transcript_tokens={plan['transcript_tokens']}")
+    if not output_tokens:
+        return
+
+    key = profile_id(template)
+    load_profile(table, template)
+    with _lock:
+        profile = _profiles.get(key, (None,))[0] or {}
+        _profiles[key] = (fold_sample(key, template, profile, output_tokens, plan['transcript_tokens']),
+                          time.time())
+        _pending[key] = _pending.get(key, 0) + 1
+        due = sum(_pending.values()) >= PROFILE_FLUSH_SAMPLES or \
+            time.time() - _last_flush >= PROFILE_FLUSH_SECONDS
+
+    if due and _flushing.acquire(blocking=False):
+        threading.Thread(target=flush_profiles, args=(table,), daemon=True).start()
+
+
+def fold_sample(key, template, profile, output_tokens, transcript_tokens):
+    """Profile with one more sample"""
+    samples = int(profile.get('samples', 0))
+
+    if samples == 0:
+        mean, var, mean_input = float(output_tokens), 0.0, float(transcript_tokens)
+    else:
+        # Exponentially weighted mean/variance; recent notes matter more
+        old_mean = float(profile['mean_output'])
+        diff = output_tokens - old_mean
+        mean = old_mean + EWMA_ALPHA * diff
+        var = (1 - EWMA_ALPHA) * (float(profile.get('var_output', 0)) + EWMA_ALPHA * diff * diff)
+        mean_input = float(profile.get('mean_input', 0)) + EWMA_ALPHA * (
+            transcript_tokens - float(profile.get('mean_input', 0)))
+
+    return {
+        'template_id': key,
+        'template_name': template.get('name', ''),
+        'samples': samples + 1,
+        'mean_output': int(round(mean)),
+        'var_output': int(round(var)),
+        'mean_input': int(round(mean_input)),
+        'updated_at': datetime.utcnow().isoformat()
+    }
+
+
+def flush_profiles(table):
+    """Write the profiles with unflushed samples (runs on its own thread, holding _flushing)"""
+    global _last_flush
+    try:
+        with _lock:
+            batch = [_profiles[key][0] for key in _pending if key in _profiles]
+            _pending.clear()
+            _last_flush = time.time()
+        if not batch:
+            return
+
+        # Last writer wins - fine for a running statistic
+        with table.batch_writer() as writer:
+            for profile in batch:
+                writer.put_item(Item=profile)
+        print(f"Saved {len(batch)} length profile(s)")
+    except Exception as e:
+        print(f"Error saving length profiles: {str(e)}")
+    finally:
+        _flushing.release()
@@ -0,0 +1,217 @@
+# functions/generate/live_draft.py
+"""
+Live drafting while the visit is still being recorded.
+
+The web app transcribes the visit in ~30 s segments as it records and posts
+each one to POST /generate-note/live/{session_id}/segments. Segments are
+appended, in order, to a live session item in the jobs table. Once
+LIVE_FOLD_TOKENS of them are not yet summarized, an async invocation folds
+them into the session's running fact summary (the same extraction the
+long-transcript map step does, one part at a time).
+
+When recording stops, /generate-note is called with live_session_id: the
+final note is written from the fact summary plus only the segments that came
+after the last fold (the tail), so the work left after "stop" is one short
+segment transcription and one small generation call.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+from long_transcript import EXTRACT_MAX_TOKENS, EXTRACT_SYSTEM_PROMPT, estimate_tokens
+from table_pool import PooledTable
+
+# Summarize once this much unsummarized transcript has built up (~2-3 minutes of talk)
+LIVE_FOLD_TOKENS = int(os.environ.get('LIVE_FOLD_TOKENS', '600'))
+# Another fold may take over a claim older than this (the folding invocation died)
+FOLD_LEASE_SECONDS = 120
+SESSION_TTL_HOURS = 24
+MAX_SEGMENT_CHARS = 20000
+
+LIVE_SOURCE_LABEL = 'CLINICAL FACTS (extracted during the visit), then the END OF THE TRANSCRIPT they do not cover'
+TAIL_LABEL = 'END OF THE TRANSCRIPT (after the facts above)'
+
+sessions_table = PooledTable(os.environ.get('JOBS_TABLE', 'DentalScribeGenerationJobs-prod'))
+
+
+class SegmentOrderError(Exception):
+    """A segment arrived out of order; expected_seq is the one the session wants next"""
+
+    def __init__(self, expected_seq):
+        super().__init__(f"Expected segment {expected_seq}")
+        self.expected_seq = expected_seq
+
+
+def _is_conditional_failure(error):
+    return isinstance(error, ClientError) and \
+        error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+def get_session(session_id, user_id):
+    """The caller's live session, or None"""
+    session = sessions_table.get_item(Key={'job_id': session_id}, ConsistentRead=True).get('Item')
+    if not session or session.get('kind') != 'live' or session.get('user_id') != user_id:
+        return None
+    return session
+
+
+def append_segment(session_id, user_id, seq, text):
+    """
+    Append segment `seq` (0-based, in order). The first segment creates the
+    session. Returns (session, duplicate); a segment sent twice (client retry)
+    is a no-op. Raises SegmentOrderError for a gap, LookupError for a session
+    that belongs to someone else.
+    """
+    now = datetime.utcnow()
+    if seq == 0:
+        condition = 'attribute_not_exists(job_id)'
+        update = ('SET #segments = :segment, #next_seq = :next, #user_id = :user_id, #kind = :kind, '
+                  '#summary = :blank, #summarized_through = :zero, #parts = :zero, #created_at = :now, '
+                  '#ttl = :ttl, #updated_at = :now')
+        values = {':kind': 'live', ':blank': '', ':zero': 0,
+                  ':ttl': int((now + timedelta(hours=SESSION_TTL_HOURS)).timestamp())}
+    else:
+        condition = '#user_id = :user_id AND #next_seq = :seq'
+        update = 'SET #segments = list_append(#segments, :segment), #next_seq = :next, #updated_at = :now'
+        values = {':seq': seq}
+    values.update({':segment': [text], ':next': seq + 1, ':user_id': user_id, ':now': now.isoformat()})
+    # SEGMENTS, TTL and friends are DynamoDB reserved words
+    names = {f"#{name}": name for name in ('segments', 'next_seq', 'user_id', 'kind', 'summary',
+                                           'summarized_through', 'parts', 'created_at', 'ttl', 'updated_at')
+             if f"#{name}" in update or f"#{name}" in condition}
+
+    try:
+        response = sessions_table.update_item(
+            Key={'job_id': session_id},
+            UpdateExpression=update,
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )
+        return response['Attributes'], False
+    except ClientError as e:
+        if not _is_conditional_failure(e):
+            raise
+
+    session = sessions_table.get_item(Key={'job_id': session_id}, ConsistentRead=True).get('Item')
+    if not session or session.get('kind') != 'live' or session.get('user_id') != user_id:
+        raise LookupError("Live session not found")
+    if seq < int(session.get('next_seq', 0)):
+        return session, True
+    raise SegmentOrderError(int(session.get('next_seq', 0)))
+
+
+def unsummarized(session):
+    """Segments not yet folded into the summary, joined"""
+    segments = session.get('segments', [])
+    return '\n'.join(segments[int(session.get('summarized_through', 0)):])
+
+
+def needs_fold(session):
+    return estimate_tokens(unsummarized(session)) >= LIVE_FOLD_TOKENS
+
+
+def build_fold_prompt(text, part):
+    """Extraction prompt for one stretch of a visit in progress (shares the map step's cached system prompt)"""
+    return {
+        'system': EXTRACT_SYSTEM_PROMPT,
+        'user': f"TRANSCRIPT PART {part} (the visit is still in progress):\n{text}",
+        'max_tokens': EXTRACT_MAX_TOKENS
+    }
+
+
+def claim_fold(session_id):
+    """Take the fold lease; False if another fold holds it"""
+    now = time.time()
+    try:
+        sessions_table.update_item(
+            Key={'job_id': session_id},
+            UpdateExpression='SET fold_lease = :until',
+            ConditionExpression='attribute_exists(job_id) AND (attribute_not_exists(fold_lease) OR fold_lease < :now)',
+            ExpressionAttributeValues={':until': int(now + FOLD_LEASE_SECONDS), ':now': int(now)}
+        )
+        return True
+    except ClientError as e:
+        if _is_conditional_failure(e):
+            return False
+        raise
+
+
+def release_fold(session_id):
+    try:
+        sessions_table.update_item(Key={'job_id': session_id}, UpdateExpression='REMOVE fold_lease')
+    except Exception as e:
+        print(f"Error releasing fold lease: {str(e)}")
+
+
+def fold_summary(session_id, invoke, prepare=None):
+    """
+    Summarize the unsummarized segments into the session's facts. `invoke(prompt)`
+    returns (text, usage); `prepare(text)` (e.g. compaction) runs first.
+    Returns the number of segments folded (0 if there was nothing to do).
+    """
+    if not claim_fold(session_id):
+        return 0
+    folded = False
+    try:
+        session = sessions_table.get_item(Key={'job_id': session_id}, ConsistentRead=True).get('Item')
+        if not session or not needs_fold(session):
+            return 0
+
+        start = int(session.get('summarized_through', 0))
+        end = len(session.get('segments', []))
+        text = unsummarized(session)
+        if prepare:
+            text = prepare(text)
+        part = int(session.get('parts', 0)) + 1
+
+        started = time.time()
+        facts, _ = invoke(build_fold_prompt(text, part))
+        facts = facts.strip()
+        summary = session.get('summary', '')
+        if facts and facts.upper() != 'NONE':
+            summary = f"{summary}\n\nPart {part}:\n{facts}".strip()
+
+        sessions_table.update_item(
+            Key={'job_id': session_id},
+            UpdateExpression='SET #summary = :summary, #summarized_through = :end, #parts = :part '
+                             'REMOVE fold_lease',
+            ConditionExpression='#summarized_through = :start',
+            ExpressionAttributeNames={'#summary': 'summary', '#summarized_through': 'summarized_through',
+                                      '#parts': 'parts'},
+            ExpressionAttributeValues={':summary': summary, ':end': end, ':part': part, ':start': start}
+        )
+        folded = True
+        print(f"Live session {session_id}: folded segments {start}-{end - 1} into part {part} "
+              f"in {int((time.time() - started) * 1000)} ms, summary_tokens={estimate_tokens(summary)}")
+        return end - start
+    finally:
+        if not folded:
+            release_fold(session_id)
+
+
+def _normalize(text):
+    return ' '.join((text or '').split())
+
+
+def live_source(session, transcript):
+    """
+    (facts, tail) for the final note, or None to use the full transcript: no
+    facts yet, or the transcript isn't exactly the session's segments (a
+    segment never arrived).
+    """
+    if not session or not session.get('summary'):
+        return None
+    segments = session.get('segments', [])
+    if _normalize(' '.join(segments)) != _normalize(transcript):
+        print(f"Live session {session.get('job_id')}: transcript does not match its segments, "
+              f"using the full transcript")
+        return None
+    return session['summary'], unsummarized(session)
+
+
+def build_live_source(facts, tail):
+    """Text for build_prompt's transcript slot"""
+    return f"{facts}\n\n{TAIL_LABEL}:\n{tail or '(none)'}"
@@ -0,0 +1,157 @@
+# functions/generate/long_transcript.py
+"""
+Map-reduce generation for long visit transcripts.
+
+Transcripts over LONG_TRANSCRIPT_TOKENS (local estimate, no tokenizer call) are
+split on speaker turns / blank-line topic breaks into balanced chunks. Clinical
+facts are extracted from every chunk concurrently (map), and the extracted
+facts - not the raw transcript - are what the final template-filling call sees
+(reduce). Wall time is roughly the slowest chunk plus one reduce call.
+"""
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+LONG_TRANSCRIPT_TOKENS = int(os.environ.get('LONG_TRANSCRIPT_TOKENS', '12000'))
+CHUNK_TOKENS = int(os.environ.get('LONG_TRANSCRIPT_CHUNK_TOKENS', '4000'))
+MAP_WORKERS = int(os.environ.get('LONG_TRANSCRIPT_WORKERS', '8'))
+
+EXTRACT_MAX_TOKENS = 1200
+REDUCE_SOURCE_LABEL = 'CLINICAL FACTS (extracted in order from a long visit transcript)'
+
+# "Dr. Lee: ...", "PATIENT: ...", "[00:12:31] Hygienist: ..."
+SPEAKER_RE = re.compile(r"^\s*(?:\[[^\]]{1,20}\]\s*)?[A-Za-z][\w .'-]{0,30}:\s")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+WORD_RE = re.compile(r"\S+")
+
+EXTRACT_SYSTEM_PROMPT = """You are an expert Dental Scribe AI.
+
+You will receive one part of a longer dental visit transcript. Extract every clinically relevant fact from this part as concise plain-text "- " bullets, in the order they occur.
+
+Include: patient-reported symptoms and concerns, history, exam findings, tooth numbers and surfaces, probing depths and other measurements, radiographic findings, diagnoses, procedures performed, materials and anesthetic used, medications, patient instructions, and follow-up plans.
+
+Rules:
+- Only state facts present in this part; do not infer or summarize beyond it
+- Keep numbers, tooth numbers and drug names exactly as spoken
+- No headers, no Markdown, no commentary
+- If this part contains nothing clinically relevant, reply with NONE
+"""
+
+
+def _estimate(text):
+    return max(len(text) / 4, len(WORD_RE.findall(text)) * 1.3)
+
+
+def estimate_tokens(text):
+    """Cheap local token estimate: ~4 characters per token, at least ~1.3 per word"""
+    return math.ceil(_estimate(text)) if text else 0
+
+
+def is_long_transcript(transcript):
+    return estimate_tokens(transcript) > LONG_TRANSCRIPT_TOKENS
+
+
+def split_turns(transcript):
+    """Split into speaker turns; blank lines also end a turn (topic breaks)"""
+    turns = []
+    current = []
+    for line in transcript.splitlines():
+        blank = not line.strip()
+        if current and (blank or SPEAKER_RE.match(line)):
+            turns.append('\n'.join(current))
+            current = []
+        if not blank:
+            current.append(line)
+    if current:
+        turns.append('\n'.join(current))
+    return turns
+
+
+def split_oversized(turn, max_tokens):
+    """Break a single over-long turn (or an unpunctuated blob) on sentence boundaries"""
+    pieces = []
+    current = []
+    size = 0
+    for sentence in SENTENCE_RE.split(turn):
+        tokens = _estimate(sentence)
+        if current and size + tokens > max_tokens:
+            pieces.append(' '.join(current))
+            current = []
+            size = 0
+        current.append(sentence)
+        size += tokens
+    if current:
+        pieces.append(' '.join(current))
+    return pieces
+
+
+def split_transcript(transcript, max_tokens=CHUNK_TOKENS):
+    """
+    Pack turns into chunks of roughly equal size, none over max_tokens (unless a
+    single sentence is). Balanced chunks keep the slowest map call short.
+    """
+    units = []
+    for turn in split_turns(transcript):
+        tokens = _estimate(turn)
+        if tokens > max_tokens:
+            units.extend((piece, _estimate(piece)) for piece in split_oversized(turn, max_tokens))
+        else:
+            units.append((turn, tokens))
+
+    total = sum(tokens for _, tokens in units)
+    if not units:
+        return []
+    target = math.ceil(total / math.ceil(total / max_tokens)) if total else max_tokens
+
+    chunks = []
+    current = []
+    size = 0
+    for text, tokens in units:
+        if current and size + tokens > target:
+            chunks.append('\n'.join(current))
+            current = []
+            size = 0
+        current.append(text)
+        size += tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+def build_extract_prompt(chunk, index, total):
+    """Map prompt; the system part is shared by every chunk so it caches"""
+    return {
+        'system': EXTRACT_SYSTEM_PROMPT,
+        'user': f"TRANSCRIPT PART {index} OF {total}:\n{chunk}",
+        'max_tokens': EXTRACT_MAX_TOKENS
+    }
+
+
+def extract_facts(transcript, invoke):
+    """
+    Map step: extract facts from every chunk concurrently.
+    `invoke(prompt)` returns (text, usage). Returns the facts in transcript order.
+    """
+    chunks = split_transcript(transcript)
+    started = time.time()
+
+    def run(indexed):
+        index, chunk = indexed
+        chunk_started = time.time()
+        text, _ = invoke(build_extract_prompt(chunk, index + 1, len(chunks)))
+        return text.strip(), int((time.time() - chunk_started) * 1000)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAP_WORKERS, len(chunks)))) as pool:
+        results = list(pool.map(run, enumerate(chunks)))
+
+    chunk_ms = [ms for _, ms in results]
+    print(f"Long transcript map: chunks={len(chunks)} est_tokens={estimate_tokens(transcript)} "
+          f"slowest_chunk_ms={max(chunk_ms, default=0)} map_ms={int((time.time() - started) * 1000)}")
+
+    parts = []
+    for index, (facts, _) in enumerate(results):
+        if facts and facts.upper() != 'NONE':
+            parts.append(f"Part {index + 1}:\n{facts}")
+    return '\n\n'.join(parts)
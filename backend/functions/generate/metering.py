@@ -0,0 +1,262 @@
+# functions/generate/metering.py
+"""
+Token usage and latency metering per note, with daily rollups.
+
+A Meter follows one note through generation: every Bedrock call adds its
+token usage (input, output, prompt-cache read/write) and model id, and the
+handler times each phase (template_fetch, cache_lookup, model, sanitize).
+The note item stores meter.to_item(). The rollups are written while the note
+write is in flight, so save time is not part of them - it is logged on the
+'note_write' line (see note_outbox.py).
+
+Rollups: one item per (scope, day) in the usage table - scope is
+"user#<id>", "practice#<id>" or "model#<id>" - kept with atomic ADD
+counters, so concurrent notes never lose an update. Notes slower than
+SLOW_NOTE_MS are counted separately to make outliers easy to spot.
+
+GET /admin/usage?scope=user|practice|model&id=...&from=YYYY-MM-DD&to=YYYY-MM-DD
+returns the daily rows (all ids of the scope when id is omitted).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from boto3.dynamodb.conditions import Key
+from security import format_response, format_error, require_admin, ValidationError
+from table_pool import PooledTable
+
+USAGE_TABLE = os.environ.get('USAGE_TABLE', 'DentalScribeUsage-prod')
+SLOW_NOTE_MS = int(os.environ.get('SLOW_NOTE_MS', '30000'))
+# Bound on how long a response waits for the rollup writes
+ROLLUP_FLUSH_SECONDS = 0.5
+DEFAULT_PRACTICE_ID = 'default'
+
+TOKEN_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+PHASES = ('template_fetch', 'cache_lookup', 'model', 'sanitize')
+SCOPES = ('user', 'practice', 'model')
+DEFAULT_REPORT_DAYS = 7
+MAX_REPORT_DAYS = 92
+# Without an id every day is its own query
+MAX_REPORT_DAYS_ALL_IDS = 31
+
+usage_table = PooledTable(USAGE_TABLE)
+
+
+def practice_of(event):
+    """Practice from the Cognito claims (custom:practice_id), else the single default practice"""
+    authorizer = (event.get('requestContext') or {}).get('authorizer') or {}
+    claims = authorizer.get('claims') or (authorizer.get('jwt') or {}).get('claims') or {}
+    return claims.get('custom:practice_id') or DEFAULT_PRACTICE_ID
+
+
+class Meter:
+    """Usage and phase timings for one note; safe to share with section / map threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.usage = {field: 0 for field in TOKEN_FIELDS}
+        self.calls = 0
+        self.bedrock_ms = 0
+        self.model_ids = []
+        self.phases = {}
+
+    def add_call(self, model_id, usage, latency_ms):
+        """One Bedrock call (each continuation, section, map chunk counts)"""
+        with self.lock:
+            self.calls += 1
+            self.bedrock_ms += int(latency_ms or 0)
+            for field in TOKEN_FIELDS:
+                self.usage[field] += int((usage or {}).get(field, 0) or 0)
+            if model_id and model_id not in self.model_ids:
+                self.model_ids.append(model_id)
+
+    def record(self, phase, ms):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + int(ms)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, (time.time() - started) * 1000)
+
+    def total_ms(self):
+        return int((time.time() - self.started) * 1000)
+
+    def to_item(self):
+        """Stored on the note item (ints only, DynamoDB-safe)"""
+        with self.lock:
+            return {
+                # The model that wrote the note (fallbacks and continuations come last)
+                'model_id': self.model_ids[-1] if self.model_ids else None,
+                'model_ids': list(self.model_ids),
+                'bedrock_calls': self.calls,
+                'bedrock_ms': self.bedrock_ms,
+                **self.usage,
+                'latency_ms': dict(self.phases, total=self.total_ms())
+            }
+
+
+def rollup_update(meter, cached, total_ms, counts_note=True):
+    """ADD expression for one note (or, with counts_note=False, usage that produced no note)"""
+    note = 1 if counts_note else 0
+    values = {':one': note, ':cached': note if cached else 0, ':slow': note if total_ms >= SLOW_NOTE_MS else 0,
+              ':calls': meter.calls, ':bedrock_ms': meter.bedrock_ms, ':total_ms': total_ms}
+    counters = ['notes :one', 'cached_notes :cached', 'slow_notes :slow', 'bedrock_calls :calls',
+                'bedrock_ms :bedrock_ms', 'total_ms :total_ms']
+    for field in TOKEN_FIELDS:
+        values[f":{field}"] = meter.usage[field]
+        counters.append(f"{field} :{field}")
+    for phase in PHASES:
+        values[f":{phase}_ms"] = meter.phases.get(phase, 0)
+        counters.append(f"{phase}_ms :{phase}_ms")
+    return 'ADD ' + ', '.join(counters), values
+
+
+class Rollups:
+    """
+    The note's user, practice and model rollup updates (atomic ADDs), running
+    in parallel in the background; start them before the note write is
+    awaited so the two overlap. counts_note=False adds the usage without
+    counting a note (e.g. a live-draft summary fold). Never raises.
+    """
+
+    def __init__(self, meter, user_id, practice_id, cached=False, counts_note=True):
+        item = meter.to_item()
+        total_ms = item['latency_ms']['total']
+        self.day = datetime.utcnow().date().isoformat()
+        print(json.dumps({'event': 'note_metering', 'user_id': user_id, 'practice_id': practice_id,
+                          'cached': cached, 'slow': total_ms >= SLOW_NOTE_MS, **item}))
+
+        self.update, self.values = rollup_update(meter, cached, total_ms, counts_note)
+        scopes = [f"user#{user_id}", f"practice#{practice_id or DEFAULT_PRACTICE_ID}"]
+        # A cache hit made no Bedrock call, so it has no model to attribute
+        if item['model_id']:
+            scopes.append(f"model#{item['model_id']}")
+
+        self.started = time.time()
+        self.threads = [threading.Thread(target=self._add, args=(scope,), daemon=True) for scope in scopes]
+        for thread in self.threads:
+            thread.start()
+
+    def _add(self, scope):
+        try:
+            usage_table.update_item(
+                Key={'scope': scope, 'day': self.day},
+                UpdateExpression=self.update + ' SET updated_at = :now',
+                ExpressionAttributeValues=dict(self.values, **{':now': datetime.utcnow().isoformat()})
+            )
+        except Exception as e:
+            print(f"Error updating usage rollup {scope}: {str(e)}")
+
+    def wait(self):
+        """Waits at most ROLLUP_FLUSH_SECONDS from the start"""
+        deadline = self.started + ROLLUP_FLUSH_SECONDS
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.time()))
+
+
+def record_rollups(meter, user_id, practice_id, cached=False, counts_note=True):
+    """Add the note to today's rollups and log it, waiting for the writes"""
+    Rollups(meter, user_id, practice_id, cached, counts_note).wait()
+
+
+# ========================================
+# GET /admin/usage
+# ========================================
+
+def _days(start, end):
+    day = start
+    while day <= end:
+        yield day.isoformat()
+        day += timedelta(days=1)
+
+
+def report_row(item):
+    """Rollup item -> response row with averages"""
+    row = {k: (int(v) if hasattr(v, 'to_integral_value') else v) for k, v in item.items()}
+    scope, _, scope_id = row.pop('scope', '').partition('#')
+    row.update(scope=scope, id=scope_id)
+    notes = row.get('notes', 0)
+    generated = notes - row.get('cached_notes', 0)
+    if notes:
+        row['avg_total_ms'] = int(row.get('total_ms', 0) / notes)
+    if generated:
+        row['avg_model_ms'] = int(row.get('model_ms', 0) / generated)
+        row['avg_output_tokens'] = int(row.get('output_tokens', 0) / generated)
+    return row
+
+
+def query_all(**kwargs):
+    items = []
+    while True:
+        response = usage_table.query(**kwargs)
+        items.extend(response.get('Items', []))
+        if not response.get('LastEvaluatedKey'):
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def lambda_handler(event, context):
+    if event.get('httpMethod') == 'OPTIONS':
+        return format_response(200, {})
+
+    try:
+        require_admin(event)
+    except ValidationError as e:
+        return format_error(403, e.message)
+
+    params = event.get('queryStringParameters') or {}
+    scope = params.get('scope', 'practice')
+    if scope not in SCOPES:
+        return format_error(400, f"scope must be one of: {', '.join(SCOPES)}")
+    scope_id = params.get('id')
+
+    try:
+        end = date.fromisoformat(params['to']) if params.get('to') else datetime.utcnow().date()
+        start = date.fromisoformat(params['from']) if params.get('from') else \
+            end - timedelta(days=DEFAULT_REPORT_DAYS - 1)
+    except ValueError:
+        return format_error(400, "from / to must be YYYY-MM-DD")
+    limit = MAX_REPORT_DAYS if scope_id else MAX_REPORT_DAYS_ALL_IDS
+    if start > end or (end - start).days >= limit:
+        return format_error(400, f"from must be before to, at most {limit} days apart")
+
+    try:
+        if scope_id:
+            items = query_all(KeyConditionExpression=Key('scope').eq(f"{scope}#{scope_id}")
+                              & Key('day').between(start.isoformat(), end.isoformat()))
+        else:
+            items = []
+            for day in _days(start, end):
+                items.extend(query_all(IndexName='day-index',
+                                       KeyConditionExpression=Key('day').eq(day)
+                                       & Key('scope').begins_with(f"{scope}#")))
+    except Exception as e:
+        return format_error(500, "Failed to read usage", internal_error=e)
+
+    rows = [report_row(item) for item in items]
+    rows.sort(key=lambda r: (r['day'], r['id']))
+
+    totals = {}
+    for row in rows:
+        total = totals.setdefault(row['id'], {'id': row['id'], 'days': 0})
+        total['days'] += 1
+        for key, value in row.items():
+            if isinstance(value, int) and not key.startswith('avg_'):
+                total[key] = total.get(key, 0) + value
+
+    return format_response(200, {
+        'scope': scope,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'slow_note_ms': SLOW_NOTE_MS,
+        'rows': rows,
+        'totals': [report_row(dict(t, scope=f"{scope}#{t['id']}")) for t in totals.values()]
+    }, event=event)
@@ -0,0 +1,212 @@
+# functions/generate/model_router.py
+"""
+Per-request model routing.
+
+Candidates, in order of preference:
+  FAST_MODEL_ID      fast-draft tier for short transcripts on simple templates
+  MODEL_ID           primary model
+  FALLBACK_MODEL_ID  used when the preferred model throttles, errors or blows
+                     the latency budget (e.g. a global cross-region profile)
+
+Each container keeps a sliding window of observed latency per output token for
+every model; if the preferred model's p95 predicts a call over the latency
+budget and an alternative predicts faster, the alternative goes first.
+
+Every routing decision and every call outcome is logged as one JSON line
+("model_route" / "model_call") so the policy can be evaluated offline with
+CloudWatch Logs Insights.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+PRIMARY_MODEL_ID = os.environ.get('MODEL_ID', 'us.anthropic.claude-haiku-4-5-20251001-v1:0')
+FAST_MODEL_ID = os.environ.get('FAST_MODEL_ID', '')
+FALLBACK_MODEL_ID = os.environ.get('FALLBACK_MODEL_ID', '')
+
+LATENCY_BUDGET_SECONDS = float(os.environ.get('LATENCY_BUDGET_SECONDS', '20'))
+
+# Fast tier only for short, simple requests
+FAST_MAX_TRANSCRIPT_TOKENS = int(os.environ.get('FAST_MAX_TRANSCRIPT_TOKENS', '1500'))
+FAST_MAX_SECTIONS = 4
+
+LATENCY_WINDOW = 50
+LATENCY_MIN_SAMPLES = 5
+MIN_TOKENS_FOR_RATE = 50
+
+# Errors worth trying another model for (everything else is a request problem)
+FALLBACK_ERROR_CODES = {
+    'ThrottlingException', 'ServiceUnavailableException', 'ModelTimeoutException',
+    'ModelNotReadyException', 'InternalServerException', 'TooManyRequestsException'
+}
+FALLBACK_EXCEPTION_NAMES = {
+    'ReadTimeoutError', 'ConnectTimeoutError', 'EndpointConnectionError', 'LatencyBudgetExceeded',
+    # bedrock_guard: breaker open / no shared rate-limit capacity for this model
+    'CircuitOpenError', 'RateLimitedError'
+}
+
+_latency = {}
+_latency_lock = threading.Lock()
+# Duration of the last Bedrock request on this thread (see timed_request)
+_request_timing = threading.local()
+
+
+class LatencyBudgetExceeded(Exception):
+    """A non-final candidate ran past LATENCY_BUDGET_SECONDS of wall-clock time"""
+
+
+def error_code(error):
+    """botocore ClientError code, or the exception class name"""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code'):
+        return response['Error']['Code']
+    return type(error).__name__
+
+
+def is_fallback_error(error):
+    return error_code(error) in FALLBACK_ERROR_CODES or type(error).__name__ in FALLBACK_EXCEPTION_NAMES
+
+
+def observe(model_id, latency_ms, output_tokens):
+    """Record a successful call's latency per output token"""
+    rate = latency_ms / max(int(output_tokens or 0), MIN_TOKENS_FOR_RATE)
+    with _latency_lock:
+        _latency.setdefault(model_id, deque(maxlen=LATENCY_WINDOW)).append(rate)
+
+
+def p95_ms_per_token(model_id):
+    with _latency_lock:
+        window = sorted(_latency.get(model_id, ()))
+    if len(window) < LATENCY_MIN_SAMPLES:
+        return None
+    return window[min(len(window) - 1, int(len(window) * 0.95))]
+
+
+def predicted_latency_ms(model_id, output_tokens):
+    rate = p95_ms_per_token(model_id)
+    return None if rate is None else rate * max(output_tokens, MIN_TOKENS_FOR_RATE)
+
+
+def default_route():
+    """Route for internal calls (fact extraction etc.): primary, then fallback"""
+    candidates = [PRIMARY_MODEL_ID] + ([FALLBACK_MODEL_ID] if FALLBACK_MODEL_ID else [])
+    return {'route_id': None, 'candidates': candidates, 'reason': 'default'}
+
+
+def choose_route(transcript_tokens, section_count, predicted_tokens):
+    """Pick the ordered model candidates for one note generation"""
+    if FAST_MODEL_ID and transcript_tokens <= FAST_MAX_TRANSCRIPT_TOKENS and section_count <= FAST_MAX_SECTIONS:
+        candidates = [FAST_MODEL_ID, PRIMARY_MODEL_ID]
+        reason = 'fast_tier'
+    else:
+        candidates = [PRIMARY_MODEL_ID]
+        reason = 'primary'
+    if FALLBACK_MODEL_ID and FALLBACK_MODEL_ID not in candidates:
+        candidates.append(FALLBACK_MODEL_ID)
+
+    # Latency-aware reordering: promote the fastest model that is expected to
+    # meet the budget when the preferred one is not
+    budget_ms = LATENCY_BUDGET_SECONDS * 1000
+    predictions = {m: predicted_latency_ms(m, predicted_tokens) for m in candidates}
+    first = predictions[candidates[0]]
+    if first is not None and first > budget_ms:
+        faster = [m for m in candidates[1:] if predictions[m] is not None and predictions[m] < first]
+        if faster:
+            best = min(faster, key=lambda m: predictions[m])
+            candidates.remove(best)
+            candidates.insert(0, best)
+            reason += '+latency'
+
+    route = {'route_id': uuid.uuid4().hex[:12], 'candidates': candidates, 'reason': reason}
+    print(json.dumps({
+        'event': 'model_route',
+        'route_id': route['route_id'],
+        'reason': reason,
+        'candidates': candidates,
+        'transcript_tokens': transcript_tokens,
+        'sections': section_count,
+        'predicted_tokens': predicted_tokens,
+        'predicted_latency_ms': {m: (int(v) if v is not None else None) for m, v in predictions.items()}
+    }))
+    return route
+
+
+def timed_request(request):
+    """
+    Run one Bedrock request, noting how long the request itself took.
+    bedrock_guard wraps every attempt in this, so the latency that
+    run_with_fallback reports leaves out rate-limiter waits and retry backoff.
+    """
+    started = time.time()
+    try:
+        return request()
+    finally:
+        _request_timing.ms = (time.time() - started) * 1000
+
+
+def within_budget(request, seconds=None):
+    """
+    Run request() but give up after the latency budget of wall-clock time.
+    botocore's read_timeout only bounds each socket read, so a response that
+    keeps arriving can run well past it. An abandoned request finishes on its
+    daemon thread and its result is dropped.
+    """
+    seconds = LATENCY_BUDGET_SECONDS if seconds is None else seconds
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = request()
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    if thread.is_alive():
+        raise LatencyBudgetExceeded(f"No response within {seconds:.0f}s")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+def record_call(route, model_id, attempt, ok, latency_ms, output_tokens=None, error=None):
+    """One outcome line per model call (successes feed the latency window)"""
+    if ok and output_tokens is not None:
+        observe(model_id, latency_ms, output_tokens)
+    print(json.dumps({
+        'event': 'model_call',
+        'route_id': route.get('route_id'),
+        'model_id': model_id,
+        'attempt': attempt,
+        'ok': ok,
+        'latency_ms': int(latency_ms),
+        'output_tokens': output_tokens,
+        'error': error,
+        'over_budget': latency_ms > LATENCY_BUDGET_SECONDS * 1000
+    }))
+
+
+def run_with_fallback(route, call):
+    """
+    Try route candidates in order. `call(model_id, last)` performs the request
+    (`last` is True for the final candidate, which gets no latency budget).
+    Returns (result, model_id, attempt, latency_ms); latency_ms is the
+    request's own time (see timed_request), 0 if none was sent. Non-retryable
+    errors propagate immediately; the last candidate's error propagates too.
+    """
+    candidates = route['candidates']
+    for attempt, model_id in enumerate(candidates):
+        last = attempt == len(candidates) - 1
+        _request_timing.ms = 0.0
+        try:
+            result = call(model_id, last)
+            return result, model_id, attempt, _request_timing.ms
+        except Exception as e:
+            record_call(route, model_id, attempt, False, _request_timing.ms, error=error_code(e))
+            if last or not is_fallback_error(e):
+                raise
+            print(f"Model {model_id} failed ({error_code(e)}), falling back to {candidates[attempt + 1]}")
@@ -0,0 +1,218 @@
+# functions/generate/note_outbox.py
+"""
+Durable persistence for generated notes, off the response critical path.
+
+save_note() starts the write - S3 offload of big bodies, then the DynamoDB
+put - on a background thread and returns a NoteWrite. The caller stores the
+cache entry and usage rollups meanwhile, then calls wait(), which blocks for
+whatever is left of OUTBOX_FLUSH_SECONDS since the write started (well before
+the Lambda returns and freezes):
+
+- 'saved'    the put completed
+- 'pending'  the put is still in flight at the budget; rather than block, the
+             item also goes to the notes outbox queue, and whichever lands
+             first wins
+- 'queued'   the put failed, so the item went to the outbox queue;
+             lambda_handler below (NotesOutboxWriter) writes it with
+             BatchWriteItem, retrying until the DLQ
+- 'failed'   neither worked - the note is only in the response
+
+Writes are idempotent: the direct put is conditional on the note not
+existing, and the writer skips notes already in the table, so a put that
+lands late never overwrites a note edited or regenerated since.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+from body_store import offload_bodies
+from table_pool import PooledTable
+
+NOTES_TABLE = os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod')
+NOTES_OUTBOX_QUEUE_URL = os.environ.get('NOTES_OUTBOX_QUEUE_URL', '')
+OUTBOX_FLUSH_SECONDS = float(os.environ.get('OUTBOX_FLUSH_SECONDS', '1.0'))
+# Partitions of the sparse archive-index; the archiver queries every one
+ARCHIVE_SHARDS = int(os.environ.get('ARCHIVE_SHARDS', '16'))
+
+BATCH_WRITE_LIMIT = 25
+BATCH_WRITE_RETRIES = 4
+BATCH_RETRY_BASE_SECONDS = 0.1
+
+dynamodb = boto3.resource('dynamodb')
+notes_table = PooledTable(NOTES_TABLE)
+# SQS_ENDPOINT_URL points the client at ElasticMQ when running locally
+sqs = boto3.client('sqs', endpoint_url=os.environ.get('SQS_ENDPOINT_URL') or None)
+
+
+def archive_shard(user_id, timestamp):
+    digest = hashlib.sha256(f"{user_id}#{timestamp}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % ARCHIVE_SHARDS
+
+
+def mark_updated(item, now=None):
+    """
+    Stamp the write time; history syncs on updated_at via the user-updated-index
+    GSI. New notes also join the archive-index until the archiver stubs them.
+    """
+    item['updated_at'] = now or datetime.utcnow().isoformat()
+    item.setdefault('archive_shard', archive_shard(item['user_id'], item['timestamp']))
+    return item
+
+
+def _decimal_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def enqueue_note(item):
+    """Hand the item to the outbox queue. Returns True once SQS has it."""
+    if not NOTES_OUTBOX_QUEUE_URL:
+        return False
+    try:
+        sqs.send_message(
+            QueueUrl=NOTES_OUTBOX_QUEUE_URL,
+            MessageBody=json.dumps({'item': item, 'queued_at': time.time()}, default=_decimal_default)
+        )
+        return True
+    except Exception as e:
+        print(f"Error queueing note {item['user_id']}#{item['timestamp']}: {str(e)}")
+        return False
+
+
+class NoteWrite:
+    """One note write (body offload + put) running in the background"""
+
+    def __init__(self, item):
+        # Left as built: the outbox fallback offloads its own copy
+        self.item = item
+        self.error = None
+        self.write_ms = None
+        self.started = time.time()
+        self.thread = threading.Thread(target=self._put, daemon=True)
+        self.thread.start()
+
+    def _put(self):
+        try:
+            # Keep the item under the 400 KB limit - big bodies go to S3
+            item = mark_updated(offload_bodies(dict(self.item)))
+            notes_table.put_item(Item=item, ConditionExpression='attribute_not_exists(user_id)')
+        except ClientError as e:
+            # Already there (a retried request): the note is saved
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                self.error = e
+        except Exception as e:
+            self.error = e
+        self.write_ms = int((time.time() - self.started) * 1000)
+
+    def wait(self, timeout=None):
+        """Persistence status: 'saved', 'pending', 'queued' or 'failed'"""
+        if timeout is None:
+            timeout = OUTBOX_FLUSH_SECONDS
+        self.thread.join(max(0.0, timeout - (time.time() - self.started)))
+        in_flight = self.thread.is_alive()
+        if not in_flight and self.error is None:
+            status = 'saved'
+        else:
+            reason = 'still in flight' if in_flight else str(self.error)
+            print(f"Note write {self.item['user_id']}#{self.item['timestamp']} {reason}; using the outbox")
+            try:
+                # Offloading is content-addressed, so redoing it here is idempotent;
+                # it also keeps the message under SQS's 256 KB
+                queued = enqueue_note(offload_bodies(dict(self.item)))
+            except Exception as e:
+                print(f"Error offloading note bodies for the outbox: {str(e)}")
+                queued = False
+            status = ('pending' if in_flight else 'queued') if queued else 'failed'
+
+        print(json.dumps({'event': 'note_write', 'status': status, 'write_ms': self.write_ms,
+                          'waited_ms': int((time.time() - self.started) * 1000)}))
+        return status
+
+
+# ========================================
+# Outbox writer (SQS -> BatchWriteItem)
+# ========================================
+
+def existing_keys(keys):
+    """The subset of note keys already in the table"""
+    found = set()
+    request = {NOTES_TABLE: {'Keys': keys, 'ProjectionExpression': 'user_id, #ts',
+                             'ExpressionAttributeNames': {'#ts': 'timestamp'}}}
+    for _ in range(BATCH_WRITE_RETRIES + 1):
+        response = dynamodb.meta.client.batch_get_item(RequestItems=request)
+        for item in response.get('Responses', {}).get(NOTES_TABLE, []):
+            found.add((item['user_id'], item['timestamp']))
+        request = response.get('UnprocessedKeys') or {}
+        if not request:
+            return found
+        time.sleep(BATCH_RETRY_BASE_SECONDS)
+    raise RuntimeError("Could not check existing notes (unprocessed keys)")
+
+
+def write_notes(items):
+    """
+    BatchWriteItem the items, retrying unprocessed ones with backoff.
+    Returns the keys ((user_id, timestamp)) that could not be written.
+    """
+    # Stamped when actually written: a late write must still reach clients
+    # whose sync cursor is past the time the note was generated
+    now = datetime.utcnow().isoformat()
+    pending = [{'PutRequest': {'Item': mark_updated(dict(item), now)}} for item in items]
+    for attempt in range(BATCH_WRITE_RETRIES + 1):
+        if not pending:
+            return set()
+        if attempt:
+            time.sleep(random.uniform(0, BATCH_RETRY_BASE_SECONDS * (2 ** attempt)))
+        response = dynamodb.meta.client.batch_write_item(RequestItems={NOTES_TABLE: pending})
+        pending = (response.get('UnprocessedItems') or {}).get(NOTES_TABLE, [])
+    return {(r['PutRequest']['Item']['user_id'], r['PutRequest']['Item']['timestamp']) for r in pending}
+
+
+def lambda_handler(event, context):
+    """
+    SQS batch handler for the notes outbox. Messages whose note could not be
+    written are reported individually (partial batch response) and retried.
+    """
+    failures = []
+    by_key = {}
+    for record in event.get('Records', []):
+        try:
+            item = json.loads(record['body'], parse_float=Decimal)['item']
+            key = (item['user_id'], item['timestamp'])
+        except Exception as e:
+            # Unparseable - redelivery won't help, let it reach the DLQ
+            print(f"Bad outbox message {record.get('messageId')}: {str(e)}")
+            failures.append({'itemIdentifier': record['messageId']})
+            continue
+        # The same note queued twice (e.g. a retried request) is one write
+        by_key.setdefault(key, []).append((record['messageId'], item))
+
+    keys = list(by_key)
+    written = skipped = 0
+    for start in range(0, len(keys), BATCH_WRITE_LIMIT):
+        chunk = keys[start:start + BATCH_WRITE_LIMIT]
+        try:
+            existing = existing_keys([{'user_id': k[0], 'timestamp': k[1]} for k in chunk])
+            to_write = [k for k in chunk if k not in existing]
+            failed = write_notes([by_key[k][0][1] for k in to_write])
+        except Exception as e:
+            print(f"Error writing outbox notes: {str(e)}")
+            failed = set(chunk)
+            existing = set()
+            to_write = []
+        skipped += len(existing)
+        written += len(to_write) - len(failed & set(to_write))
+        for key in failed:
+            failures.extend({'itemIdentifier': message_id} for message_id, _ in by_key[key])
+
+    print(json.dumps({'event': 'notes_outbox', 'messages': len(event.get('Records', [])),
+                      'written': written, 'already_saved': skipped, 'failed': len(failures)}))
+    return {'batchItemFailures': failures}
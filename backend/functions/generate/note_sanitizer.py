@@ -0,0 +1,303 @@
+# functions/generate/note_sanitizer.py
+"""
+Linear-time Markdown-to-plaintext sanitizer for generated notes.
+
+Complete lines are handled in blocks: fence marker lines are dropped, then a
+single pass of one tokenizer regex (MARKDOWN_RE) over the block strips every
+construct - line-level prefixes (headers, quotes, rules, bullets, table
+pipes) and inline code, links, images and emphasis - and a last pass trims
+trailing whitespace when a line has any. Every alternative starts with its
+delimiter character, so the regex engine skips plain text without trying
+them, and no alternative can rescan past the next delimiter of its kind, so
+the pass stays linear (the old regex chain went quadratic on unclosed links).
+
+Emphasis follows the CommonMark flanking rules: "*" / "_" only open when
+followed by non-whitespace and only close when preceded by it ("2 * 3 * 4"
+and "Class II*" stay as written), and "_" never opens or closes inside a
+word (snake_case).
+
+MarkdownSanitizer can be fed chunk by chunk (e.g. from a Bedrock response
+stream). Output is only emitted for completed lines and is always a prefix of
+the final result, so streamed text never has to be retracted.
+
+The golden corpus is in backend/tests/generate/test_note_sanitizer.py; run
+`python note_sanitizer.py` to benchmark against the previous regex chain.
+"""
+import re
+
+FENCE_MARKERS = ('```', '~~~')
+
+# Lines without any of these need no Markdown handling at all
+MARKUP_RE = re.compile(r"[`*_\[!#>|~+-]")
+
+# ASCII punctuation, for the emphasis flanking rules
+_PUNCT = r"!-/:-@\[-`{-~"
+# End of line, ignoring trailing whitespace
+_EOL = r"(?=[ \t\r]*(?:\n|\Z))"
+
+
+def _strong(d):
+    """**text** / __text__: opener left-flanking, closer right-flanking"""
+    d = re.escape(d)
+    if d == r'\*':
+        return (rf"{d}{d}(?<!{d}{d}{d})(?![\s{d}])(?:(?![{_PUNCT}])|(?<![^\s{_PUNCT}]{d}{d}))"
+                rf"([^{d}\n]+)"
+                rf"{d}{d}(?!{d})(?<!\s{d}{d})(?:(?<![{_PUNCT}]{d}{d})|(?![^\s{_PUNCT}]))")
+    # Underscores must also sit at word boundaries
+    return (rf"{d}{d}(?<!{d}{d}{d})(?<![^\s{_PUNCT}]{d}{d})(?![\s{d}])"
+            rf"([^{d}\n]+)"
+            rf"{d}{d}(?!{d})(?<!\s{d}{d})(?![^\s{_PUNCT}])")
+
+
+def _em(d):
+    """*text* / _text_, same rules for a single delimiter"""
+    d = re.escape(d)
+    if d == r'\*':
+        return (rf"{d}(?<!{d}{d})(?![\s{d}])(?:(?![{_PUNCT}])|(?<![^\s{_PUNCT}]{d}))"
+                rf"([^{d}\n]+)"
+                rf"{d}(?!{d})(?<!\s{d})(?:(?<![{_PUNCT}]{d})|(?![^\s{_PUNCT}]))")
+    return (rf"{d}(?<!{d}{d})(?<![^\s{_PUNCT}]{d})(?![\s{d}])"
+            rf"([^{d}\n]+)"
+            rf"{d}(?!{d})(?<!\s{d})(?![^\s{_PUNCT}])")
+
+
+# Matched against "\n" + block, so every line starts after a newline. At most
+# one line-level construct per line, tried in this order: horizontal rule
+# (---, ***, ___), ATX header (up to 3 spaces, 1-6 '#', then whitespace or end
+# of line - "#14 crown prep" is a tooth number, not a header), blockquote,
+# leading table pipe (all replaced by group 1, the newline), bullet (group 2).
+# Then the inline constructs, each with its text in one group, and the
+# trailing table pipe. Brackets can't nest in link text or URLs, so an
+# unclosed "[" never scans past the next one.
+MARKDOWN_RE = re.compile('|'.join([
+    rf"(\n)(?:[ \t]*[-*_]{{3,}}{_EOL}|[ \t]{{0,3}}#{{1,6}}(?:[ \t]+|{_EOL})|[ \t]*>[ \t]?|\|)",
+    r"(\n)[ \t]*[*+-][ \t]+",
+    r"`([^`\n]+)`",
+    r"!\[([^\]\[\n]*)\]\([^)\[\n]+\)",
+    r"\[([^\]\[\n]+)\]\([^)\[\n]+\)",
+    _strong('*'),
+    _strong('_'),
+    _em('*'),
+    _em('_'),
+    rf"\|{_EOL}",
+]))
+_BULLET_GROUP = 2
+
+# The lookbehind keeps this linear: a run of spaces is only tried from its start
+TRAILING_SPACE_RE = re.compile(r"(?<![ \t\r])[ \t\r]+$", re.MULTILINE)
+BLANK_RUN_RE = re.compile(r"\n{3,}")
+# Candidate fence lines start with one of these (after optional indentation)
+FENCE_RE = re.compile(r"```|~~~")
+
+
+def _replace(match):
+    """Each construct becomes the text in its group; bullets become "- " """
+    group = match.lastindex
+    if group == _BULLET_GROUP:
+        return '\n- '
+    return match.group(group) if group else ''
+
+
+def _has_trailing_space(text):
+    return ' \n' in text or '\t\n' in text or '\r' in text or text[-1:] in (' ', '\t')
+
+
+def sanitize_block(text):
+    """Complete lines outside fence markers: one tokenizer pass, then trailing whitespace"""
+    if MARKUP_RE.search(text):
+        text = MARKDOWN_RE.sub(_replace, '\n' + text)[1:]
+    if _has_trailing_space(text):
+        text = TRAILING_SPACE_RE.sub('', text)
+    return text
+
+
+def _fence_marker(line):
+    stripped = line.lstrip(' \t')
+    for marker in FENCE_MARKERS:
+        if stripped.startswith(marker):
+            # ```code``` on one line is inline code, not a fence
+            if marker in stripped[3:]:
+                return None
+            return marker
+    return None
+
+
+class MarkdownSanitizer:
+    """Incremental sanitizer: feed() chunks, then finish()"""
+
+    def __init__(self):
+        self._partial = []
+        self._fence = None
+        self._pending_blank = False
+        self._started = False
+
+    def feed(self, chunk):
+        """Consume a chunk; returns the sanitized text for every line completed so far"""
+        if not chunk:
+            return ''
+
+        newline = chunk.rfind('\n')
+        if newline == -1:
+            self._partial.append(chunk)
+            return ''
+
+        self._partial.append(chunk[:newline])
+        text = ''.join(self._partial)
+        self._partial = [chunk[newline + 1:]] if newline + 1 < len(chunk) else []
+
+        return self._emit_text(text)
+
+    def finish(self):
+        """Flush the final (unterminated) line"""
+        text = ''.join(self._partial)
+        self._partial = []
+        return self._emit_text(text) if text else ''
+
+    def _emit_text(self, text):
+        """
+        Complete lines (joined by newlines). Fence marker lines are dropped and
+        the blocks between them sanitized in bulk; what is inside a fence is
+        sanitized like any other text, since models wrap whole notes in
+        ```markdown fences.
+        """
+        out = []
+        pos = 0
+        for match in FENCE_RE.finditer(text):
+            start = text.rfind('\n', 0, match.start()) + 1
+            # Only a marker that starts its line (after indentation) is a fence
+            if start < pos or text[start:match.start()].strip(' \t'):
+                continue
+            end = text.find('\n', match.end())
+            if end == -1:
+                end = len(text)
+            line = text[start:end]
+            if self._fence:
+                if not line.lstrip(' \t').startswith(self._fence):
+                    continue
+                self._fence = None
+            else:
+                marker = _fence_marker(line)
+                if not marker:
+                    continue
+                self._fence = marker
+            if start > pos:
+                out.append(self._emit_lines(text[pos:start - 1]))
+            pos = end + 1
+        if pos <= len(text):
+            out.append(self._emit_lines(text[pos:]))
+        return ''.join(out)
+
+    def _emit_lines(self, block):
+        """
+        Collapse runs of blank lines to one and drop leading and trailing
+        blanks (sanitize_block leaves blank lines empty). A blank run at the
+        end of a block is only written once a non-blank line follows it.
+        """
+        text = sanitize_block(block)
+        body = text.strip('\n')
+        if not body:
+            if self._started:
+                self._pending_blank = True
+            return ''
+
+        body = BLANK_RUN_RE.sub('\n\n', body)
+        if not self._started:
+            self._started = True
+            out = body.lstrip(' \t')
+        else:
+            out = ('\n\n' if self._pending_blank or text.startswith('\n') else '\n') + body
+        self._pending_blank = text.endswith('\n')
+        return out
+
+
+def sanitize(text):
+    """Sanitize a complete note"""
+    sanitizer = MarkdownSanitizer()
+    return sanitizer.feed(text or '') + sanitizer.finish()
+
+
+# ========================================
+# Benchmark (python note_sanitizer.py)
+# ========================================
+
+BENCHMARK_NOTE = """SUBJECTIVE:
+Patient presents for a limited exam, c/o cold sensitivity on the lower left for 2 weeks.
+Denies swelling. Medical history reviewed - no changes, NKDA.
+
+OBJECTIVE:
+- #19: MO composite, recurrent decay at the mesial margin
+- Percussion (+) #19, (-) #18, #20
+- Cold test: lingering 10+ sec on #19
+Radiograph: PA #19 shows radiolucency approaching the pulp.
+
+ASSESSMENT:
+Symptomatic irreversible pulpitis, #19.
+
+PLAN:
+1. Discussed RCT + crown vs. extraction; patient elects RCT.
+2. Referred to endo; follow-up in 2 weeks.
+3. Ibuprofen 600 mg q6h PRN.
+"""
+BENCHMARK_MARKDOWN = """```markdown
+## SUBJECTIVE:
+**Patient** presents for recall, no complaints.
+
+## OBJECTIVE:
+* Generalized *light* plaque
+* `BOP` on #30 distal
+---
+## PLAN:
+1. Prophy, fluoride
+2. Recall in [6 months](#)
+```
+"""
+
+
+def _legacy_regex_chain(txt):
+    """The previous 17-pass regex post-processing, kept only for benchmarking"""
+    txt = re.sub(r"```(?:\w+)?\n?([\s\S]*?)\n?```", r"\1", txt)
+    txt = re.sub(r"~~~(?:\w+)?\n?([\s\S]*?)\n?~~~", r"\1", txt)
+    txt = re.sub(r"`([^`]+)`", r"\1", txt)
+    txt = re.sub(r"^[ \t]{0,3}#{1,6}[ \t]*", "", txt, flags=re.MULTILINE)
+    txt = re.sub(r"^[ \t]*>[ \t]?", "", txt, flags=re.MULTILINE)
+    txt = re.sub(r"!\[([^\]]*)\]\([^)]+\)", r"\1", txt)
+    txt = re.sub(r"\[([^\]]+)\]\([^)]+\)", r"\1", txt)
+    txt = re.sub(r"\*\*([^*]+)\*\*", r"\1", txt)
+    txt = re.sub(r"__([^_]+)__", r"\1", txt)
+    txt = re.sub(r"_([^_]+)_", r"\1", txt)
+    txt = re.sub(r"\*([^*]+)\*", r"\1", txt)
+    txt = re.sub(r"^[ \t]*[\*\+-][ \t]+", "- ", txt, flags=re.MULTILINE)
+    txt = re.sub(r"^[ \t]*([-*_]){3,}[ \t]*$", "", txt, flags=re.MULTILINE)
+    txt = re.sub(r"^\|", "", txt, flags=re.MULTILINE)
+    txt = re.sub(r"\|$", "", txt, flags=re.MULTILINE)
+    txt = re.sub(r"\n\s*\n\s*\n+", "\n\n", txt)
+    txt = re.sub(r"[ \t]+$", "", txt, flags=re.MULTILINE)
+    return txt.strip()
+
+
+def _benchmark():
+    import timeit
+
+    adversarial = {
+        'blank lines': "A" + "\n \n" * 2000 + " B",
+        'unclosed emphasis': "* " * 5000,
+        'unclosed links': "[a](" * 5000,
+    }
+    fenced_body = BENCHMARK_MARKDOWN.split('\n', 1)[1].rsplit('```', 1)[0]
+    typical = [
+        ('typical note', BENCHMARK_NOTE),
+        ('markdown note', BENCHMARK_MARKDOWN),
+        ('long note', BENCHMARK_NOTE * 10),
+        ('long markdown', '```markdown\n' + fenced_body * 20 + '```\n'),
+    ]
+    for name, text in typical + list(adversarial.items()):
+        # Best of several repeats, so a noisy machine doesn't decide the comparison
+        runs = 20
+        new = min(timeit.repeat(lambda: sanitize(text), number=runs, repeat=5)) / runs
+        old = min(timeit.repeat(lambda: _legacy_regex_chain(text), number=runs, repeat=5)) / runs
+        print(f"{name:18s} {len(text):7d} chars  sanitizer {new * 1000:8.2f} ms "
+              f"({len(text) / new / 1e6:6.1f} MB/s)  regex chain {old * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    _benchmark()
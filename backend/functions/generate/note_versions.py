@@ -0,0 +1,90 @@
+# functions/generate/note_versions.py
+"""
+Versioned in-place updates of a saved note (batch regeneration, section edits).
+
+The note text is replaced as version N+1; the replaced text stays in S3 and is
+referenced from previous_versions, so every change can be audited or undone.
+"""
+import hashlib
+import os
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+from body_store import NOTE_BODIES_BUCKET, body_key, offload_bodies, s3
+from table_pool import PooledTable
+
+notes_table = PooledTable(os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod'))
+
+
+def store_previous_body(note):
+    """S3 pointer to the text being replaced (reusing an existing offload)"""
+    if isinstance(note.get('soap_note_ref'), dict):
+        return note['soap_note_ref']
+    data = (note.get('soap_note') or '').encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    key = body_key(note['user_id'], note['timestamp'], 'soap_note', digest)
+    s3.put_object(
+        Bucket=NOTE_BODIES_BUCKET,
+        Key=key,
+        Body=data,
+        ContentType='text/plain; charset=utf-8',
+        ServerSideEncryption='aws:kms'
+    )
+    return {'bucket': NOTE_BODIES_BUCKET, 'key': key, 'sha256': digest, 'size': len(data)}
+
+
+def write_version(note, template, soap_note, **fields):
+    """
+    Replace the note text as version N+1, setting `fields` alongside (e.g.
+    regeneration_id). Returns the new version, or None if the note changed
+    since it was read (someone else wrote a version) - it is left alone.
+    """
+    now = datetime.utcnow().isoformat()
+    version = int(note.get('version', 1))
+    previous = {
+        'version': version,
+        'template_id': note.get('template_id'),
+        'template_name': note.get('template_name'),
+        'soap_note_ref': store_previous_body(note),
+        'replaced_at': now
+    }
+
+    new_body = offload_bodies({'user_id': note['user_id'], 'timestamp': note['timestamp'], 'soap_note': soap_note})
+    if 'soap_note' in new_body:
+        body_update, remove = 'soap_note = :body', ' REMOVE soap_note_ref'
+        body_value = new_body['soap_note']
+    else:
+        body_update, remove = 'soap_note_ref = :body', ' REMOVE soap_note'
+        body_value = new_body['soap_note_ref']
+
+    names = {f"#{k}": k for k in fields}
+    values = {f":{k}": v for k, v in fields.items()}
+    extra = ''.join(f", #{k} = :{k}" for k in fields)
+    try:
+        notes_table.update_item(
+            Key={'user_id': note['user_id'], 'timestamp': note['timestamp']},
+            UpdateExpression=(
+                f"SET {body_update}, template_name = :template_name, version = :next, "
+                "updated_at = :now, "
+                "previous_versions = list_append(if_not_exists(previous_versions, :none), :previous)"
+                + extra + remove
+            ),
+            ConditionExpression='attribute_exists(user_id) AND '
+                                '(attribute_not_exists(version) OR version = :seen)',
+            ExpressionAttributeValues={
+                ':body': body_value,
+                ':template_name': template.get('name', 'Unknown'),
+                ':next': version + 1,
+                ':none': [],
+                ':previous': [previous],
+                ':seen': version,
+                ':now': now,
+                **values
+            },
+            **({'ExpressionAttributeNames': names} if names else {})
+        )
+        return version + 1
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return None
+        raise
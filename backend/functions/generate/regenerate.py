@@ -0,0 +1,597 @@
+# functions/generate/regenerate.py
+"""
+Batch regeneration of saved notes, e.g. after an admin changes a template.
+
+POST /admin/regenerations                    {template_id, from, to, user_id?, backend?, concurrency?}
+GET  /admin/regenerations/{regeneration_id}  progress
+
+Notes are selected by template and timestamp range (optionally one provider).
+Two backends:
+  ondemand  the normal generation path (model routing, retries, the shared
+            Bedrock rate limit) driven by a bounded thread pool. The scan
+            position is checkpointed after every page and the run continues
+            in a fresh invocation when time runs low.
+  batch     every prompt is written to S3 as Bedrock batch-inference JSONL and
+            submitted as one model invocation job - cheaper and outside the
+            on-demand quotas, for big backfills. The output is ingested when
+            the job finishes (EventBridge state change, or the next GET).
+
+A regenerated note is updated in place as a new version (note_versions.py):
+version is bumped and the replaced text is kept in S3.
+"""
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from bedrock_guard import has_time_for, is_retryable, set_deadline
+from body_store import resolve_bodies
+from generation_cache import put_cached
+from handler import (
+    MODEL_ID, build_bedrock_body, cacheable, find_template, generate_cached, jobs_table, lambda_client,
+    notes_table, prepare_prompt, sanitize_note
+)
+from metering import Meter, Rollups
+from note_versions import write_version
+from security import format_response, format_error, parse_body, require_admin, ValidationError
+
+bedrock_control = boto3.client('bedrock', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
+s3 = boto3.client('s3')
+
+REGENERATION_BUCKET = os.environ.get('REGENERATION_BUCKET', 'scribe32-regenerations-prod')
+BATCH_ROLE_ARN = os.environ.get('BATCH_INFERENCE_ROLE_ARN', '')
+BATCH_MODEL_ID = os.environ.get('BATCH_MODEL_ID', MODEL_ID)
+# Bedrock rejects batch jobs below its minimum record count
+BATCH_MIN_RECORDS = 100
+
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 8
+PAGE_SIZE = 100
+NOTE_ATTEMPTS = 3
+NOTE_RETRY_SECONDS = 5
+MAX_REPORTED_ERRORS = 20
+JOB_TTL_DAYS = 14
+
+# Leave time for the page in flight and the checkpoint before the Lambda timeout
+SAFETY_MARGIN_MS = 240 * 1000
+
+BATCH_DONE_STATUSES = ('Completed', 'PartiallyCompleted')
+BATCH_FAILED_STATUSES = ('Failed', 'Stopped', 'Expired')
+
+
+def lambda_handler(event, context):
+    set_deadline(context)
+
+    # Async continuation of a run (see start_regeneration)
+    if event.get('regeneration_id'):
+        return run_regeneration(event['regeneration_id'], context, event.get('step', 'run'))
+
+    # Bedrock batch job finished (EventBridge "Batch Inference Job State Change")
+    if event.get('source') == 'aws.bedrock':
+        return on_batch_state_change(event.get('detail') or {}, context)
+
+    http_method = event.get('httpMethod', 'GET')
+    if http_method == 'OPTIONS':
+        return format_response(200, {}, method='POST')
+
+    try:
+        # Admin only endpoint
+        try:
+            user_info = require_admin(event)
+        except ValidationError as e:
+            return format_error(403, e.message, method=http_method)
+
+        if http_method == 'POST':
+            return start_regeneration(event, context, user_info)
+
+        regeneration_id = (event.get('pathParameters') or {}).get('regeneration_id')
+        if http_method == 'GET' and regeneration_id:
+            return get_regeneration(regeneration_id, event, context)
+
+        return format_error(405, f"Method {http_method} not allowed", method=http_method)
+
+    except Exception as e:
+        return format_error(500, "An unexpected error occurred", internal_error=e, method=http_method)
+
+
+# ========================================
+# API
+# ========================================
+
+def parse_day(value, end_of_day=False):
+    """ISO date/datetime -> the stored timestamp format; date-only 'to' covers the day"""
+    value = (value or '').strip()
+    datetime.fromisoformat(value)
+    if end_of_day and len(value) == 10:
+        return f"{value}T23:59:59.999999"
+    return value
+
+
+def start_regeneration(event, context, user_info):
+    try:
+        body = parse_body(event)
+    except json.JSONDecodeError:
+        return format_error(400, "Invalid JSON in request body", method='POST')
+
+    template_id = body.get('template_id')
+    if not template_id:
+        return format_error(400, "template_id is required", method='POST')
+
+    now = datetime.utcnow()
+    try:
+        from_ts = parse_day(body.get('from') or (now - timedelta(days=7)).date().isoformat())
+        to_ts = parse_day(body.get('to') or now.date().isoformat(), end_of_day=True)
+    except ValueError:
+        return format_error(400, "from/to must be ISO dates, e.g. 2025-01-31", method='POST')
+
+    backend = body.get('backend', 'ondemand')
+    if backend not in ('ondemand', 'batch'):
+        return format_error(400, "backend must be 'ondemand' or 'batch'", method='POST')
+    if backend == 'batch' and not BATCH_ROLE_ARN:
+        return format_error(400, "Batch inference is not configured", method='POST')
+
+    try:
+        concurrency = max(1, min(int(body.get('concurrency', DEFAULT_CONCURRENCY)), MAX_CONCURRENCY))
+    except (ValueError, TypeError):
+        concurrency = DEFAULT_CONCURRENCY
+
+    # get_template falls back to default SOAP; regenerating with it would overwrite notes
+    try:
+        template = find_template(template_id)
+    except Exception as e:
+        return format_error(500, "Failed to fetch template", internal_error=e, method='POST')
+    if template is None:
+        return format_error(404, "Template not found", method='POST')
+
+    regeneration_id = uuid.uuid4().hex
+    job = {
+        'job_id': regeneration_id,
+        'kind': 'regeneration',
+        'status': 'queued',
+        'backend': backend,
+        'template_id': template_id,
+        'from_ts': from_ts,
+        'to_ts': to_ts,
+        'provider_user_id': body.get('user_id'),
+        'concurrency': concurrency,
+        'requested_by': user_info['email'],
+        'total': None,
+        'succeeded': 0,
+        'failed': 0,
+        'skipped': 0,
+        'errors': [],
+        'invocations': 0,
+        'created_at': now.isoformat(),
+        'updated_at': now.isoformat(),
+        'ttl': int((now + timedelta(days=JOB_TTL_DAYS)).timestamp())
+    }
+
+    try:
+        jobs_table.put_item(Item=job)
+        invoke_self(context, regeneration_id)
+    except Exception as e:
+        return format_error(500, "Failed to start regeneration", internal_error=e, method='POST')
+
+    return format_response(202, {
+        'regeneration_id': regeneration_id,
+        'status': 'queued',
+        'backend': backend
+    }, method='POST')
+
+
+def get_regeneration(regeneration_id, event, context):
+    job = load_job(regeneration_id)
+    if not job or job.get('kind') != 'regeneration':
+        return format_error(404, "Regeneration not found")
+
+    if job.get('status') == 'submitted':
+        job = check_batch(job, context)
+
+    succeeded, failed, skipped = (int(job.get(k, 0)) for k in ('succeeded', 'failed', 'skipped'))
+    total = job.get('total')
+    result = {
+        'regeneration_id': regeneration_id,
+        'status': job['status'],
+        'backend': job['backend'],
+        'template_id': job['template_id'],
+        'from': job['from_ts'],
+        'to': job['to_ts'],
+        'total': int(total) if total is not None else None,
+        'succeeded': succeeded,
+        'failed': failed,
+        'skipped': skipped,
+        'percent': round(100.0 * (succeeded + failed + skipped) / int(total), 1) if total else None,
+        'errors': job.get('errors', []),
+        'error': job.get('error'),
+        'batch_status': job.get('batch_status'),
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at']
+    }
+    return format_response(200, result, event=event)
+
+
+# ========================================
+# Job state
+# ========================================
+
+def load_job(regeneration_id):
+    return jobs_table.get_item(Key={'job_id': regeneration_id}, ConsistentRead=True).get('Item')
+
+
+def update_progress(regeneration_id, counts=None, errors=None, **fields):
+    """Atomically add to the counters and set any other fields"""
+    fields['updated_at'] = datetime.utcnow().isoformat()
+    names = {f"#{k}": k for k in fields}
+    values = {f":{k}": v for k, v in fields.items()}
+    expression = 'SET ' + ', '.join(f"#{k} = :{k}" for k in fields)
+
+    if errors:
+        names['#errors'] = 'errors'
+        values[':errors'] = errors
+        values[':none'] = []
+        expression += ', #errors = list_append(if_not_exists(#errors, :none), :errors)'
+
+    adds = {k: v for k, v in (counts or {}).items() if v}
+    if adds:
+        names.update({f"#{k}": k for k in adds})
+        values.update({f":add_{k}": v for k, v in adds.items()})
+        expression += ' ADD ' + ', '.join(f"#{k} :add_{k}" for k in adds)
+
+    jobs_table.update_item(
+        Key={'job_id': regeneration_id},
+        UpdateExpression=expression,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def invoke_self(context, regeneration_id, step='run'):
+    lambda_client.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'regeneration_id': regeneration_id, 'step': step})
+    )
+
+
+# ========================================
+# Note selection
+# ========================================
+
+def selection(job):
+    """Query/scan arguments selecting the job's notes"""
+    template = Attr('template_id').eq(job['template_id'])
+    if job.get('provider_user_id'):
+        return 'query', {
+            'KeyConditionExpression': Key('user_id').eq(job['provider_user_id'])
+                                      & Key('timestamp').between(job['from_ts'], job['to_ts']),
+            'FilterExpression': template
+        }
+    return 'scan', {'FilterExpression': template & Attr('timestamp').between(job['from_ts'], job['to_ts'])}
+
+
+def read_pages(job, start_key=None):
+    """Yield (notes, last_evaluated_key) for the job's selection"""
+    operation, kwargs = selection(job)
+    kwargs['Limit'] = PAGE_SIZE
+    last_key = start_key
+    while True:
+        if last_key:
+            kwargs['ExclusiveStartKey'] = last_key
+        response = getattr(notes_table, operation)(**kwargs)
+        last_key = response.get('LastEvaluatedKey')
+        yield response.get('Items', []), last_key
+        if not last_key:
+            return
+
+
+def count_notes(job):
+    operation, kwargs = selection(job)
+    kwargs['Select'] = 'COUNT'
+    total = 0
+    while True:
+        response = getattr(notes_table, operation)(**kwargs)
+        total += response.get('Count', 0)
+        if not response.get('LastEvaluatedKey'):
+            return total
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def skip_reason(note, regeneration_id):
+    if note.get('regeneration_id') == regeneration_id:
+        return 'already regenerated'
+    if note.get('archive_ref'):
+        # Archived notes only keep a stub in the table
+        return 'archived'
+    if not note.get('transcript'):
+        return 'no transcript'
+    return None
+
+
+# ========================================
+# On-demand backend
+# ========================================
+
+def regenerate_note(note, template, regeneration_id):
+    """Returns ('succeeded' | 'skipped' | 'failed', detail)"""
+    reason = skip_reason(note, regeneration_id)
+    if reason:
+        return 'skipped', reason
+
+    note_id = f"{note['user_id']}#{note['timestamp']}"
+    for attempt in range(1, NOTE_ATTEMPTS + 1):
+        try:
+            meter = Meter()
+            soap_note, cached, key = generate_cached(
+                note['user_id'], template, note['transcript'], note.get('patient_name', 'UNKNOWN'), meter=meter
+            )
+            # Bill the regeneration to the note's owner, overlapping the version write
+            rollups = Rollups(meter, note['user_id'], note.get('practice_id'), cached=cached)
+            try:
+                if not cached and cacheable(meter):
+                    put_cached(key, soap_note)
+                written = write_version(note, template, soap_note, regeneration_id=regeneration_id,
+                                        regenerated_at=datetime.utcnow().isoformat())
+            finally:
+                rollups.wait()
+            if not written:
+                return 'skipped', 'changed during regeneration'
+            return 'succeeded', None
+        except Exception as e:
+            # Bedrock is saturated: back off and give it another go while time allows
+            transient = is_retryable(e) or type(e).__name__ in ('CircuitOpenError', 'RateLimitedError')
+            if not transient or attempt == NOTE_ATTEMPTS or not has_time_for(NOTE_RETRY_SECONDS * attempt):
+                print(f"Regeneration {regeneration_id}: note {note_id} failed: {str(e)}")
+                return 'failed', {'note_id': note_id, 'error': type(e).__name__}
+            time.sleep(NOTE_RETRY_SECONDS * attempt)
+
+
+def job_template(job):
+    """The job's template; one deleted since the job started fails the job instead of falling back"""
+    template = find_template(job['template_id'])
+    if template is None:
+        raise LookupError(f"Template {job['template_id']} not found")
+    return template
+
+
+def run_ondemand(job, context):
+    """Regenerate page by page until done or out of time. Returns True when complete."""
+    regeneration_id = job['job_id']
+    template = job_template(job)
+    if context is not None:
+        deadline = time.time() + (context.get_remaining_time_in_millis() - SAFETY_MARGIN_MS) / 1000
+    else:
+        deadline = float('inf')
+
+    reported = len(job.get('errors', []))
+
+    with ThreadPoolExecutor(max_workers=int(job.get('concurrency', DEFAULT_CONCURRENCY))) as pool:
+        for notes, last_key in read_pages(job, job.get('last_key')):
+            resolve_bodies(notes, fields=('transcript', 'soap_note'))
+            outcomes = list(pool.map(lambda n: regenerate_note(n, template, regeneration_id), notes))
+
+            counts = {k: sum(1 for status, _ in outcomes if status == k)
+                      for k in ('succeeded', 'failed', 'skipped')}
+            errors = [detail for status, detail in outcomes if status == 'failed'][:MAX_REPORTED_ERRORS - reported]
+            reported += len(errors)
+            # The checkpoint only moves once the whole page is written
+            update_progress(regeneration_id, counts, errors, last_key=last_key)
+
+            if last_key and time.time() >= deadline:
+                return False
+    return True
+
+
+# ========================================
+# Batch-inference backend
+# ========================================
+
+def batch_key(regeneration_id, name):
+    return f"regenerations/{regeneration_id}/{name}"
+
+
+def batch_record(note, template, index):
+    """One batch-inference input line; recordId indexes the stored note map"""
+    prompt = prepare_prompt(template, note['transcript'], note.get('patient_name', 'UNKNOWN'))
+    model_input = json.loads(build_bedrock_body(prompt, BATCH_MODEL_ID))
+    # Prompt caching markers aren't meaningful in batch jobs
+    for block in model_input['system']:
+        block.pop('cache_control', None)
+    return {'recordId': f"{index:011d}", 'modelInput': model_input}
+
+
+def submit_batch(job):
+    """Write the JSONL input and submit the job. Returns False if too small for batch."""
+    regeneration_id = job['job_id']
+    template = job_template(job)
+    lines = []
+    records = []
+    skipped = 0
+
+    for notes, _ in read_pages(job):
+        resolve_bodies(notes, fields=('transcript',))
+        for note in notes:
+            if skip_reason(note, regeneration_id):
+                skipped += 1
+                continue
+            lines.append(json.dumps(batch_record(note, template, len(records)), separators=(',', ':')))
+            records.append({'user_id': note['user_id'], 'timestamp': note['timestamp'],
+                            'version': int(note.get('version', 1))})
+
+    if len(records) < BATCH_MIN_RECORDS:
+        print(f"Regeneration {regeneration_id}: {len(records)} notes is below the batch minimum, "
+              f"running on demand")
+        return False
+
+    s3.put_object(Bucket=REGENERATION_BUCKET, Key=batch_key(regeneration_id, 'records.json'),
+                  Body=json.dumps(records).encode('utf-8'), ServerSideEncryption='aws:kms')
+    s3.put_object(Bucket=REGENERATION_BUCKET, Key=batch_key(regeneration_id, 'input/notes.jsonl'),
+                  Body='\n'.join(lines).encode('utf-8'), ServerSideEncryption='aws:kms')
+
+    response = bedrock_control.create_model_invocation_job(
+        jobName=f"regen-{regeneration_id}",
+        roleArn=BATCH_ROLE_ARN,
+        modelId=BATCH_MODEL_ID,
+        inputDataConfig={'s3InputDataConfig': {
+            's3Uri': f"s3://{REGENERATION_BUCKET}/{batch_key(regeneration_id, 'input/')}",
+            's3InputFormat': 'JSONL'
+        }},
+        outputDataConfig={'s3OutputDataConfig': {
+            's3Uri': f"s3://{REGENERATION_BUCKET}/{batch_key(regeneration_id, 'output/')}"
+        }}
+    )
+    update_progress(regeneration_id, {'skipped': skipped}, status='submitted',
+                    batch_job_arn=response['jobArn'], batch_status='Submitted')
+    return True
+
+
+def check_batch(job, context):
+    """Refresh the Bedrock job status; start ingestion once it has finished"""
+    try:
+        status = bedrock_control.get_model_invocation_job(jobIdentifier=job['batch_job_arn'])['status']
+    except Exception as e:
+        print(f"Error reading batch job status: {str(e)}")
+        return job
+
+    if status in BATCH_DONE_STATUSES + BATCH_FAILED_STATUSES:
+        claim_ingestion(job, status, context)
+    elif status != job.get('batch_status'):
+        update_progress(job['job_id'], batch_status=status)
+    job['batch_status'] = status
+    return job
+
+
+def claim_ingestion(job, status, context):
+    """Move submitted -> ingesting exactly once (GET and EventBridge may both notice)"""
+    failed = status in BATCH_FAILED_STATUSES
+    try:
+        jobs_table.update_item(
+            Key={'job_id': job['job_id']},
+            UpdateExpression='SET #status = :next, batch_status = :batch_status, updated_at = :now',
+            ConditionExpression='#status = :submitted',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':next': 'failed' if failed else 'ingesting',
+                ':batch_status': status,
+                ':now': datetime.utcnow().isoformat(),
+                ':submitted': 'submitted'
+            }
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return
+        raise
+
+    job['status'] = 'failed' if failed else 'ingesting'
+    if not failed:
+        invoke_self(context, job['job_id'], step='ingest')
+
+
+def output_lines(regeneration_id):
+    """Parsed lines of every *.jsonl.out file the batch job wrote"""
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=REGENERATION_BUCKET, Prefix=batch_key(regeneration_id, 'output/')):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('.jsonl.out'):
+                continue
+            body = s3.get_object(Bucket=REGENERATION_BUCKET, Key=obj['Key'])['Body'].read().decode('utf-8')
+            for line in body.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+def ingest_record(line, records, template, regeneration_id):
+    record = records[int(line['recordId'])]
+    note_id = f"{record['user_id']}#{record['timestamp']}"
+    output = line.get('modelOutput') or {}
+    if line.get('error') or not output.get('content'):
+        return 'failed', {'note_id': note_id, 'error': str((line.get('error') or {}).get('errorMessage', 'no output'))}
+    if output.get('stop_reason') == 'max_tokens':
+        return 'failed', {'note_id': note_id, 'error': 'truncated'}
+
+    note = notes_table.get_item(Key={'user_id': record['user_id'], 'timestamp': record['timestamp']}).get('Item')
+    if not note or int(note.get('version', 1)) != record['version']:
+        return 'skipped', 'changed since submission'
+    resolve_bodies([note], fields=('soap_note',))
+
+    soap_note = sanitize_note(output['content'][0]['text'])
+    meter = Meter()
+    meter.add_call(BATCH_MODEL_ID, output.get('usage'), 0)
+    rollups = Rollups(meter, note['user_id'], note.get('practice_id'))
+    try:
+        written = write_version(note, template, soap_note, regeneration_id=regeneration_id,
+                                regenerated_at=datetime.utcnow().isoformat())
+    finally:
+        rollups.wait()
+    if not written:
+        return 'skipped', 'changed during regeneration'
+    return 'succeeded', None
+
+
+def ingest_batch(job):
+    regeneration_id = job['job_id']
+    template = job_template(job)
+    response = s3.get_object(Bucket=REGENERATION_BUCKET, Key=batch_key(regeneration_id, 'records.json'))
+    records = json.loads(response['Body'].read())
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        outcomes = list(pool.map(lambda line: ingest_record(line, records, template, regeneration_id),
+                                 output_lines(regeneration_id)))
+
+    counts = {k: sum(1 for status, _ in outcomes if status == k) for k in ('succeeded', 'failed', 'skipped')}
+    # Records the job never answered
+    counts['failed'] += len(records) - len(outcomes)
+    errors = [d for s, d in outcomes if s == 'failed'][:MAX_REPORTED_ERRORS]
+    update_progress(regeneration_id, counts, errors, status='complete')
+
+
+def on_batch_state_change(detail, context):
+    name = detail.get('batchJobName', '')
+    if not name.startswith('regen-'):
+        return {'ignored': name}
+    job = load_job(name[len('regen-'):])
+    if job and job.get('status') == 'submitted':
+        check_batch(job, context)
+    return {'regeneration_id': name[len('regen-'):]}
+
+
+# ========================================
+# Runner
+# ========================================
+
+def run_regeneration(regeneration_id, context, step='run'):
+    job = load_job(regeneration_id)
+    if not job or job.get('status') in ('complete', 'failed'):
+        return {'regeneration_id': regeneration_id, 'status': job and job.get('status')}
+
+    try:
+        if step == 'ingest':
+            ingest_batch(job)
+            return {'regeneration_id': regeneration_id, 'status': 'complete'}
+
+        update_progress(regeneration_id, {'invocations': 1}, status='running')
+        if job.get('total') is None:
+            job['total'] = count_notes(job)
+            update_progress(regeneration_id, total=job['total'])
+
+        if job['backend'] == 'batch' and not job.get('last_key'):
+            if submit_batch(job):
+                return {'regeneration_id': regeneration_id, 'status': 'submitted'}
+            update_progress(regeneration_id, backend='ondemand')
+
+        if not run_ondemand(job, context):
+            # Out of time - continue from the checkpoint in a fresh invocation
+            invoke_self(context, regeneration_id)
+            return {'regeneration_id': regeneration_id, 'status': 'running'}
+
+        update_progress(regeneration_id, status='complete')
+        return {'regeneration_id': regeneration_id, 'status': 'complete'}
+
+    except Exception as e:
+        print(f"Regeneration {regeneration_id} failed: {str(e)}")
+        update_progress(regeneration_id, status='failed', error='Regeneration stopped unexpectedly')
+        return {'regeneration_id': regeneration_id, 'status': 'failed'}
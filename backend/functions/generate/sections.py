@@ -0,0 +1,193 @@
+# functions/generate/sections.py
+"""
+Per-section note generation.
+
+Template examples are plain text with ALL-CAPS "HEADER:" lines. In section
+mode each section is generated by its own, smaller Bedrock call - all of them
+concurrently - and the results are stitched back together in template order.
+Output tokens dominate latency, so N parallel calls of ~1/N the length finish
+several times sooner than one long call.
+"""
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# "SUBJECTIVE:", "HISTORY OF PRESENT ILLNESS:", "TREATMENT PROVIDED:"
+SECTION_HEADER_RE = re.compile(r"^[ \t]*([A-Z][A-Z0-9 /&(),'-]{1,60}):[ \t]*$")
+
+MIN_SECTION_TOKENS = 300
+MAX_SECTION_WORKERS = 8
+
+
+def parse_sections(example_output):
+    """
+    Split a template example into [(header, example_body), ...] in order.
+    Text before the first header is ignored. Returns [] if there are no headers.
+    """
+    sections = []
+    header = None
+    lines = []
+    for line in (example_output or '').splitlines():
+        match = SECTION_HEADER_RE.match(line)
+        if match:
+            if header:
+                sections.append((header, '\n'.join(lines).strip()))
+            header = match.group(1).strip()
+            lines = []
+        elif header:
+            lines.append(line)
+    if header:
+        sections.append((header, '\n'.join(lines).strip()))
+    return sections
+
+
+def section_budgets(sections, total_tokens):
+    """
+    Split the output-token budget by how long each example section is. Every
+    section gets at least MIN_SECTION_TOKENS (or an even share when the budget
+    can't cover that many floors), and the shares above the floor are scaled
+    down so the budgets never add up to more than total_tokens.
+    """
+    weights = [max(len(body), 1) for _, body in sections]
+    total_weight = sum(weights)
+    budgets = [max(MIN_SECTION_TOKENS, total_tokens * w // total_weight) for w in weights]
+    if sum(budgets) <= total_tokens:
+        return budgets
+
+    floor = min(MIN_SECTION_TOKENS, total_tokens // len(sections))
+    room = total_tokens - floor * len(sections)
+    above = [b - floor for b in budgets]
+    total_above = sum(above)
+    return [floor + (a * room // total_above if total_above else 0) for a in above]
+
+
+def build_section_prompt(base_prompt, header, headers, patient_name, max_tokens):
+    """
+    Reuse the full-note system prompt (so every section call shares one cached
+    prefix) and ask for a single section in the user message.
+    """
+    others = ', '.join(h for h in headers if h != header)
+    user = (f"Write ONLY the \"{header}:\" section of the note for patient \"{patient_name}\", "
+            f"following the example format for that section. Start with the line \"{header}:\" "
+            f"and stop at the end of this section. Do not write the other sections ({others}); "
+            f"they are generated separately.\n\n{base_prompt['user']}")
+    # Stop as soon as the model starts another section
+    stop_sequences = [f"\n{h}:" for h in headers if h != header] + base_prompt.get('stop_sequences', [])
+    return {'system': base_prompt['system'], 'user': user, 'max_tokens': max_tokens,
+            'stop_sequences': stop_sequences, 'route': base_prompt.get('route'), 'meter': base_prompt.get('meter')}
+
+
+def clean_section(text, header, headers):
+    """Drop a repeated header line and anything the model wrote past its own section"""
+    lines = (text or '').strip().splitlines()
+    if lines:
+        match = SECTION_HEADER_RE.match(lines[0])
+        if match and match.group(1).strip().upper() == header.upper():
+            lines = lines[1:]
+
+    other_headers = {h.upper() for h in headers if h != header}
+    for i, line in enumerate(lines):
+        match = SECTION_HEADER_RE.match(line)
+        if match and match.group(1).strip().upper() in other_headers:
+            lines = lines[:i]
+            break
+
+    body = '\n'.join(lines).strip()
+    return f"{header}:\n{body}" if body else f"{header}:"
+
+
+def generate_sections(base_prompt, sections, patient_name, invoke, total_tokens):
+    """
+    Generate every section concurrently and stitch them in template order.
+    `invoke(prompt)` returns (text, usage); any failure propagates. Returns
+    (note, usage) with the output tokens summed over the sections.
+    """
+    headers = [header for header, _ in sections]
+    budgets = section_budgets(sections, total_tokens)
+    started = time.time()
+
+    def run(index):
+        section_started = time.time()
+        prompt = build_section_prompt(base_prompt, headers[index], headers, patient_name, budgets[index])
+        text, usage = invoke(prompt)
+        return clean_section(text, headers[index], headers), int((time.time() - section_started) * 1000), usage
+
+    with ThreadPoolExecutor(max_workers=min(MAX_SECTION_WORKERS, len(sections))) as pool:
+        results = list(pool.map(run, range(len(sections))))
+
+    section_ms = [ms for _, ms, _ in results]
+    print(f"Sectioned generation: sections={len(sections)} slowest_section_ms={max(section_ms)} "
+          f"sum_section_ms={sum(section_ms)} wall_ms={int((time.time() - started) * 1000)}")
+
+    usage = {
+        'output_tokens': sum(u.get('output_tokens') or 0 for _, _, u in results),
+        'stop_reason': 'max_tokens' if any(u.get('stop_reason') == 'max_tokens' for _, _, u in results) else None
+    }
+    return '\n\n'.join(text for text, _, _ in results), usage
+
+
+# ========================================
+# Section edits of an existing note
+# ========================================
+
+def split_note(note):
+    """
+    Split a generated note into [(header or None, text), ...] covering every
+    line, so joining the texts gives back the note. Text before the first
+    header has header None.
+    """
+    blocks = []
+    header = None
+    lines = []
+    for line in (note or '').splitlines():
+        match = SECTION_HEADER_RE.match(line)
+        if match:
+            if lines or header:
+                blocks.append((header, '\n'.join(lines)))
+            header = match.group(1).strip()
+            lines = [line]
+        else:
+            lines.append(line)
+    if lines or header:
+        blocks.append((header, '\n'.join(lines)))
+    return blocks
+
+
+def find_section(blocks, header):
+    """Index of the block whose header matches (case-insensitive), or None"""
+    wanted = ' '.join((header or '').rstrip(':').split()).upper()
+    for i, (name, _) in enumerate(blocks):
+        if name and name.upper() == wanted:
+            return i
+    return None
+
+
+def splice_section(blocks, index, section_text):
+    """The note with block `index` replaced, keeping the blank lines around it"""
+    old = blocks[index][1]
+    trailing = old[len(old.rstrip('\n')):]
+    texts = [text for _, text in blocks]
+    texts[index] = section_text.strip('\n') + trailing
+    return '\n'.join(texts)
+
+
+def edit_budget(section_tokens, addition_tokens, max_tokens):
+    """Output tokens for rewriting one section: its length plus room for the addition"""
+    return min(max_tokens, max(MIN_SECTION_TOKENS, int(1.5 * (section_tokens + addition_tokens)) + 100))
+
+
+def build_section_edit_prompt(base_prompt, header, headers, note, new_information, patient_name, max_tokens):
+    """
+    Rewrite one section of an existing note. Reuses the template's system
+    prompt (same cached prefix as full generation); the output is only the
+    section, so it costs tokens in proportion to the section, not the note.
+    """
+    user = (f"Below is the current note for patient \"{patient_name}\" and new information from the "
+            f"clinician.\n\nRewrite ONLY the \"{header}:\" section so it includes the new information. "
+            f"Keep everything in that section that the new information does not change, in the same "
+            f"style as the example. Start with the line \"{header}:\" and stop at the end of this "
+            f"section. Do not write any other section.\n\n"
+            f"CURRENT NOTE:\n{note}\n\nNEW INFORMATION:\n{new_information}")
+    stop_sequences = [f"\n{h}:" for h in headers if h.upper() != header.upper()] + base_prompt.get('stop_sequences', [])
+    return {'system': base_prompt['system'], 'user': user, 'max_tokens': max_tokens,
+            'stop_sequences': stop_sequences, 'route': base_prompt.get('route'), 'meter': base_prompt.get('meter')}
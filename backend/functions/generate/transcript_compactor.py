@@ -0,0 +1,216 @@
+# functions/generate/transcript_compactor.py
+"""
+Deterministic transcript compaction before generation.
+
+Deepgram output (smart_format) still carries disfluencies, cross-talk echoes and
+social small talk, all of which are billed as input tokens. Three passes, each
+conservative about clinical content:
+
+1. Fillers: "um", "uh", "erm", comma-delimited "you know" / "I mean" / "like",
+   and stuttered function words ("I I I think"). Affirmations such as "mm-hmm"
+   and "uh-huh" are answers, not filler, and are kept.
+2. Duplicates: a sentence of MIN_DEDUPE_WORDS+ words that repeats one of the
+   last DEDUPE_WINDOW sentences exactly is dropped, as is a fragment that the
+   next sentence restates in full - but only within one turn or against the
+   turn right before it (a cross-talk echo). A question asked again after the
+   other speaker answered is a new question: dropping it would attach the
+   second answer to whatever came before. Near duplicates are only dropped
+   when neither sentence is clinical - "lower left" vs "lower right" or
+   "buccal" vs "lingual" differ by one word and both findings matter. Short
+   sentences ("Yes.", "No.") are never deduplicated - they answer different
+   questions.
+3. Small talk: a run of CHITCHAT_MIN_SENTENCES+ consecutive sentences that
+   have a small-talk marker (or are short acknowledgements) and no clinical
+   term, number or negation is replaced by one "[small talk omitted]" line.
+
+compact() returns the text plus the token counts saved (local estimate).
+"""
+import re
+
+from long_transcript import SENTENCE_RE, SPEAKER_RE, estimate_tokens, split_turns
+
+# Bump when the rules change: part of the generation cache key
+COMPACTION_VERSION = 'compact-v3'
+
+MIN_DEDUPE_WORDS = 4
+DEDUPE_WINDOW = 6
+NEAR_DUPLICATE_SIMILARITY = 0.85
+CHITCHAT_MIN_SENTENCES = 3
+ACK_MAX_WORDS = 5
+CHITCHAT_PLACEHOLDER = '[small talk omitted]'
+
+# Not "er": Deepgram writes the emergency room as "ER"
+FILLER_RE = re.compile(r"(?i)(?:^|(?<=[\s,.;!?]))(?:u+m+|u+h+|e+rm+|a+h+|h+m+)(?:[,.]+|(?=\s)|$)\s*")
+# Discourse markers only when set off by commas - "I mean the lower left" stays
+HEDGE_RE = re.compile(r"(?i),\s*(?:you know|i mean|like|sort of|kind of|basically)\s*,")
+STUTTER_RE = re.compile(
+    r"(?i)\b(i|a|the|and|so|we|it|to|you|my|it's|this|but|or)(?:[\s,]+\1\b)+"
+)
+SPACE_RE = re.compile(r"[ \t]{2,}")
+LEADING_JUNK_RE = re.compile(r"^[\s,;]+")
+WORD_RE = re.compile(r"[a-z0-9']+")
+
+# Matched at the start of a word, so prefixes cover inflections ("bleed" ->
+# "bleeding") without "eat" matching "weather"
+CLINICAL_RE = re.compile(r"(?i)\b(?:" + '|'.join([
+    'tooth', 'teeth', 'molar', 'premolar', 'incisor', 'canine', 'gum', 'gingiv', 'perio', 'pocket',
+    'bleed', 'blood', 'pain', 'hurt', 'ach', 'sore', 'sensitiv', 'swell', 'swollen', 'numb', 'throb',
+    'cavit', 'caries', 'decay', 'filling', 'crown', 'bridge', 'implant', 'root', 'canal', 'extract',
+    'floss', 'brush', 'rinse', 'fluoride', 'plaque', 'tartar', 'calculus', 'clean', 'scal',
+    'x-ray', 'xray', 'radiograph', 'scan', 'bit', 'jaw', 'tmj', 'grind', 'clench', 'guard',
+    'mouth', 'tongue', 'lip', 'cheek', 'palate', 'lesion', 'ulcer', 'abscess', 'infect', 'fever',
+    'medic', 'pill', 'prescri', 'antibiotic', 'ibuprofen', 'advil', 'tylenol', 'dose', 'mg',
+    'allerg', 'diabet', 'pregnan', 'heart', 'pressure', 'surgery', 'smok', 'vap', 'alcohol',
+    'anesthe', 'lidocaine', 'upper', 'lower', 'left', 'right', 'front', 'back', 'side',
+    'hot', 'cold', 'sweet', 'chew', 'eat', 'drink', 'sleep', 'appointment', 'follow', 'schedul',
+    'insurance', 'symptom', 'history', r'weeks?\b', r'months?\b', r'days?\b', 'since', 'yesterday'
+]) + ")")
+NEGATION_RE = re.compile(r"(?i)\b(?:no|not|never|none|don't|doesn't|didn't|can't|won't|haven't|hasn't)\b")
+SMALL_TALK_TERMS = (
+    'weather', 'rain', 'sunny', 'weekend', 'vacation', 'holiday', 'trip', 'game', 'team', 'season',
+    'traffic', 'parking', 'kids', 'grandkids', 'family', 'dog', 'cat', 'movie', 'show', 'restaurant',
+    'christmas', 'thanksgiving', 'birthday', 'wedding', 'school', 'job', 'work', 'busy', 'how are you',
+    'nice to see', 'good to see', 'how have you been', 'beautiful', 'congrat'
+)
+
+
+def strip_fillers(sentence):
+    """Returns (cleaned sentence, fillers removed)"""
+    cleaned, fillers = FILLER_RE.subn('', sentence)
+    cleaned, hedges = HEDGE_RE.subn(' ', cleaned)
+    cleaned, stutters = STUTTER_RE.subn(r'\1', cleaned)
+    cleaned = LEADING_JUNK_RE.sub('', SPACE_RE.sub(' ', cleaned)).strip()
+    if cleaned and cleaned[0].islower() and sentence[:1].isupper():
+        cleaned = cleaned[0].upper() + cleaned[1:]
+    return cleaned, fillers + hedges + stutters
+
+
+def words(sentence):
+    return WORD_RE.findall(sentence.lower())
+
+
+def similarity(a, b):
+    """Dice coefficient over word bigrams (order-aware, cheap)"""
+    if a == b:
+        return 1.0
+    pairs_a = set(zip(a, a[1:]))
+    pairs_b = set(zip(b, b[1:]))
+    if not pairs_a or not pairs_b:
+        return 0.0
+    return 2 * len(pairs_a & pairs_b) / (len(pairs_a) + len(pairs_b))
+
+
+def is_clinical(sentence):
+    lowered = sentence.lower()
+    return (any(ch.isdigit() for ch in lowered) or NEGATION_RE.search(lowered) is not None
+            or CLINICAL_RE.search(lowered) is not None)
+
+
+def is_adjacent(sentence, earlier):
+    """Same turn or the one right before it: no other turn in between"""
+    return sentence['turn'] - earlier['turn'] <= 1
+
+
+def is_duplicate(sentence, earlier):
+    """Exact repeat, or a near repeat when neither sentence carries clinical content"""
+    if not is_adjacent(sentence, earlier):
+        return False
+    if sentence['words'] == earlier['words']:
+        return True
+    if is_clinical(sentence['text']) or is_clinical(earlier['text']):
+        return False
+    return similarity(sentence['words'], earlier['words']) >= NEAR_DUPLICATE_SIMILARITY
+
+
+def is_small_talk(sentence):
+    lowered = sentence.lower()
+    return not is_clinical(lowered) and any(term in lowered for term in SMALL_TALK_TERMS)
+
+
+def split_units(transcript):
+    """[(speaker prefix or '', [sentences])] per turn"""
+    units = []
+    for turn in split_turns(transcript):
+        text = ' '.join(line.strip() for line in turn.splitlines())
+        match = SPEAKER_RE.match(text)
+        prefix = match.group(0).strip() if match else ''
+        body = text[match.end():] if match else text
+        units.append((prefix, [s for s in SENTENCE_RE.split(body) if s.strip()]))
+    return units
+
+
+def compact(transcript):
+    """
+    Returns (compacted transcript, stats). stats: original_tokens,
+    compacted_tokens, tokens_saved, fillers, duplicates, small_talk_sentences.
+    """
+    stats = {'fillers': 0, 'duplicates': 0, 'small_talk_sentences': 0}
+    original_tokens = estimate_tokens(transcript or '')
+    if not transcript or not transcript.strip():
+        stats.update(original_tokens=original_tokens, compacted_tokens=original_tokens, tokens_saved=0)
+        return transcript, stats
+
+    # Flatten to sentences tagged with their turn, cleaning fillers as we go
+    sentences = []
+    for turn_index, (prefix, turn_sentences) in enumerate(split_units(transcript)):
+        for sentence in turn_sentences:
+            cleaned, removed = strip_fillers(sentence)
+            stats['fillers'] += removed
+            if WORD_RE.search(cleaned.lower()):
+                sentences.append({'turn': turn_index, 'prefix': prefix, 'text': cleaned, 'words': words(cleaned)})
+
+    # Exact / near duplicates and restated fragments
+    kept = []
+    for sentence in sentences:
+        if len(sentence['words']) >= MIN_DEDUPE_WORDS:
+            recent = kept[-DEDUPE_WINDOW:]
+            if any(is_duplicate(sentence, k) for k in recent):
+                stats['duplicates'] += 1
+                continue
+            previous = kept[-1] if kept else None
+            if (previous and is_adjacent(sentence, previous) and len(previous['words']) >= 2
+                    and len(previous['words']) < len(sentence['words'])
+                    and sentence['words'][:len(previous['words'])] == previous['words']):
+                # "Let's take a" followed by "Let's take a look at the upper left."
+                kept.pop()
+                stats['duplicates'] += 1
+        kept.append(sentence)
+
+    # Collapse small-talk runs
+    result = []
+    run = []
+
+    def flush_run():
+        if len(run) >= CHITCHAT_MIN_SENTENCES:
+            stats['small_talk_sentences'] += len(run)
+            result.append({'turn': run[0]['turn'], 'prefix': '', 'text': CHITCHAT_PLACEHOLDER})
+        else:
+            result.extend(run)
+        run.clear()
+
+    for sentence in kept:
+        # Short acknowledgements ("Yeah.", "Oh nice.") don't break a run
+        if is_small_talk(sentence['text']) or (run and not is_clinical(sentence['text'])
+                                               and len(sentence['words']) <= ACK_MAX_WORDS):
+            run.append(sentence)
+            continue
+        flush_run()
+        result.append(sentence)
+    flush_run()
+
+    # Reassemble turns (speaker prefix on the first surviving sentence)
+    lines = []
+    current_turn = None
+    for sentence in result:
+        if sentence['turn'] != current_turn or sentence['text'] == CHITCHAT_PLACEHOLDER:
+            prefix = sentence['prefix'] if sentence['turn'] != current_turn else ''
+            lines.append(f"{prefix} {sentence['text']}".strip())
+            current_turn = sentence['turn'] if sentence['text'] != CHITCHAT_PLACEHOLDER else None
+        else:
+            lines[-1] += ' ' + sentence['text']
+
+    compacted = '\n'.join(lines)
+    compacted_tokens = estimate_tokens(compacted)
+    stats.update(original_tokens=original_tokens, compacted_tokens=compacted_tokens,
+                 tokens_saved=original_tokens - compacted_tokens)
+    return compacted, stats
@@ -0,0 +1,173 @@
+# functions/generate/worker.py
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from bedrock_guard import set_deadline
+from body_store import resolve_bodies
+from handler import (
+    GENERATION_QUEUE_URL, sqs, jobs_table, get_template, generate_cached, persist_note,
+    note_result, update_job
+)
+from metering import Meter
+
+# Must match maxReceiveCount on the queue's redrive policy; the last attempt
+# marks the job failed before SQS moves the message to the dead-letter queue.
+MAX_ATTEMPTS = int(os.environ.get('GENERATION_MAX_ATTEMPTS', '3'))
+RETRY_BASE_SECONDS = 10
+# Must match the queue's VisibilityTimeout: a 'running' claim older than this
+# belongs to a worker that died, and its message is visible again
+VISIBILITY_TIMEOUT_SECONDS = int(os.environ.get('GENERATION_VISIBILITY_SECONDS', '1080'))
+
+
+class JobClaimed(Exception):
+    """Another delivery of the message is running the job"""
+
+
+def claim_job(job_id, attempt):
+    """
+    Mark the job running unless it is finished or a live worker already has it.
+    Raises JobClaimed when another worker does; returns False when it finished.
+    """
+    now = datetime.utcnow()
+    try:
+        jobs_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET #status = :running, attempts = :attempt, started_at = :now',
+            ConditionExpression='NOT #status IN (:running, :complete, :failed) '
+                                'OR (#status = :running AND started_at < :stale)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':running': 'running', ':complete': 'complete', ':failed': 'failed',
+                ':attempt': attempt, ':now': now.isoformat(),
+                ':stale': (now - timedelta(seconds=VISIBILITY_TIMEOUT_SECONDS)).isoformat()
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+
+    job = jobs_table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item') or {}
+    if job.get('status') in ('complete', 'failed'):
+        return False
+    raise JobClaimed(f"Generation job {job_id} is running elsewhere (since {job.get('started_at')})")
+
+
+def retry_delay(attempt):
+    """Exponential backoff before the message becomes visible again"""
+    return min(RETRY_BASE_SECONDS * (2 ** (attempt - 1)), 300)
+
+
+def process_job(job_id, attempt, requested_at=None):
+    """Run one queued generation. Raises so SQS redelivers on failure."""
+    job = jobs_table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item')
+    if not job:
+        print(f"Generation job {job_id} not found (expired?)")
+        return
+
+    # Duplicate delivery of a job that already finished
+    if job.get('status') in ('complete', 'failed'):
+        return
+
+    # Claim it before generating so duplicate deliveries don't both call Bedrock
+    if not claim_job(job_id, attempt):
+        return
+
+    started = time.time()
+    meter = Meter()
+    if requested_at:
+        meter.record('queue', (started - requested_at) * 1000)
+
+    try:
+        request = resolve_bodies([job.get('request') or {}])[0]
+        with meter.phase('template_fetch'):
+            template = get_template(request.get('template_id', 'default_soap'))
+        visit_summary, cached, key = generate_cached(
+            job['user_id'], template, request.get('transcript'), request.get('patient_name', 'UNKNOWN'),
+            sectioned=bool(job.get('sections')), force=bool(job.get('force')), meter=meter
+        )
+        timestamp, persistence = persist_note(job['user_id'], job.get('user_email'), request, template,
+                                              visit_summary, meter, cached, key=key)
+        if persistence == 'failed':
+            # Not in the table and not in the outbox: retry the job (the note is in the generation cache)
+            raise RuntimeError("Failed to save note")
+
+    except Exception as e:
+        final = attempt >= MAX_ATTEMPTS
+        print(f"Generation job {job_id} attempt {attempt}/{MAX_ATTEMPTS} failed: {str(e)}")
+        update_job(job_id, status='failed' if final else 'retrying',
+                   error='Failed to generate note via AI')
+        raise
+
+    total_ms = int((time.time() - started) * 1000)
+    queue_ms = int((started - requested_at) * 1000) if requested_at else None
+    print(f"Generation job {job_id}: attempt={attempt} queue_ms={queue_ms} total_ms={total_ms} "
+          f"cached={cached}")
+
+    result = note_result(job['user_id'], template, visit_summary, timestamp, persistence)
+    result['cached'] = cached
+    update_job(
+        job_id,
+        status='complete',
+        result=result,
+        total_ms=total_ms
+    )
+
+
+def lambda_handler(event, context):
+    """
+    SQS batch handler. Failed messages are reported individually (partial batch
+    response) and pushed back with backoff, so only they are retried.
+    """
+    set_deadline(context)
+    failures = []
+
+    for record in event.get('Records', []):
+        attempt = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+        try:
+            message = json.loads(record['body'])
+            process_job(message['job_id'], attempt, message.get('requested_at'))
+        except Exception as e:
+            print(f"Error processing message {record.get('messageId')}: {str(e)}")
+            failures.append({'itemIdentifier': record['messageId']})
+
+            if attempt < MAX_ATTEMPTS and record.get('receiptHandle'):
+                # A claimed job is looked at again once the claim could have gone stale
+                delay = VISIBILITY_TIMEOUT_SECONDS if isinstance(e, JobClaimed) else retry_delay(attempt)
+                try:
+                    sqs.change_message_visibility(
+                        QueueUrl=GENERATION_QUEUE_URL,
+                        ReceiptHandle=record['receiptHandle'],
+                        VisibilityTimeout=delay
+                    )
+                except Exception as visibility_error:
+                    print(f"Error setting retry delay: {str(visibility_error)}")
+
+    return {'batchItemFailures': failures}
+
+
+if __name__ == '__main__':
+    # Local worker: SQS_ENDPOINT_URL=http://localhost:9324 GENERATION_QUEUE_URL=... python worker.py
+    if not GENERATION_QUEUE_URL:
+        sys.exit("Set GENERATION_QUEUE_URL (and SQS_ENDPOINT_URL for ElasticMQ)")
+
+    while True:
+        response = sqs.receive_message(
+            QueueUrl=GENERATION_QUEUE_URL,
+            MaxNumberOfMessages=1,
+            WaitTimeSeconds=20,
+            AttributeNames=['ApproximateReceiveCount']
+        )
+        for msg in response.get('Messages', []):
+            record = {
+                'messageId': msg['MessageId'],
+                'receiptHandle': msg['ReceiptHandle'],
+                'body': msg['Body'],
+                'attributes': msg.get('Attributes', {})
+            }
+            result = lambda_handler({'Records': [record]}, None)
+            if not result['batchItemFailures']:
+                sqs.delete_message(QueueUrl=GENERATION_QUEUE_URL, ReceiptHandle=msg['ReceiptHandle'])
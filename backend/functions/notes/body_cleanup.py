@@ -0,0 +1,28 @@
+# functions/notes/body_cleanup.py
+"""
+Delete a note's offloaded bodies when the note item goes away (its TTL
+expires or it is deleted), so transcript and note text in the bodies bucket
+never outlive the note. Consumes REMOVE records from the NotesTable stream;
+the bucket's lifecycle rules then expire the noncurrent versions.
+"""
+from boto3.dynamodb.types import TypeDeserializer
+from body_store import delete_bodies
+
+deserializer = TypeDeserializer()
+
+
+def lambda_handler(event, context):
+    notes = 0
+    deleted = 0
+    for record in event.get('Records', []):
+        if record.get('eventName') != 'REMOVE':
+            continue
+        keys = record.get('dynamodb', {}).get('Keys') or {}
+        user_id = deserializer.deserialize(keys['user_id'])
+        timestamp = deserializer.deserialize(keys['timestamp'])
+        # Raises on failure, so the batch is retried
+        deleted += delete_bodies(user_id, timestamp)
+        notes += 1
+
+    print(f"Deleted {deleted} bodies for {notes} removed notes")
+    return {'notes': notes, 'deleted': deleted}
@@ -2,12 +2,119 @@
 import json
 import boto3
 import os
-from boto3.dynamodb.conditions import Key
+import time
+from datetime import datetime
+from boto3.dynamodb.conditions import Key, Attr
+from archive_store import restore_archived
+from body_store import resolve_bodies
 from security import format_response, format_error, get_user_info, ValidationError
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ.get('NOTES_TABLE', 'DentalScribeNotes-prod'))
 
+# A cursor older than this gets resync=true: reload instead of walking the changes
+SYNC_MAX_DAYS = 31
+BATCH_GET_LIMIT = 100
+BATCH_GET_RETRIES = 4
+
+
+def parse_timestamp_param(value, end_of_day=False):
+    """
+    Validate an ISO date/datetime query parameter so it compares correctly
+    against the stored isoformat() timestamps. Date-only 'to' values cover the whole day.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid timestamp '{value}'. Use ISO format, e.g. 2025-01-31 or 2025-01-31T14:30:00")
+    if end_of_day and len(value) == 10:
+        return f"{value}T23:59:59.999999"
+    return value
+
+
+def timestamp_condition(build, from_ts, to_ts):
+    """
+    Build the sort-key (or filter) condition for the requested range.
+    build is Key or Attr; returns None when no range was requested.
+    """
+    ts = build('timestamp')
+    if from_ts and to_ts:
+        return ts.between(from_ts, to_ts)
+    if from_ts:
+        return ts.gte(from_ts)
+    if to_ts:
+        return ts.lte(to_ts)
+    return None
+
+
+def with_range(key_condition, range_condition):
+    return key_condition & range_condition if range_condition is not None else key_condition
+
+
+def changed_since(since, limit, user_id, patient_id=None):
+    """
+    The user's notes written or changed after `since` (created, regenerated,
+    section-edited or written late by the outbox), oldest change first, via
+    the user-updated-index GSI. Returns (notes, has_more), or None when the
+    cursor is too old to walk.
+
+    The next cursor is the last updated_at returned and the next call reads
+    strictly after it, so a page never ends partway through a run of notes
+    sharing one updated_at (an outbox batch is stamped together).
+    """
+    if (datetime.utcnow() - datetime.fromisoformat(since)).days > SYNC_MAX_DAYS:
+        return None
+
+    query_args = {
+        'IndexName': 'user-updated-index',
+        'KeyConditionExpression': Key('user_id').eq(user_id) & Key('updated_at').gt(since),
+        'Limit': limit + 1
+    }
+    if patient_id:
+        query_args['FilterExpression'] = Attr('patient_id').eq(patient_id)
+
+    changes = []
+    while True:
+        response = table.query(**query_args)
+        changes.extend(response.get('Items', []))
+        more = 'LastEvaluatedKey' in response
+        # Enough read once there is a page's worth and the last run has ended
+        if not more or (len(changes) > limit and changes[0]['updated_at'] != changes[-1]['updated_at']):
+            break
+        query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    has_more = more or len(changes) > limit
+    if len(changes) > limit:
+        boundary = changes[limit]['updated_at']
+        kept = [c for c in changes[:limit] if c['updated_at'] != boundary]
+        # Only when one run fills the whole page is it returned beyond the limit
+        changes = kept or [c for c in changes if c['updated_at'] == boundary]
+    return get_notes(changes), has_more
+
+
+def get_notes(keys):
+    """Full note items for index entries, in the same order"""
+    found = {}
+    for i in range(0, len(keys), BATCH_GET_LIMIT):
+        request = {table.name: {'Keys': [{'user_id': k['user_id'], 'timestamp': k['timestamp']}
+                                         for k in keys[i:i + BATCH_GET_LIMIT]]}}
+        for attempt in range(BATCH_GET_RETRIES + 1):
+            if attempt:
+                time.sleep(0.05 * (2 ** attempt))
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(table.name, []):
+                found[(item['user_id'], item['timestamp'])] = item
+            request = response.get('UnprocessedKeys') or {}
+            if not request:
+                break
+        else:
+            raise RuntimeError("Could not read changed notes (unprocessed keys)")
+    # A note deleted since the index entry was read just drops out
+    return [found[(k['user_id'], k['timestamp'])] for k in keys if (k['user_id'], k['timestamp']) in found]
+
 
 def lambda_handler(event, context):
     try:
@@ -33,19 +140,46 @@ def lambda_handler(event, context):
         patient_id = params.get('patient_id')
         all_visits = params.get('all', 'false').lower() == 'true'
 
+        # Optional time range: from/to (inclusive), or since - a sync cursor: notes
+        # created or changed after it
+        try:
+            from_ts = parse_timestamp_param(params.get('from'))
+            to_ts = parse_timestamp_param(params.get('to'), end_of_day=True)
+            since = parse_timestamp_param(params.get('since'))
+        except ValueError as e:
+            return format_error(400, str(e))
+
         # Determine if admin wants all visits
         is_admin_all_query = user_role == 'admin' and all_visits
+        has_more = False
 
         try:
-            if patient_id:
+            if since:
+                # Incremental sync: everything changed since the cursor. The
+                # change index is per user, so the all-users view reloads instead
+                changed = None if is_admin_all_query else changed_since(since, limit, user_id,
+                                                                        patient_id=patient_id)
+                if changed is None:
+                    return format_response(200, {'notes': [], 'count': 0, 'is_admin_view': is_admin_all_query,
+                                                 'sync_cursor': since, 'has_more': False, 'resync': True},
+                                           event=event)
+                notes, has_more = changed
+                if to_ts:
+                    notes = [n for n in notes if n.get('timestamp', '') <= to_ts]
+
+            elif patient_id:
                 # Query by patient (uses GSI)
                 response = table.query(
                     IndexName='patient-index',
-                    KeyConditionExpression=Key('patient_id').eq(patient_id),
+                    KeyConditionExpression=with_range(
+                        Key('patient_id').eq(patient_id),
+                        timestamp_condition(Key, from_ts, to_ts)
+                    ),
                     Limit=limit,
-                    ScanIndexForward=False  # Most recent first
+                    ScanIndexForward=False
                 )
                 notes = response.get('Items', [])
+                has_more = 'LastEvaluatedKey' in response
                 
                 # If not admin, filter to only user's notes
                 if not is_admin_all_query:
@@ -53,23 +187,37 @@ def lambda_handler(event, context):
                     
             elif is_admin_all_query:
                 # Admin requesting all visits - use scan
-                response = table.scan(Limit=limit)
+                scan_args = {'Limit': limit}
+                range_filter = timestamp_condition(Attr, from_ts, to_ts)
+                if range_filter is not None:
+                    scan_args['FilterExpression'] = range_filter
+                response = table.scan(**scan_args)
                 notes = response.get('Items', [])
+                has_more = 'LastEvaluatedKey' in response
                 
-                # Sort by timestamp descending
+                # Sort by timestamp (most recent first)
                 notes.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
                 
             else:
                 # Regular user - query by their user_id
                 response = table.query(
-                    KeyConditionExpression=Key('user_id').eq(user_id),
+                    KeyConditionExpression=with_range(
+                        Key('user_id').eq(user_id),
+                        timestamp_condition(Key, from_ts, to_ts)
+                    ),
                     Limit=limit,
                     ScanIndexForward=False
                 )
                 notes = response.get('Items', [])
+                has_more = 'LastEvaluatedKey' in response
         except Exception as e:
             return format_error(500, "Failed to fetch notes from database", internal_error=e)
 
+        # Read archived notes through from the cold tier, then fetch any
+        # bodies offloaded to S3 (both in parallel across the page)
+        restore_archived(notes)
+        resolve_bodies(notes)
+
         # Remove sensitive fields if needed and format response
         formatted_notes = []
         for note in notes:
@@ -82,15 +230,28 @@ def lambda_handler(event, context):
                 'transcript': note.get('transcript', ''),
                 'template_name': note.get('template_name', 'Unknown'),
                 'provider_email': note.get('provider_email', ''),
-                'created_at': note.get('created_at', note.get('timestamp'))
+                'created_at': note.get('created_at', note.get('timestamp')),
+                # Bumped when the note is regenerated or a section is edited (previous text kept in previous_versions)
+                'version': int(note.get('version', 1)),
+                'regenerated_at': note.get('regenerated_at'),
+                # Set when one section was rewritten via /generate-note/section
+                'edited_at': note.get('edited_at'),
+                # Last write of any kind (sync cursor)
+                'updated_at': note.get('updated_at') or note.get('created_at') or note.get('timestamp')
             }
             formatted_notes.append(formatted_note)
 
+        # Cursor for the next incremental sync: the newest change seen
+        changes = [n['updated_at'] for n in formatted_notes if n.get('updated_at')]
+        sync_cursor = max(changes + ([since] if since else [])) if changes else since
+
         return format_response(200, {
             'notes': formatted_notes,
             'count': len(formatted_notes),
-            'is_admin_view': is_admin_all_query
-        })
+            'is_admin_view': is_admin_all_query,
+            'sync_cursor': sync_cursor,
+            'has_more': has_more
+        }, event=event)
 
     except Exception as e:
         return format_error(500, "An unexpected error occurred", internal_error=e)
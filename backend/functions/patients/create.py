@@ -4,7 +4,7 @@ import boto3
 import os
 import uuid
 from datetime import datetime
-from security import format_response, format_error, validate_input, get_user_info, ValidationError
+from security import format_response, format_error, validate_input, parse_body, get_user_info, ValidationError
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ.get('PATIENTS_TABLE', 'DentalScribePatients-prod'))
@@ -28,7 +28,7 @@ def lambda_handler(event, context):
 
         # Parse and Validate request body
         try:
-            body = json.loads(event.get('body', '{}'))
+            body = parse_body(event)
         except json.JSONDecodeError:
             return format_error(400, "Invalid JSON in request body", method='POST')
             
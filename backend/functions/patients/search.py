@@ -146,7 +146,7 @@ def lambda_handler(event, context):
             'patients': formatted_patients,
             'count': len(formatted_patients),
             'query': query
-        })
+        }, event=event)
 
     except Exception as e:
         return format_error(500, "An unexpected error occurred", internal_error=e)
\ No newline at end of file
@@ -0,0 +1,96 @@
+# functions/search/indexer.py
+import json
+import os
+import sys
+from boto3.dynamodb.types import TypeDeserializer
+from body_store import BODY_FIELDS, ref_field, resolve_bodies
+from inverted_index import Segment, get_store, doc_key, new_segment_name
+
+deserializer = TypeDeserializer()
+store = get_store()
+
+
+def deserialize_image(image):
+    """Convert a DynamoDB stream image into a plain dict"""
+    return {k: deserializer.deserialize(v) for k, v in (image or {}).items()}
+
+
+def indexed_fingerprint(image):
+    """Everything that affects what gets indexed for a note (bodies may be S3 pointers)"""
+    parts = [image.get('patient_name')]
+    for field in BODY_FIELDS:
+        ref = image.get(ref_field(field)) or {}
+        parts.append(ref.get('sha256') if ref else image.get(field))
+    return tuple(parts)
+
+
+def collect_changes(records):
+    """
+    Reduce a batch of NotesTable stream records to the final state per note.
+    Returns (upserts, deletes) where upserts maps doc key -> note.
+    """
+    upserts = {}
+    deletes = set()
+
+    for record in records:
+        event_name = record.get('eventName')
+        ddb = record.get('dynamodb', {})
+
+        if event_name == 'REMOVE':
+            keys = deserialize_image(ddb.get('Keys') or ddb.get('OldImage'))
+            key = doc_key(keys.get('user_id'), keys.get('timestamp'))
+            upserts.pop(key, None)
+            deletes.add(key)
+            continue
+
+        new_image = deserialize_image(ddb.get('NewImage'))
+        if not new_image:
+            continue
+
+        # Archiving swaps the bodies for a pointer; the indexed text is unchanged
+        if event_name == 'MODIFY' and new_image.get('archive_ref'):
+            continue
+
+        # Skip updates that don't touch the indexed text (e.g. ttl changes)
+        if event_name == 'MODIFY':
+            old_image = deserialize_image(ddb.get('OldImage'))
+            if indexed_fingerprint(old_image) == indexed_fingerprint(new_image):
+                continue
+
+        key = doc_key(new_image.get('user_id'), new_image.get('timestamp'))
+        deletes.discard(key)
+        upserts[key] = new_image
+
+    return upserts, deletes
+
+
+def lambda_handler(event, context):
+    """Index a batch of NotesTable stream records as one new segment"""
+    records = event.get('Records', [])
+    upserts, deletes = collect_changes(records)
+
+    if not upserts and not deletes:
+        return {'indexed': 0, 'deleted': 0, 'segment': None}
+
+    notes = resolve_bodies(list(upserts.values()))
+    segment = Segment.build(new_segment_name(), notes, deletes)
+    data = segment.to_bytes()
+    store.write(segment.name, data)
+
+    print(f"Indexed {len(upserts)} notes, {len(deletes)} deletes from {len(records)} records "
+          f"into {segment.name} ({len(data)} bytes)")
+
+    return {'indexed': len(upserts), 'deleted': len(deletes), 'segment': segment.name}
+
+
+if __name__ == '__main__':
+    # Local replay: SEARCH_INDEX_DIR=./index python indexer.py records.json [...]
+    # Each file holds a stream event ({"Records": [...]}) or a bare list of records.
+    if not os.environ.get('SEARCH_INDEX_DIR'):
+        sys.exit("Set SEARCH_INDEX_DIR to replay into a local index directory")
+
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            payload = json.load(f)
+        records = payload.get('Records', []) if isinstance(payload, dict) else payload
+        print(json.dumps(lambda_handler({'Records': records}, None)))
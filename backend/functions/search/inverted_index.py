@@ -0,0 +1,468 @@
+# functions/search/inverted_index.py
+import gc
+import heapq
+import json
+import math
+import os
+import re
+import time
+import zlib
+from collections import Counter
+
+import boto3
+
+# BM25 parameters (standard Lucene defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+SEGMENT_SUFFIX = '.seg'
+SEGMENT_FORMAT_VERSION = 1
+
+# Merge policy: merge the run of recent small segments once there are enough of
+# them, and fall back to a full merge when the total segment count grows too large.
+MERGE_MIN_SEGMENTS = int(os.environ.get('MERGE_MIN_SEGMENTS', '8'))
+MERGE_MAX_SEGMENTS = int(os.environ.get('MERGE_MAX_SEGMENTS', '32'))
+LARGE_SEGMENT_DOCS = int(os.environ.get('LARGE_SEGMENT_DOCS', '50000'))
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'into', 'is', 'it', 'of', 'on', 'or', 'so', 'that', 'the', 'their', 'then',
+    'there', 'these', 'they', 'this', 'to', 'was', 'were', 'will', 'with',
+])
+
+# Note attributes kept in the segment so hits can be rendered without a table read
+DOC_FIELDS = ('user_id', 'timestamp', 'patient_name', 'patient_id', 'template_name')
+
+
+def tokenize(text):
+    """Lowercase and split text into searchable terms ("#14" -> "14")"""
+    return [t for t in TOKEN_RE.findall((text or '').lower()) if t not in STOPWORDS]
+
+
+def doc_key(user_id, timestamp):
+    """Stable document key - same shape as the note_id returned by /generate-note"""
+    return f"{user_id}#{timestamp}"
+
+
+def note_text(note):
+    """Text that gets indexed for a note"""
+    return f"{note.get('soap_note') or ''}\n{note.get('transcript') or ''}"
+
+
+def segment_name(seq, gen=0):
+    """Segment names sort by (seq, gen); later segments win over earlier ones"""
+    return f"{seq:020d}-{gen:04d}{SEGMENT_SUFFIX}"
+
+
+def parse_segment_name(name):
+    base = os.path.basename(name)[:-len(SEGMENT_SUFFIX)]
+    seq, gen = base.split('-')
+    return int(seq), int(gen)
+
+
+def new_segment_name():
+    return segment_name(time.time_ns())
+
+
+# ========================================
+# Segments
+# ========================================
+
+class Segment:
+    """
+    Immutable batch of indexed notes.
+
+    docs     - list of per-document metadata dicts (ordinal = list index)
+    postings - term -> (ordinals, term frequencies), ordinals ascending
+    deletes  - doc keys removed by this segment (masks older segments)
+    """
+
+    def __init__(self, name, docs, postings, deletes=()):
+        self.name = name
+        self.docs = docs
+        self.postings = postings
+        self.deletes = set(deletes)
+        self.seq, self.gen = parse_segment_name(name)
+
+    @property
+    def sort_key(self):
+        return (self.seq, self.gen)
+
+    @classmethod
+    def build(cls, name, notes, deletes=()):
+        """Build a segment from plain note dicts (DynamoDB item shape)"""
+        docs = []
+        postings = {}
+        for note in notes:
+            ordinal = len(docs)
+            terms = tokenize(note_text(note))
+            doc = {field: note.get(field) for field in DOC_FIELDS}
+            doc['key'] = doc_key(note.get('user_id'), note.get('timestamp'))
+            doc['length'] = len(terms)
+            docs.append(doc)
+
+            for term, tf in Counter(terms).items():
+                ordinals, freqs = postings.setdefault(term, ([], []))
+                ordinals.append(ordinal)
+                freqs.append(tf)
+
+        return cls(name, docs, postings, deletes)
+
+    def to_bytes(self):
+        """Serialize as zlib-compressed JSON with delta-encoded postings"""
+        encoded = {}
+        for term, (ordinals, freqs) in self.postings.items():
+            deltas = [ordinals[0]] + [b - a for a, b in zip(ordinals, ordinals[1:])]
+            encoded[term] = [deltas, freqs]
+
+        payload = {
+            'v': SEGMENT_FORMAT_VERSION,
+            'fields': list(DOC_FIELDS),
+            'docs': [[d.get(f) for f in DOC_FIELDS] + [d['length']] for d in self.docs],
+            'postings': encoded,
+            'deletes': sorted(self.deletes)
+        }
+        return zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 6)
+
+    @classmethod
+    def from_bytes(cls, name, data):
+        payload = json.loads(zlib.decompress(data).decode('utf-8'))
+        if payload.get('v') != SEGMENT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported segment format in {name}: {payload.get('v')}")
+
+        fields = payload['fields']
+        docs = []
+        for row in payload['docs']:
+            doc = dict(zip(fields, row[:-1]))
+            doc['key'] = doc_key(doc.get('user_id'), doc.get('timestamp'))
+            doc['length'] = row[-1]
+            docs.append(doc)
+
+        postings = {}
+        for term, (deltas, freqs) in payload['postings'].items():
+            ordinals = []
+            running = 0
+            for delta in deltas:
+                running += delta
+                ordinals.append(running)
+            postings[term] = (ordinals, freqs)
+
+        return cls(name, docs, postings, payload.get('deletes', []))
+
+
+def compute_liveness(segments):
+    """
+    Return one list of booleans per segment marking which docs are live.
+    A doc is live if no later segment re-indexes or deletes its key.
+    """
+    ordered = sorted(segments, key=lambda s: s.sort_key)
+    latest = {}
+    for idx, seg in enumerate(ordered):
+        for doc in seg.docs:
+            latest[doc['key']] = idx
+        for key in seg.deletes:
+            latest[key] = idx
+
+    live = {}
+    for idx, seg in enumerate(ordered):
+        live[seg.name] = [
+            latest.get(doc['key']) == idx and doc['key'] not in seg.deletes
+            for doc in seg.docs
+        ]
+    return live
+
+
+# ========================================
+# Segment storage (S3 in AWS, a directory locally)
+# ========================================
+
+class LocalSegmentStore:
+    """Directory-backed store used for local replay and tests"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def list_names(self):
+        return sorted(n for n in os.listdir(self.path) if n.endswith(SEGMENT_SUFFIX))
+
+    def read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            return f.read()
+
+    def write(self, name, data):
+        tmp_path = os.path.join(self.path, f".{name}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+
+class S3SegmentStore:
+    """S3-backed store; segments live under a common key prefix"""
+
+    def __init__(self, bucket, prefix='notes-index/'):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3')
+
+    def list_names(self):
+        names = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                if key.endswith(SEGMENT_SUFFIX):
+                    names.append(key[len(self.prefix):])
+        return sorted(names)
+
+    def read(self, name):
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        return response['Body'].read()
+
+    def write(self, name, data):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + name,
+            Body=data,
+            ContentType='application/octet-stream',
+            ServerSideEncryption='aws:kms'
+        )
+
+    def delete(self, name):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+
+def get_store():
+    """SEARCH_INDEX_DIR selects a local directory, otherwise SEARCH_INDEX_BUCKET on S3"""
+    local_dir = os.environ.get('SEARCH_INDEX_DIR')
+    if local_dir:
+        return LocalSegmentStore(local_dir)
+    return S3SegmentStore(
+        os.environ.get('SEARCH_INDEX_BUCKET', 'scribe32-search-index-prod'),
+        os.environ.get('SEARCH_INDEX_PREFIX', 'notes-index/')
+    )
+
+
+# ========================================
+# Query side
+# ========================================
+
+class SearchIndex:
+    """
+    In-memory view over all segments in a store.
+
+    Loaded segments are kept across invocations in a warm container; only new
+    segments are fetched on refresh, and the listing itself is rate limited.
+    """
+
+    def __init__(self, store, refresh_seconds=5.0):
+        self.store = store
+        self.refresh_seconds = refresh_seconds
+        self.segments = {}
+        self.live = {}
+        self.live_docs = 0
+        self.avg_length = 0.0
+        self.norms = {}
+        self.fully_live = {}
+        self._last_refresh = 0.0
+        self._gc_frozen = False
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self.segments and now - self._last_refresh < self.refresh_seconds:
+            return False
+        self._last_refresh = now
+
+        names = set(self.store.list_names())
+        current = set(self.segments)
+        if names == current:
+            return False
+
+        for name in current - names:
+            del self.segments[name]
+        for name in sorted(names - current):
+            self.segments[name] = Segment.from_bytes(name, self.store.read(name))
+
+        self.live = compute_liveness(self.segments.values())
+        total_length = 0
+        live_docs = 0
+        for seg in self.segments.values():
+            for doc, alive in zip(seg.docs, self.live[seg.name]):
+                if alive:
+                    live_docs += 1
+                    total_length += doc['length']
+        self.live_docs = live_docs
+        self.avg_length = (total_length / live_docs) if live_docs else 0.0
+
+        # Precompute the BM25 length normalisation per doc (None = not live) so
+        # the scoring loop is a flat list lookup.
+        avg_length = self.avg_length or 1.0
+        self.norms = {}
+        self.fully_live = {}
+        for seg in self.segments.values():
+            live = self.live[seg.name]
+            self.norms[seg.name] = [
+                BM25_K1 * (1 - BM25_B + BM25_B * doc['length'] / avg_length) if alive else None
+                for doc, alive in zip(seg.docs, live)
+            ]
+            self.fully_live[seg.name] = all(live)
+
+        # The cold-start load is the bulk of the long-lived objects; keep the
+        # cyclic GC from rescanning it. Only once - every freeze moves whatever
+        # is alive at that point (replaced segments included) out of reach of
+        # the collector for good.
+        if not self._gc_frozen:
+            gc.collect()
+            gc.freeze()
+            self._gc_frozen = True
+        return True
+
+    def search(self, query, limit=20, user_id=None):
+        """
+        BM25 search. When user_id is given only that user's notes are returned,
+        but collection statistics stay global so scores are comparable.
+        """
+        self.refresh()
+
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.live_docs:
+            return []
+
+        n_docs = self.live_docs
+        scores = {}
+
+        for term in terms:
+            entries = []
+            df = 0
+            for seg in self.segments.values():
+                entry = seg.postings.get(term)
+                if not entry:
+                    continue
+                norms = self.norms[seg.name]
+                if self.fully_live[seg.name]:
+                    df += len(entry[0])
+                else:
+                    df += sum(1 for ordinal in entry[0] if norms[ordinal] is not None)
+                entries.append((seg, norms, entry))
+
+            if not df:
+                continue
+
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            idf_k1 = idf * (BM25_K1 + 1)
+            for seg, norms, (ordinals, freqs) in entries:
+                docs = seg.docs
+                name = seg.name
+                for ordinal, tf in zip(ordinals, freqs):
+                    norm = norms[ordinal]
+                    if norm is None:
+                        continue
+                    if user_id and docs[ordinal].get('user_id') != user_id:
+                        continue
+                    key = (name, ordinal)
+                    scores[key] = scores.get(key, 0.0) + idf_k1 * tf / (tf + norm)
+
+        top = heapq.nlargest(limit, scores.items(), key=lambda kv: kv[1])
+        results = []
+        for (name, ordinal), score in top:
+            doc = self.segments[name].docs[ordinal]
+            hit = {field: doc.get(field) for field in DOC_FIELDS}
+            hit['note_id'] = doc['key']
+            hit['score'] = round(score, 4)
+            results.append(hit)
+        return results
+
+
+# ========================================
+# Merging
+# ========================================
+
+def select_merge_candidates(segments):
+    """
+    Pick segments to merge (oldest first), or [] if no merge is needed.
+    Normally the trailing run of small segments; everything if there are too many.
+    """
+    ordered = sorted(segments, key=lambda s: s.sort_key)
+    if len(ordered) >= MERGE_MAX_SEGMENTS:
+        return ordered
+
+    tail = []
+    for seg in reversed(ordered):
+        if len(seg.docs) >= LARGE_SEGMENT_DOCS:
+            break
+        tail.append(seg)
+    tail.reverse()
+
+    return tail if len(tail) >= MERGE_MIN_SEGMENTS else []
+
+
+def merge(segments, includes_oldest):
+    """
+    Merge segments into one. Superseded docs are dropped; tombstones are only
+    kept when older, unmerged segments may still hold the deleted keys.
+    """
+    ordered = sorted(segments, key=lambda s: s.sort_key)
+    live = compute_liveness(ordered)
+    seq = max(s.seq for s in ordered)
+    gen = max(s.gen for s in ordered) + 1
+
+    docs = []
+    remap = {}
+    for seg in ordered:
+        mapping = {}
+        for ordinal, (doc, alive) in enumerate(zip(seg.docs, live[seg.name])):
+            if alive:
+                mapping[ordinal] = len(docs)
+                docs.append(doc)
+        remap[seg.name] = mapping
+
+    postings = {}
+    for seg in ordered:
+        mapping = remap[seg.name]
+        for term, (ordinals, freqs) in seg.postings.items():
+            for ordinal, tf in zip(ordinals, freqs):
+                new_ordinal = mapping.get(ordinal)
+                if new_ordinal is None:
+                    continue
+                out_ordinals, out_freqs = postings.setdefault(term, ([], []))
+                out_ordinals.append(new_ordinal)
+                out_freqs.append(tf)
+
+    deletes = set()
+    if not includes_oldest:
+        live_keys = {doc['key'] for doc in docs}
+        for seg in ordered:
+            deletes |= seg.deletes
+        deletes -= live_keys
+
+    return Segment(segment_name(seq, gen), docs, postings, deletes)
+
+
+def merge_store(store):
+    """Run one merge pass against a store. Returns the merged segment name or None."""
+    names = store.list_names()
+    segments = [Segment.from_bytes(name, store.read(name)) for name in names]
+    candidates = select_merge_candidates(segments)
+    if not candidates:
+        return None
+
+    oldest = min(s.sort_key for s in segments)
+    merged = merge(candidates, includes_oldest=candidates[0].sort_key == oldest)
+
+    # Write first, then drop inputs - readers briefly seeing both is harmless
+    # because the merged segment sorts after every input.
+    store.write(merged.name, merged.to_bytes())
+    for seg in candidates:
+        if seg.name != merged.name:
+            store.delete(seg.name)
+
+    print(f"Merged {len(candidates)} segments into {merged.name} ({len(merged.docs)} docs)")
+    return merged.name
@@ -0,0 +1,19 @@
+# functions/search/merge.py
+import os
+import sys
+from inverted_index import get_store, merge_store
+
+store = get_store()
+
+
+def lambda_handler(event, context):
+    """Scheduled background merge of small index segments"""
+    merged = merge_store(store)
+    return {'merged': merged}
+
+
+if __name__ == '__main__':
+    # Local: SEARCH_INDEX_DIR=./index python merge.py
+    if not os.environ.get('SEARCH_INDEX_DIR'):
+        sys.exit("Set SEARCH_INDEX_DIR to merge a local index directory")
+    print(lambda_handler({}, None))
@@ -0,0 +1,58 @@
+# functions/search/search.py
+import os
+import time
+from inverted_index import SearchIndex, get_store
+from security import format_response, format_error, get_user_info, ValidationError
+
+MAX_RESULTS = 100
+
+# Module-level so segments stay loaded across warm invocations
+index = SearchIndex(get_store(), refresh_seconds=float(os.environ.get('SEARCH_REFRESH_SECONDS', '5')))
+
+
+def lambda_handler(event, context):
+    # Handle OPTIONS preflight
+    if event.get('httpMethod') == 'OPTIONS':
+        return format_response(200, {})
+
+    try:
+        # Get user info from Cognito
+        try:
+            user_info = get_user_info(event)
+        except ValidationError:
+            return format_error(401, "Unauthorized")
+
+        params = event.get('queryStringParameters') or {}
+        query = (params.get('q') or '').strip()
+        if not query:
+            return format_error(400, "Search query 'q' is required")
+
+        try:
+            limit = min(int(params.get('limit', 20)), MAX_RESULTS)
+        except (ValueError, TypeError):
+            limit = 20
+
+        # Admins may search every provider's notes, everyone else only their own
+        all_visits = params.get('all', 'false').lower() == 'true'
+        is_admin_all_query = user_info['is_admin'] and all_visits
+        user_filter = None if is_admin_all_query else user_info['user_id']
+
+        started = time.perf_counter()
+        try:
+            hits = index.search(query, limit=limit, user_id=user_filter)
+        except Exception as e:
+            return format_error(500, "Failed to search notes", internal_error=e)
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
+
+        print(f"Search q={len(query)} chars hits={len(hits)} segments={len(index.segments)} "
+              f"docs={index.live_docs} took_ms={took_ms}")
+
+        return format_response(200, {
+            'results': hits,
+            'count': len(hits),
+            'took_ms': took_ms,
+            'is_admin_view': is_admin_all_query
+        }, event=event)
+
+    except Exception as e:
+        return format_error(500, "An unexpected error occurred", internal_error=e)
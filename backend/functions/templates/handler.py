@@ -5,11 +5,15 @@ import os
 import uuid
 from datetime import datetime
 from boto3.dynamodb.conditions import Key
-from security import format_response, format_error, validate_input, require_admin, ValidationError
+from security import format_response, format_error, validate_input, parse_body, require_admin, ValidationError
 
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table(os.environ.get('TEMPLATES_TABLE', 'DentalScribeTemplates-prod'))
 
+# Version stamp item - bumped on every write so warm caches in the generate
+# function can cheaply tell whether any template changed
+TEMPLATES_VERSION_ID = '__version__'
+
 # Default templates that are always available
 DEFAULT_TEMPLATES = [
     {
@@ -104,9 +108,9 @@ def lambda_handler(event, context):
     try:
         if http_method == 'GET':
             if template_id:
-                return get_template(template_id)
+                return get_template(template_id, event)
             else:
-                return list_templates()
+                return list_templates(event)
         
         # POST/PUT/DELETE - admin only
         if http_method in ['POST', 'PUT', 'DELETE']:
@@ -129,12 +133,36 @@ def lambda_handler(event, context):
         return format_error(500, "An unexpected error occurred", internal_error=e)
 
 
-def list_templates():
+def is_reserved_id(template_id):
+    """
+    Bookkeeping items share the table: the version stamp and the generate
+    function's per-template length profiles ('__profile__#...'). Custom
+    template ids never start with '__'.
+    """
+    return template_id == TEMPLATES_VERSION_ID or template_id.startswith('__')
+
+
+def bump_templates_version():
+    """Increment the templates version stamp (failures only delay cache refresh)"""
+    try:
+        table.update_item(
+            Key={'template_id': TEMPLATES_VERSION_ID},
+            UpdateExpression='ADD version :one SET updated_at = :updated',
+            ExpressionAttributeValues={':one': 1, ':updated': datetime.utcnow().isoformat()}
+        )
+    except Exception as e:
+        print(f"Error bumping templates version: {str(e)}")
+
+
+def list_templates(event=None):
     """List all templates (defaults + custom)"""
     try:
         # Get custom templates from DynamoDB
         response = table.scan()
-        custom_templates = response.get('Items', [])
+        custom_templates = [
+            t for t in response.get('Items', [])
+            if not is_reserved_id(t.get('template_id', ''))
+        ]
         
         # Combine with defaults
         all_templates = DEFAULT_TEMPLATES + custom_templates
@@ -142,31 +170,31 @@ def list_templates():
         return format_response(200, {
             'templates': all_templates,
             'count': len(all_templates)
-        })
+        }, event=event)
     except Exception as e:
         # Return defaults if DB fails
         return format_response(200, {
             'templates': DEFAULT_TEMPLATES,
             'count': len(DEFAULT_TEMPLATES)
-        })
+        }, event=event)
 
 
-def get_template(template_id):
+def get_template(template_id, event=None):
     """Get a specific template by ID"""
     # Check defaults first
     for template in DEFAULT_TEMPLATES:
         if template['template_id'] == template_id:
-            return format_response(200, {'template': template})
+            return format_response(200, {'template': template}, event=event)
     
     # Check custom templates
     try:
         response = table.get_item(Key={'template_id': template_id})
         template = response.get('Item')
         
-        if not template:
+        if not template or is_reserved_id(template_id):
             return format_error(404, "Template not found")
         
-        return format_response(200, {'template': template})
+        return format_response(200, {'template': template}, event=event)
     except Exception as e:
         return format_error(500, "Failed to get template", internal_error=e)
 
@@ -175,7 +203,7 @@ def create_template(event, user_id):
     """Create a new custom template"""
     try:
         try:
-            body = json.loads(event.get('body', '{}'))
+            body = parse_body(event)
         except json.JSONDecodeError:
             return format_error(400, "Invalid JSON in request body", method='POST')
         
@@ -202,6 +230,7 @@ def create_template(event, user_id):
         }
         
         table.put_item(Item=item)
+        bump_templates_version()
         
         return format_response(201, {
             'message': 'Template created successfully',
@@ -218,10 +247,12 @@ def update_template(event, template_id, user_id):
     for template in DEFAULT_TEMPLATES:
         if template['template_id'] == template_id:
             return format_error(400, "Cannot modify default templates", method='PUT')
+    if is_reserved_id(template_id):
+        return format_error(404, "Template not found", method='PUT')
     
     try:
         try:
-            body = json.loads(event.get('body', '{}'))
+            body = parse_body(event)
         except json.JSONDecodeError:
             return format_error(400, "Invalid JSON in request body", method='PUT')
         
@@ -247,6 +278,7 @@ def update_template(event, template_id, user_id):
             },
             ReturnValues='ALL_NEW'
         )
+        bump_templates_version()
         
         return format_response(200, {
             'message': 'Template updated successfully',
@@ -263,9 +295,12 @@ def delete_template(template_id):
     for template in DEFAULT_TEMPLATES:
         if template['template_id'] == template_id:
             return format_error(400, "Cannot delete default templates", method='DELETE')
+    if is_reserved_id(template_id):
+        return format_error(404, "Template not found", method='DELETE')
     
     try:
         table.delete_item(Key={'template_id': template_id})
+        bump_templates_version()
         
         return format_response(200, {'message': 'Template deleted successfully'}, method='DELETE')
         
@@ -3,7 +3,7 @@ import boto3
 import base64
 import os
 import httpx
-from security import format_response, format_error, validate_input
+from security import format_response, format_error, validate_input, parse_body
 
 secrets_client = boto3.client('secretsmanager')
 
@@ -24,7 +24,7 @@ def lambda_handler(event, context):
     try:
         # 1. Parse and Validate Input
         try:
-            body = json.loads(event.get('body', '{}'))
+            body = parse_body(event)
         except json.JSONDecodeError:
             return format_error(400, "Invalid JSON in request body", method='POST')
 
@@ -77,7 +77,7 @@ def lambda_handler(event, context):
         return format_response(200, {
             'transcript': transcript,
             'confidence': confidence
-        }, method='POST')
+        }, method='POST', event=event)
 
     except Exception as e:
         return format_error(500, "An unexpected error occurred", internal_error=e, method='POST')
\ No newline at end of file
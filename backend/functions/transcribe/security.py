@@ -1,7 +1,17 @@
+import base64
+import binascii
+import gzip
 import json
 import os
+import time
 import traceback
 
+# Brotli is optional - not bundled with the Lambda runtime
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 def get_allowed_origins():
     """Get allowed origins from environment or use defaults."""
     env_origins = os.environ.get('ALLOWED_ORIGINS', '')
@@ -16,6 +26,9 @@ def get_allowed_origins():
 
 ALLOWED_ORIGINS = get_allowed_origins()
 
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+
 def get_cors_headers(method='GET'):
     """Generate CORS headers for responses."""
     # In production, we should ideally echo the request origin if it matches our allowlist
@@ -29,13 +42,89 @@ def get_cors_headers(method='GET'):
         'Access-Control-Allow-Methods': f'{method},OPTIONS'
     }
 
-def format_response(status_code, body, method='GET'):
-    """Format a consistent API Gateway response."""
-    return {
+def get_header(event, name):
+    """Case-insensitive request header lookup."""
+    headers = (event or {}).get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def choose_encoding(accept_encoding):
+    """Pick the best supported encoding from an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if token:
+            weights[token] = q
+
+    supported = ['br', 'gzip'] if brotli else ['gzip']
+    best, best_q = None, 0.0
+    for encoding in supported:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+def accepts_json(event):
+    """
+    API Gateway only decodes a base64 body for requests whose Accept header
+    names a binary media type, and only application/json is declared binary.
+    """
+    accept = get_header(event, 'Accept') or ''
+    return accept.split(',')[0].split(';')[0].strip().lower() == 'application/json'
+
+def compress_response(response, event):
+    """Compress the response body in place if the client accepts it and it is large enough."""
+    raw = response['body'].encode('utf-8')
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+
+    response['headers']['Vary'] = 'Accept, Accept-Encoding'
+    encoding = choose_encoding(get_header(event, 'Accept-Encoding'))
+    if not encoding or not accepts_json(event):
+        return response
+
+    started = time.perf_counter()
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    encode_ms = (time.perf_counter() - started) * 1000
+
+    print(f"Compressed response: encoding={encoding} raw_bytes={len(raw)} "
+          f"compressed_bytes={len(compressed)} ratio={len(raw) / max(len(compressed), 1):.2f} "
+          f"encode_ms={encode_ms:.2f}")
+
+    response['headers']['Content-Encoding'] = encoding
+    response['body'] = base64.b64encode(compressed).decode('ascii')
+    response['isBase64Encoded'] = True
+    return response
+
+def format_response(status_code, body, method='GET', event=None):
+    """
+    Format a consistent API Gateway response.
+    Pass the request event to allow Accept-Encoding based compression.
+    """
+    response = {
         'statusCode': status_code,
         'headers': get_cors_headers(method),
         'body': json.dumps(body)
     }
+    if event is not None:
+        compress_response(response, event)
+    return response
 
 def format_error(status_code, message, internal_error=None, method='GET'):
     """Format a secure error response, masking internal details in production."""
@@ -68,6 +157,24 @@ def validate_input(data, required_fields):
     
     return True, None
 
+def parse_body(event):
+    """
+    Parse the JSON request body.
+    Handles base64-encoded bodies (the API treats application/json as binary).
+    Raises json.JSONDecodeError on malformed input, including bad base64 or UTF-8.
+    """
+    body = event.get('body')
+    if body is None:
+        return {}
+    if isinstance(body, dict):
+        return body
+    if event.get('isBase64Encoded'):
+        try:
+            body = base64.b64decode(body, validate=True).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError) as e:
+            raise json.JSONDecodeError(f"Undecodable request body: {e}", str(body), 0) from e
+    return json.loads(body or '{}')
+
 class ValidationError(Exception):
     """Custom exception for validation errors."""
     def __init__(self, message):
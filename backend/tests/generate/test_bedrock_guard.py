@@ -0,0 +1,320 @@
+# tests/generate/test_bedrock_guard.py
+import json
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'functions', 'generate'))
+
+import bedrock_guard  # noqa: E402
+from bedrock_guard import CircuitOpenError, RateLimitedError, acquire_capacity, breaker_for, guarded_call  # noqa: E402
+from botocore.exceptions import ClientError  # noqa: E402
+from fake_bedrock import FakeBedrock  # noqa: E402
+
+MODEL = 'fake-model'
+BODY = json.dumps({'messages': [{'role': 'user', 'content': 'hi'}]})
+
+
+class FakeClock:
+    """Stands in for the time module inside bedrock_guard; sleeping advances it"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeLimiterTable:
+    """The one rate-limit item, with the conditional put semantics acquire_capacity relies on"""
+
+    def __init__(self, item=None, conflicts=0):
+        self.item = item
+        self.conflicts = conflicts
+        self.puts = 0
+
+    def get_item(self, Key, ConsistentRead=False):
+        return {'Item': dict(self.item)} if self.item else {}
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeValues=None):
+        self.puts += 1
+        if self.conflicts:
+            self.conflicts -= 1
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+        if ConditionExpression.startswith('attribute_not_exists'):
+            assert self.item is None
+        else:
+            assert ExpressionAttributeValues[':seen'] == self.item['updated_at']
+        self.item = dict(Item)
+
+
+def scripted(codes):
+    """A Bedrock call that fails with each error code in turn, then succeeds"""
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) <= len(codes):
+            raise ClientError({'Error': {'Code': codes[len(calls) - 1], 'Message': 'scripted'}}, 'InvokeModel')
+        return 'ok'
+    return call, calls
+
+
+@pytest.fixture(autouse=True)
+def guard(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bedrock_guard, 'time', clock)
+    monkeypatch.setattr(bedrock_guard, 'RPM_LIMIT', 0)
+    monkeypatch.setattr(bedrock_guard, 'TPM_LIMIT', 0)
+    monkeypatch.setattr(bedrock_guard, 'MAX_RETRIES', 3)
+    monkeypatch.setattr(bedrock_guard, 'BREAKER_FAILURE_THRESHOLD', 5)
+    monkeypatch.setattr(bedrock_guard, 'BREAKER_COOLDOWN_SECONDS', 20)
+    monkeypatch.setattr(bedrock_guard, 'LEASE_REQUESTS', 4)
+    monkeypatch.setattr(bedrock_guard, '_breakers', {})
+    monkeypatch.setattr(bedrock_guard, '_leases', {})
+    monkeypatch.setattr(bedrock_guard, '_deadline', {'at': None})
+    return clock
+
+
+def invoke(fake):
+    return lambda: fake.invoke_model(modelId=MODEL, body=BODY)
+
+
+# ========================================
+# Retries
+# ========================================
+
+def test_throttles_are_retried_with_backoff(guard):
+    call, calls = scripted(['ThrottlingException', 'ServiceUnavailableException'])
+
+    assert guarded_call(MODEL, call) == 'ok'
+
+    assert len(calls) == 3
+    assert len(guard.sleeps) == 2
+    for attempt, delay in enumerate(guard.sleeps, start=1):
+        assert 0 <= delay <= bedrock_guard.BACKOFF_BASE_SECONDS * 2 ** attempt
+    assert breaker_for(MODEL).state == 'closed'
+    assert breaker_for(MODEL).failures == []
+
+
+def test_retries_stop_after_max_retries(guard, monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'BREAKER_FAILURE_THRESHOLD', 100)
+    call, calls = scripted(['ThrottlingException'] * 10)
+
+    with pytest.raises(ClientError):
+        guarded_call(MODEL, call)
+
+    assert len(calls) == bedrock_guard.MAX_RETRIES + 1
+    assert len(guard.sleeps) == bedrock_guard.MAX_RETRIES
+    assert breaker_for(MODEL).state == 'closed'
+
+
+def test_no_retry_when_a_fallback_model_is_next(guard):
+    call, calls = scripted(['ThrottlingException'])
+
+    with pytest.raises(ClientError):
+        guarded_call(MODEL, call, retry=False)
+
+    assert len(calls) == 1
+    assert guard.sleeps == []
+
+
+def test_request_errors_are_not_retried_or_counted_against_the_breaker():
+    call, calls = scripted(['ValidationException'])
+
+    with pytest.raises(ClientError):
+        guarded_call(MODEL, call)
+
+    assert len(calls) == 1
+    assert breaker_for(MODEL).failures == []
+
+
+def test_no_retry_without_time_left(guard):
+    # Less than MIN_ATTEMPT_SECONDS left after any backoff
+    bedrock_guard._deadline['at'] = guard.now + bedrock_guard.MIN_ATTEMPT_SECONDS
+    call, calls = scripted(['ThrottlingException'])
+
+    with pytest.raises(ClientError):
+        guarded_call(MODEL, call)
+
+    assert len(calls) == 1
+
+
+# ========================================
+# Circuit breaker
+# ========================================
+
+def open_breaker(fake):
+    """An outage: the first call retries four times, the fifth failure opens the breaker"""
+    fake.outage(3600)
+    for _ in range(2):
+        with pytest.raises(ClientError):
+            guarded_call(MODEL, invoke(fake))
+
+
+def test_outage_opens_the_breaker_and_fails_fast():
+    fake = FakeBedrock(throttle_rate=0.0, latency_ms=0, seed=7)
+
+    open_breaker(fake)
+
+    assert fake.calls == bedrock_guard.BREAKER_FAILURE_THRESHOLD
+    assert breaker_for(MODEL).state == 'open'
+
+    for _ in range(10):
+        with pytest.raises(CircuitOpenError):
+            guarded_call(MODEL, invoke(fake))
+    assert fake.calls == bedrock_guard.BREAKER_FAILURE_THRESHOLD
+
+
+def test_half_open_probe_closes_the_breaker(guard):
+    fake = FakeBedrock(throttle_rate=0.0, latency_ms=0, seed=7)
+    open_breaker(fake)
+    calls = fake.calls
+
+    fake.outage_until = 0.0
+    guard.sleep(bedrock_guard.BREAKER_COOLDOWN_SECONDS + 1)
+    guarded_call(MODEL, invoke(fake))
+
+    assert fake.calls == calls + 1
+    assert breaker_for(MODEL).state == 'closed'
+    assert breaker_for(MODEL).failures == []
+
+
+def test_failed_probe_reopens_the_breaker_without_retrying(guard):
+    fake = FakeBedrock(throttle_rate=0.0, latency_ms=0, seed=7)
+    open_breaker(fake)
+    calls = fake.calls
+
+    guard.sleep(bedrock_guard.BREAKER_COOLDOWN_SECONDS + 1)
+    with pytest.raises(ClientError):
+        guarded_call(MODEL, invoke(fake))
+
+    assert fake.calls == calls + 1
+    assert breaker_for(MODEL).state == 'open'
+    with pytest.raises(CircuitOpenError):
+        guarded_call(MODEL, invoke(fake))
+
+
+def test_half_open_admits_one_probe_at_a_time(guard):
+    breaker = breaker_for(MODEL)
+    for _ in range(bedrock_guard.BREAKER_FAILURE_THRESHOLD):
+        breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    guard.sleep(bedrock_guard.BREAKER_COOLDOWN_SECONDS + 1)
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+    # A probe that never reached Bedrock frees the slot
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_sporadic_throttles_do_not_open_the_breaker():
+    for _ in range(5):
+        call, _ = scripted(['ThrottlingException'] * 3)
+        assert guarded_call(MODEL, call) == 'ok'
+
+    assert breaker_for(MODEL).state == 'closed'
+
+
+# ========================================
+# Leased rate limiter
+# ========================================
+
+def test_lease_serves_calls_without_touching_the_table(monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'RPM_LIMIT', 60)
+    table = FakeLimiterTable()
+    monkeypatch.setattr(bedrock_guard, 'limiter_table', table)
+
+    for _ in range(bedrock_guard.LEASE_REQUESTS):
+        assert acquire_capacity(MODEL, 100) == 0.0
+    assert table.puts == 1
+    assert table.item['requests'] == Decimal('56.0')
+
+    acquire_capacity(MODEL, 100)
+    assert table.puts == 2
+    assert table.item['requests'] == Decimal('52.0')
+
+
+def test_lease_expires(guard, monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'RPM_LIMIT', 60)
+    table = FakeLimiterTable()
+    monkeypatch.setattr(bedrock_guard, 'limiter_table', table)
+
+    acquire_capacity(MODEL, 0)
+    guard.sleep(bedrock_guard.LEASE_SECONDS + 1)
+    acquire_capacity(MODEL, 0)
+
+    assert table.puts == 2
+
+
+def test_lease_covers_only_the_tokens_it_holds(monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'TPM_LIMIT', 1000)
+    monkeypatch.setattr(bedrock_guard, 'LIMITER_MAX_WAIT_SECONDS', 10.0)
+    table = FakeLimiterTable()
+    monkeypatch.setattr(bedrock_guard, 'limiter_table', table)
+
+    # The whole bucket is leased on the first call; 1000 tokens cover three calls of 300
+    for _ in range(3):
+        acquire_capacity(MODEL, 300)
+    assert table.puts == 1
+    assert table.item['tokens'] == Decimal('0.0')
+
+    # The fourth needs 18s of refill, past the wait allowed
+    with pytest.raises(RateLimitedError):
+        acquire_capacity(MODEL, 300)
+    assert table.puts == 1
+
+
+def test_limiter_waits_for_a_refill(guard, monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'RPM_LIMIT', 60)
+    table = FakeLimiterTable(item={'cache_key': f"ratelimit#{MODEL}", 'requests': Decimal('0.5'),
+                                   'tokens': Decimal('0'), 'updated_at': Decimal(str(guard.now))})
+    monkeypatch.setattr(bedrock_guard, 'limiter_table', table)
+
+    waited = acquire_capacity(MODEL, 0)
+
+    assert 0.5 <= waited <= 0.55
+    assert table.puts == 1
+
+
+def test_limiter_backs_off_after_losing_a_race(guard, monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'RPM_LIMIT', 60)
+    table = FakeLimiterTable(conflicts=2)
+    monkeypatch.setattr(bedrock_guard, 'limiter_table', table)
+
+    acquire_capacity(MODEL, 0)
+
+    assert table.puts == 3
+    assert len(guard.sleeps) == 2
+    for conflict, delay in enumerate(guard.sleeps, start=1):
+        assert 0 <= delay <= bedrock_guard.LIMITER_BACKOFF_BASE_SECONDS * 2 ** conflict
+
+
+def test_rate_limited_call_is_not_sent_and_leaves_the_breaker_free(guard, monkeypatch):
+    monkeypatch.setattr(bedrock_guard, 'RPM_LIMIT', 60)
+    monkeypatch.setattr(bedrock_guard, 'LIMITER_MAX_WAIT_SECONDS', 0.5)
+    table = FakeLimiterTable(item={'cache_key': f"ratelimit#{MODEL}", 'requests': Decimal('0'),
+                                   'tokens': Decimal('0'), 'updated_at': Decimal(str(guard.now))})
+    monkeypatch.setattr(bedrock_guard, 'limiter_table', table)
+    breaker = breaker_for(MODEL)
+    breaker.state = 'half_open'
+    call, calls = scripted([])
+
+    with pytest.raises(RateLimitedError):
+        guarded_call(MODEL, call)
+
+    assert calls == []
+    assert not breaker.probing
@@ -0,0 +1,66 @@
+# tests/generate/test_note_sanitizer.py
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'functions', 'generate'))
+
+from note_sanitizer import MarkdownSanitizer, sanitize  # noqa: E402
+
+GOLDEN_CASES = [
+    ("SUBJECTIVE:\nPatient presents for recall.", "SUBJECTIVE:\nPatient presents for recall."),
+    ("## ASSESSMENT\n**Caries** on #14", "ASSESSMENT\nCaries on #14"),
+    ("#14 crown prep completed", "#14 crown prep completed"),
+    ("```text\nPLAN:\n1. Prophy\n```", "PLAN:\n1. Prophy"),
+    ("```markdown\n## SUBJECTIVE:\n**Patient** reports pain.\n* bullet\n```",
+     "SUBJECTIVE:\nPatient reports pain.\n- bullet"),
+    ("~~~\n> quoted in a fence\n~~~\nafter", "quoted in a fence\nafter"),
+    ("Use `fluoride` varnish", "Use fluoride varnish"),
+    ("* item one\n+ item two\n- item three", "- item one\n- item two\n- item three"),
+    ("See [chart](http://x/y) and ![xray](img.png)", "See chart and xray"),
+    ("> quoted line", "quoted line"),
+    ("A\n\n\n\n   \nB", "A\n\nB"),
+    ("---\nOBJECTIVE:\n***", "OBJECTIVE:"),
+    ("| Tooth | Finding |\n| #3 | MOD |", "Tooth | Finding\n #3 | MOD"),
+    ("_italic_ and __strong__ but snake_case_name stays", "italic and strong but snake_case_name stays"),
+    ("trailing spaces   \n  \n\n", "trailing spaces"),
+    ("####### seven hashes", "####### seven hashes"),
+    ("Windows line\r\nendings\r\n", "Windows line\nendings"),
+    # Emphasis needs CommonMark flanking delimiters; clinical text stays as written
+    ("2 * 3 * 4 without closer *", "2 * 3 * 4 without closer *"),
+    ("Dose 2 * 3 * 4 mg", "Dose 2 * 3 * 4 mg"),
+    ("Class II* and III*", "Class II* and III*"),
+    ("x*y*z and *(note)*", "xyz and (note)"),
+    ("**Bold**, *em* and **x*", "Bold, em and **x*"),
+]
+
+
+@pytest.mark.parametrize('source,expected', GOLDEN_CASES)
+def test_golden(source, expected):
+    assert sanitize(source) == expected
+
+
+@pytest.mark.parametrize('source,expected', GOLDEN_CASES)
+@pytest.mark.parametrize('size', [1, 3, 7])
+def test_streaming_matches_whole_text(source, expected, size):
+    sanitizer = MarkdownSanitizer()
+    streamed = ''.join(sanitizer.feed(source[i:i + size]) for i in range(0, len(source), size))
+    assert streamed + sanitizer.finish() == expected
+
+
+def test_streamed_output_is_never_retracted():
+    source = "```markdown\n## PLAN:\n1. **Prophy**\n\n\n2. Recall\n```\n"
+    sanitizer = MarkdownSanitizer()
+    emitted = ''
+    for ch in source:
+        emitted += sanitizer.feed(ch)
+        assert sanitize(source).startswith(emitted)
+
+
+@pytest.mark.parametrize('text', ["[a](" * 5000, "* " * 5000, " " * 20000 + "x", "A" + "\n \n" * 2000 + " B"])
+def test_adversarial_input_is_fast(text):
+    import time
+    started = time.perf_counter()
+    sanitize(text)
+    assert time.perf_counter() - started < 0.5
@@ -0,0 +1,92 @@
+# tests/generate/test_transcript_compactor.py
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'functions', 'generate'))
+
+from transcript_compactor import CHITCHAT_PLACEHOLDER, compact, strip_fillers  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', '..', 'fixtures', 'compaction')
+
+
+def test_question_repeated_after_an_answer_is_kept():
+    transcript = ("Dentist: Does it hurt when you bite down?\n"
+                  "Patient: No.\n"
+                  "Dentist: Let me check the next one. Does it hurt when you bite down?\n"
+                  "Patient: Yes.")
+
+    compacted, stats = compact(transcript)
+
+    assert compacted == transcript
+    assert stats['duplicates'] == 0
+
+
+def test_repeat_within_a_turn_is_dropped():
+    compacted, stats = compact("Dentist: The lower left molar is cracked. The lower left molar is cracked.")
+
+    assert compacted == "Dentist: The lower left molar is cracked."
+    assert stats['duplicates'] == 1
+
+
+def test_cross_talk_echo_in_the_next_turn_is_dropped():
+    transcript = "Dentist: We will place a crown on 19.\nAssistant: We will place a crown on 19."
+
+    compacted, stats = compact(transcript)
+
+    assert compacted == "Dentist: We will place a crown on 19."
+    assert stats['duplicates'] == 1
+
+
+def test_restated_fragment_is_dropped_within_a_turn_only():
+    compacted, _ = compact("Dentist: Let's take a. Let's take a look at the upper left.")
+    assert compacted == "Dentist: Let's take a look at the upper left."
+
+    # The patient's turn (only a filler) still separates the two
+    compacted, _ = compact("Dentist: Bite down.\nPatient: Uh.\nDentist: Bite down on the cotton roll gently.")
+    assert compacted == "Dentist: Bite down.\nDentist: Bite down on the cotton roll gently."
+
+
+def test_clinical_near_duplicates_are_kept():
+    transcript = "Dentist: Pocket depth is 5 on the buccal. Pocket depth is 5 on the lingual."
+    assert compact(transcript)[0] == transcript
+
+
+def test_short_answers_are_never_deduplicated():
+    transcript = "Dentist: Any pain?\nPatient: No.\nDentist: Any swelling?\nPatient: No."
+    assert compact(transcript)[0] == transcript
+
+
+@pytest.mark.parametrize('sentence,expected', [
+    ("Um, I think it started, uh, last week.", "I think it started, last week."),
+    ("I I I think so.", "I think so."),
+    ("It was, you know, sore.", "It was sore."),
+    ("I mean the lower left.", "I mean the lower left."),
+    ("Mm-hmm.", "Mm-hmm."),
+])
+def test_strip_fillers(sentence, expected):
+    assert strip_fillers(sentence)[0] == expected
+
+
+def test_small_talk_run_is_collapsed():
+    transcript = ("Patient: The weather has been great. We went on a trip this weekend. "
+                  "The kids loved it.\nDentist: Any sensitivity to cold?")
+
+    compacted, stats = compact(transcript)
+
+    assert compacted == f"{CHITCHAT_PLACEHOLDER}\nDentist: Any sensitivity to cold?"
+    assert stats['small_talk_sentences'] == 3
+
+
+@pytest.mark.parametrize('name', sorted(os.listdir(FIXTURES)) if os.path.isdir(FIXTURES) else [])
+def test_fixture_facts_survive(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        fixture = json.load(f)
+
+    compacted, stats = compact(fixture['transcript'])
+
+    lowered = ' '.join(compacted.lower().split())
+    assert [fact for fact in fixture['must_include'] if fact.lower() not in lowered] == []
+    assert stats['compacted_tokens'] <= stats['original_tokens']
@@ -0,0 +1,154 @@
+# tests/search/test_inverted_index.py
+import gc
+import math
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'functions', 'search'))
+
+import inverted_index  # noqa: E402
+from inverted_index import (  # noqa: E402
+    BM25_B, BM25_K1, LocalSegmentStore, SearchIndex, Segment, compute_liveness, merge, merge_store,
+    segment_name, select_merge_candidates
+)
+
+
+def note(user_id, timestamp, text, **fields):
+    return dict(user_id=user_id, timestamp=timestamp, soap_note=text, **fields)
+
+
+def write(store, seq, notes, deletes=(), gen=0):
+    segment = Segment.build(segment_name(seq, gen), notes, deletes)
+    store.write(segment.name, segment.to_bytes())
+    return segment
+
+
+def test_segment_round_trip():
+    segment = Segment.build(segment_name(1), [
+        note('u1', 't1', 'Crown prep on #14, crown seated', patient_name='Ann'),
+        note('u2', 't2', 'Prophy and fluoride'),
+    ], deletes=['u3#t3'])
+
+    loaded = Segment.from_bytes(segment.name, segment.to_bytes())
+
+    assert loaded.docs == segment.docs
+    assert loaded.postings == segment.postings
+    assert loaded.deletes == {'u3#t3'}
+    assert loaded.postings['crown'] == ([0], [2])
+
+
+def test_later_segment_supersedes_and_tombstones_mask():
+    old = Segment.build(segment_name(1), [note('u1', 't1', 'old'), note('u1', 't2', 'kept')])
+    new = Segment.build(segment_name(2), [note('u1', 't1', 'new')], deletes=['u1#t2'])
+
+    live = compute_liveness([new, old])
+
+    assert live[old.name] == [False, False]
+    assert live[new.name] == [True]
+
+
+def test_merge_drops_superseded_docs_and_keeps_tombstones_for_older_segments():
+    a = Segment.build(segment_name(2), [note('u1', 't1', 'first draft'), note('u1', 't2', 'other')])
+    b = Segment.build(segment_name(3), [note('u1', 't1', 'second draft')], deletes=['u1#t0'])
+
+    merged = merge([a, b], includes_oldest=False)
+
+    assert [d['key'] for d in merged.docs] == ['u1#t2', 'u1#t1']
+    assert 'first' not in merged.postings
+    assert merged.postings['second'] == ([1], [1])
+    # An older, unmerged segment may still hold u1#t0
+    assert merged.deletes == {'u1#t0'}
+    assert (merged.seq, merged.gen) == (3, 1)
+
+    assert merge([a, b], includes_oldest=True).deletes == set()
+
+
+def test_select_merge_candidates(monkeypatch):
+    monkeypatch.setattr(inverted_index, 'MERGE_MIN_SEGMENTS', 3)
+    monkeypatch.setattr(inverted_index, 'MERGE_MAX_SEGMENTS', 6)
+    monkeypatch.setattr(inverted_index, 'LARGE_SEGMENT_DOCS', 2)
+    large = Segment.build(segment_name(1), [note('u', 't1', 'a'), note('u', 't2', 'b')])
+    small = [Segment.build(segment_name(seq), [note('u', f"s{seq}", 'c')]) for seq in range(2, 4)]
+
+    assert select_merge_candidates([large] + small) == []
+
+    small.append(Segment.build(segment_name(4), [note('u', 's4', 'd')]))
+    assert select_merge_candidates([large] + small) == small
+
+    many = small + [Segment.build(segment_name(seq), [note('u', f"s{seq}", 'e')]) for seq in range(5, 7)]
+    assert select_merge_candidates([large] + many) == [large] + many
+
+
+def test_merge_store_replaces_inputs_and_search_is_unchanged(tmp_path, monkeypatch):
+    monkeypatch.setattr(inverted_index, 'MERGE_MIN_SEGMENTS', 2)
+    store = LocalSegmentStore(str(tmp_path))
+    write(store, 1, [note('u1', 't1', 'crown prep'), note('u1', 't2', 'root canal')])
+    write(store, 2, [note('u1', 't1', 'crown seated')])
+    write(store, 3, [], deletes=['u1#t2'])
+    before = SearchIndex(store).search('crown canal')
+
+    merged = merge_store(store)
+
+    assert store.list_names() == [merged]
+    after = SearchIndex(store).search('crown canal')
+    assert after == before
+    assert [hit['note_id'] for hit in after] == ['u1#t1']
+
+
+def test_bm25_scores(tmp_path):
+    store = LocalSegmentStore(str(tmp_path))
+    write(store, 1, [note('u1', 't1', 'crown prep crown'), note('u2', 't2', 'filling')])
+
+    hits = SearchIndex(store).search('crown')
+
+    # N=2, df=1, |d|=3, avgdl=2, tf=2
+    idf = math.log(1 + (2 - 1 + 0.5) / (1 + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * 3 / 2)
+    assert [hit['note_id'] for hit in hits] == ['u1#t1']
+    assert hits[0]['score'] == round(idf * (BM25_K1 + 1) * 2 / (2 + norm), 4)
+
+
+def test_bm25_ranks_by_term_weight_and_filters_by_user(tmp_path):
+    store = LocalSegmentStore(str(tmp_path))
+    write(store, 1, [
+        note('u1', 't1', 'crown crown crown'),
+        note('u1', 't2', 'crown and a long note about periodontal charting and scaling'),
+        note('u2', 't3', 'crown'),
+    ])
+    index = SearchIndex(store)
+
+    assert [hit['note_id'] for hit in index.search('crown')][0] == 'u1#t1'
+    assert {hit['note_id'] for hit in index.search('crown', user_id='u2')} == {'u2#t3'}
+    # Statistics stay global, so filtered scores match unfiltered ones
+    scores = {hit['note_id']: hit['score'] for hit in index.search('crown')}
+    assert index.search('crown', user_id='u2')[0]['score'] == scores['u2#t3']
+
+
+def test_deleted_notes_are_not_returned(tmp_path):
+    store = LocalSegmentStore(str(tmp_path))
+    write(store, 1, [note('u1', 't1', 'implant'), note('u1', 't2', 'implant consult')])
+    index = SearchIndex(store, refresh_seconds=0)
+    assert len(index.search('implant')) == 2
+
+    write(store, 2, [], deletes=['u1#t1'])
+
+    assert [hit['note_id'] for hit in index.search('implant')] == ['u1#t2']
+    assert index.live_docs == 1
+
+
+def test_gc_freeze_runs_once(tmp_path, monkeypatch):
+    freezes = []
+    monkeypatch.setattr(gc, 'freeze', lambda: freezes.append(1))
+    store = LocalSegmentStore(str(tmp_path))
+    write(store, 1, [note('u1', 't1', 'a')])
+    index = SearchIndex(store, refresh_seconds=0)
+
+    assert index.refresh()
+    write(store, 2, [note('u1', 't2', 'b')])
+    assert index.refresh()
+
+    assert len(freezes) == 1
@@ -38,10 +38,12 @@ let userEmail = '';
 let userName = '';
 let mediaRecorder = null;
 let audioChunks = [];
+let liveDraft = null;
 let selectedPatient = null;
 let resetEmail = null;
 let templatesCache = [];
 let visitsCache = [];
+let visitsSyncCursor = null;
 let editingTemplateId = null;
 let selectedMicId = null;
 let micTestStream = null;
@@ -267,6 +269,7 @@ function logout() {
   selectedPatient = null;
   templatesCache = [];
   visitsCache = [];
+  visitsSyncCursor = null;
 
   // Hide admin features
   document.querySelectorAll('.admin-only').forEach(el => {
@@ -499,7 +502,7 @@ async function loadTemplates() {
 
   try {
     const response = await fetch(`${MAIN_API}/templates`, {
-      headers: { 'Authorization': idToken }
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
     });
 
     if (!response.ok) throw new Error('Failed to load templates');
@@ -610,7 +613,7 @@ async function loadTemplateDropdown() {
 
   try {
     const response = await fetch(`${MAIN_API}/templates`, {
-      headers: { 'Authorization': idToken }
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
     });
 
     if (!response.ok) throw new Error('Failed to load templates');
@@ -694,6 +697,7 @@ async function saveTemplate() {
       method,
       headers: {
         'Content-Type': 'application/json',
+        'Accept': 'application/json',
         'Authorization': idToken
       },
       body: JSON.stringify({ name, description, example_output })
@@ -725,7 +729,7 @@ async function deleteTemplate(templateId) {
   try {
     const response = await fetch(`${MAIN_API}/templates/${templateId}`, {
       method: 'DELETE',
-      headers: { 'Authorization': idToken}
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
     });
 
     if(!response.ok) throw new Error('Failed to delete template');
@@ -753,6 +757,18 @@ async function loadVisits() {
   const list = document.getElementById('visits-list');
   if(!list) return;
 
+  // Already loaded once - only fetch notes created or changed since the last sync
+  // (per provider; the admin all-visits view always reloads)
+  if (visitsSyncCursor && visitsCache.length > 0 && userRole !== 'admin') {
+    try {
+      await syncVisits();
+      renderVisits();
+      return;
+    } catch (error) {
+      console.warn('Incremental visit sync failed, reloading:', error);
+    }
+  }
+
   list.innerHTML = `
     <div class="loading-spinner">
       <i class="fa-solid fa-spinner fa-spin"></i>
@@ -767,13 +783,14 @@ async function loadVisits() {
       : `${MAIN_API}/notes`;
 
     const response = await fetch(url, {
-      headers: { 'Authorization': idToken }
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
     });
 
     if (!response.ok) throw new Error('Failed to load visits');
 
     const data = await response.json();
     visitsCache = data.notes || [];
+    visitsSyncCursor = data.sync_cursor || null;
 
     renderVisits();
   } catch (error) {
@@ -787,6 +804,30 @@ async function loadVisits() {
   }
 }
 
+async function syncVisits() {
+  let hasMore = true;
+  while (hasMore) {
+    const response = await fetch(`${MAIN_API}/notes?since=${encodeURIComponent(visitsSyncCursor)}`, {
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
+    });
+    if (!response.ok) throw new Error('Failed to sync visits');
+
+    const data = await response.json();
+    // Cursor too old to sync from - loadVisits falls back to a full reload
+    if (data.resync) throw new Error('Visit sync cursor expired');
+
+    // Changed notes (regenerated, section-edited) replace the cached copy
+    const byKey = new Map(visitsCache.map(v => [`${v.user_id}#${v.timestamp}`, v]));
+    for (const visit of data.notes || []) {
+      byKey.set(`${visit.user_id}#${visit.timestamp}`, visit);
+    }
+    visitsCache = [...byKey.values()].sort((a, b) => (b.timestamp || '').localeCompare(a.timestamp || ''));
+
+    hasMore = data.has_more && data.sync_cursor && data.sync_cursor !== visitsSyncCursor;
+    visitsSyncCursor = data.sync_cursor || visitsSyncCursor;
+  }
+}
+
 function renderVisits(filter = 'all', searchQuery = '') {
   const list = document.getElementById('visits-list');
   if(!list) return;
@@ -930,6 +971,7 @@ async function sendInvite() {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'Accept': 'application/json',
         'Authorization': idToken
       },
       body: JSON.stringify({ email, name, role })
@@ -970,7 +1012,7 @@ async function loadTeamMembers() {
 
   try {
     const response = await fetch(`${MAIN_API}/admin/users`, {
-      headers: { 'Authorization':idToken }
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
     });
 
     if (!response.ok) throw new Error('Failed to load team');
@@ -1251,7 +1293,7 @@ async function searchPatients(query) {
   try {
     const response = await fetch(
       `${PATIENTS_API}/patients/search?q=${encodeURIComponent(query)}`,
-      { headers: { 'Authorization': idToken } }
+      { headers: { 'Accept': 'application/json', 'Authorization': idToken } }
     );
 
     if (!response.ok) throw new Error('Search failed');
@@ -1303,6 +1345,7 @@ async function createNewPatient(name) {
 
   const headersToSend = {
     'Content-Type': 'application/json',
+    'Accept': 'application/json',
     'Authorization': idToken
   };
   console.log("4. HEADERS BEING SENT:", headersToSend);
@@ -1394,11 +1437,13 @@ async function startRecording() {
 
     mediaRecorder.onstop = async () => {
       const blob = new Blob(audioChunks, { type: mediaRecorder.mimeType || 'audio/webm' });
-      await transcribeAudio(blob);
       stream.getTracks().forEach(track => track.stop());
+      await finishRecording(blob);
     };
 
     mediaRecorder.start(1000);
+    // The full recording above is the fallback if live drafting fails
+    startLiveDraft(stream, options);
 
     const recordBtn = document.getElementById('record-btn');
     const status = document.getElementById('recording-status');
@@ -1420,6 +1465,7 @@ async function startRecording() {
 
 function stopRecording() {
   if (mediaRecorder && mediaRecorder.state === 'recording') {
+    stopLiveDraft();
     mediaRecorder.stop();
 
     const recordBtn = document.getElementById('record-btn');
@@ -1438,6 +1484,117 @@ function stopRecording() {
   }
 }
 
+// ============================================
+// Live Drafting
+// ============================================
+// While recording, the audio is also cut into ~30 s segments that are
+// transcribed and sent to the backend, which keeps a running fact summary.
+// When recording stops only the last segment is left to transcribe, and the
+// note is written from the summary plus the end of the visit.
+const LIVE_SEGMENT_MS = 30000;
+
+function startLiveDraft(stream, options) {
+  liveDraft = {
+    sessionId: crypto.randomUUID(),
+    stream,
+    options,
+    recorder: null,
+    timer: null,
+    active: true,
+    nextSeq: 0,
+    transcripts: [],
+    queue: Promise.resolve(),
+    failed: false
+  };
+  liveDraft.finalQueued = new Promise(resolve => { liveDraft.resolveFinal = resolve; });
+  startSegmentRecorder(liveDraft);
+  // A new recorder per segment: each blob is a complete file Deepgram can decode
+  liveDraft.timer = setInterval(() => {
+    if (liveDraft.recorder && liveDraft.recorder.state === 'recording') liveDraft.recorder.stop();
+  }, LIVE_SEGMENT_MS);
+}
+
+function startSegmentRecorder(draft) {
+  let recorder;
+  try {
+    recorder = new MediaRecorder(draft.stream, draft.options);
+  } catch (error) {
+    console.warn('Live drafting unavailable:', error);
+    draft.failed = true;
+    draft.resolveFinal();
+    return;
+  }
+  const chunks = [];
+  recorder.ondataavailable = (event) => {
+    if (event.data.size > 0) chunks.push(event.data);
+  };
+  recorder.onstop = () => {
+    const blob = new Blob(chunks, { type: recorder.mimeType || 'audio/webm' });
+    const seq = draft.nextSeq++;
+    const final = !draft.active;
+    draft.queue = draft.queue.then(() => submitSegment(draft, seq, blob, final));
+    if (final) {
+      draft.resolveFinal();
+    } else {
+      startSegmentRecorder(draft);
+    }
+  };
+  draft.recorder = recorder;
+  recorder.start(1000);
+}
+
+function stopLiveDraft() {
+  if (!liveDraft) return;
+  liveDraft.active = false;
+  clearInterval(liveDraft.timer);
+  if (liveDraft.recorder && liveDraft.recorder.state === 'recording') {
+    liveDraft.recorder.stop();
+  } else {
+    liveDraft.resolveFinal();
+  }
+}
+
+async function submitSegment(draft, seq, blob, final) {
+  if (draft.failed) return;
+  try {
+    const text = await requestTranscript(blob);
+    const response = await fetch(`${MAIN_API}/generate-note/live/${draft.sessionId}/segments`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        'Accept': 'application/json',
+        'Authorization': idToken
+      },
+      body: JSON.stringify({ seq, text: text || '', final })
+    });
+    if (!response.ok) throw new Error(`Segment ${seq} rejected (${response.status})`);
+    draft.transcripts[seq] = text || '';
+  } catch (error) {
+    // Fall back to transcribing the full recording
+    console.warn('Live drafting stopped:', error);
+    draft.failed = true;
+  }
+}
+
+async function finishRecording(fullBlob) {
+  const draft = liveDraft;
+  liveDraft = null;
+  if (draft) {
+    showLoader('Transcribing audio...');
+    await draft.finalQueued;
+    await draft.queue;
+    if (!draft.failed) {
+      try {
+        await handleTranscript(draft.transcripts.join(' ').trim(), draft.sessionId);
+      } finally {
+        hideLoader();
+      }
+      return;
+    }
+  }
+  await transcribeAudio(fullBlob);
+}
+
 // ============================================
 // AI Processing
 // ============================================
@@ -1466,64 +1623,33 @@ function hideLoader() {
   const uploadLabel = document.getElementById('upload-audio-label');
   if (uploadLabel) { uploadLabel.style.pointerEvents = ''; uploadLabel.style.opacity = ''; }
 }
-async function transcribeAudio(audioBlob) {
-  try {
-    showLoader('Transcribing audio...');
-    const reader = new FileReader();
-    reader.readAsDataURL(audioBlob);
-    await new Promise(resolve => reader.onloadend = resolve);
-    const base64Audio = reader.result.split(',')[1];
-
-    const response = await fetch(`${MAIN_API}/transcribe`, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': idToken
-      },
-      body: JSON.stringify({ audio: base64Audio })
-    });
-
-    if (!response.ok) throw new Error('Transcription failed');
-
-    const data = await response.json();
-    const transcript = data.transcript;
-
-    // --- FIX: Check for empty transcript ---
-    if (!transcript || transcript.trim().length === 0) {
-      console.warn("Empty transcript received");
-
-      const status = document.getElementById('recording-status');
-      if(status) {
-        status.textContent = 'No Transcript Detected';
-        status.style.color = '#ef4444'; // Red text
-        // Reset color after 3 seconds
-        setTimeout(() => {
-            status.textContent = 'Ready to record';
-            status.style.color = '';
-        }, 3000);
-      }
-      hideLoader();
-      return; // STOP HERE! Do not generate note.
-    }
-    // ---------------------------------------
-
-    const transcriptEl = document.getElementById('transcript');
-    if(transcriptEl) transcriptEl.value = transcript;
-
-    // Reveal results panel now that recording has stopped and we have a transcript
-    const resultsPanel = document.getElementById('results-panel');
-    const setupPanel = document.getElementById('setup-panel');
-    const resultsToolbar = document.getElementById('results-toolbar');
-    if (resultsPanel) { resultsPanel.classList.remove('hidden'); resultsPanel.classList.add('takeover'); }
-    if (setupPanel) setupPanel.classList.add('hidden');
-    if (resultsToolbar) { resultsToolbar.classList.remove('hidden'); resultsToolbar.classList.add('visible'); }
+async function requestTranscript(audioBlob) {
+  const reader = new FileReader();
+  reader.readAsDataURL(audioBlob);
+  await new Promise(resolve => reader.onloadend = resolve);
+  const base64Audio = reader.result.split(',')[1];
+
+  const response = await fetch(`${MAIN_API}/transcribe`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Accept': 'application/json',
+      'Authorization': idToken
+    },
+    body: JSON.stringify({ audio: base64Audio })
+  });
 
-    const status = document.getElementById('recording-status');
-    if(status) status.textContent = 'Generating Clinical Note...';
-    setLoaderText('Generating clinical note...');
+  if (!response.ok) throw new Error('Transcription failed');
 
-    await generateVisitSummary(transcript);
+  const data = await response.json();
+  return data.transcript;
+}
 
+async function transcribeAudio(audioBlob) {
+  try {
+    showLoader('Transcribing audio...');
+    const transcript = await requestTranscript(audioBlob);
+    await handleTranscript(transcript);
   } catch (error) {
     alert('Error: ' + error.message);
     const status = document.getElementById('recording-status');
@@ -1533,30 +1659,74 @@ async function transcribeAudio(audioBlob) {
   }
 }
 
-async function generateVisitSummary(transcript) {
+// liveSessionId: the live drafting session the transcript was built from, if any
+async function handleTranscript(transcript, liveSessionId = null) {
+  // --- FIX: Check for empty transcript ---
+  if (!transcript || transcript.trim().length === 0) {
+    console.warn("Empty transcript received");
+
+    const status = document.getElementById('recording-status');
+    if(status) {
+      status.textContent = 'No Transcript Detected';
+      status.style.color = '#ef4444'; // Red text
+      // Reset color after 3 seconds
+      setTimeout(() => {
+          status.textContent = 'Ready to record';
+          status.style.color = '';
+      }, 3000);
+    }
+    hideLoader();
+    return; // STOP HERE! Do not generate note.
+  }
+  // ---------------------------------------
+
+  const transcriptEl = document.getElementById('transcript');
+  if(transcriptEl) transcriptEl.value = transcript;
+
+  // Reveal results panel now that recording has stopped and we have a transcript
+  const resultsPanel = document.getElementById('results-panel');
+  const setupPanel = document.getElementById('setup-panel');
+  const resultsToolbar = document.getElementById('results-toolbar');
+  if (resultsPanel) { resultsPanel.classList.remove('hidden'); resultsPanel.classList.add('takeover'); }
+  if (setupPanel) setupPanel.classList.add('hidden');
+  if (resultsToolbar) { resultsToolbar.classList.remove('hidden'); resultsToolbar.classList.add('visible'); }
+
+  const status = document.getElementById('recording-status');
+  if(status) status.textContent = 'Generating Clinical Note...';
+  setLoaderText('Generating clinical note...');
+
+  await generateVisitSummary(transcript, liveSessionId);
+}
+
+async function generateVisitSummary(transcript, liveSessionId = null) {
   try {
     const templateSelect = document.getElementById('template-select');
     const template = templateSelect ? templateSelect.value : 'default_soap';
+    const soapEl = document.getElementById('soap-note');
 
-    const response = await fetch(`${MAIN_API}/generate-note`, {
+    const response = await fetch(`${MAIN_API}/generate-note?stream=1`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'Accept': 'application/json',
         'Authorization': idToken
       },
       body: JSON.stringify({
         transcript: transcript,
         patient_name: selectedPatient ? selectedPatient.name : 'Unknown',
         patient_id: selectedPatient ? selectedPatient.patient_id : null,
-        template_id: template
+        template_id: template,
+        live_session_id: liveSessionId
       })
     });
 
     if (!response.ok) throw new Error('Generation failed');
     const data = await response.json();
 
-    const soapEl = document.getElementById('soap-note');
-    if(soapEl) soapEl.value = data.note;
+    // Blocking response (no job id) - the note is already here
+    const result = data.job_id ? await pollStreamingNote(data.job_id, soapEl) : data;
+
+    if(soapEl) soapEl.value = result.note;
 
     const status = document.getElementById('recording-status');
     if(status) status.textContent = 'Note Generated Successfully';
@@ -1567,6 +1737,38 @@ async function generateVisitSummary(transcript) {
   }
 }
 
+// Poll a streaming generation, appending text to the note as it arrives
+const STREAM_POLL_MS = 300;
+const STREAM_TIMEOUT_MS = 120000;
+
+async function pollStreamingNote(jobId, soapEl) {
+  let offset = 0;
+  let text = '';
+  const started = Date.now();
+
+  while (Date.now() - started < STREAM_TIMEOUT_MS) {
+    const response = await fetch(`${MAIN_API}/generate-note/stream/${jobId}?offset=${offset}`, {
+      headers: { 'Accept': 'application/json', 'Authorization': idToken }
+    });
+    if (!response.ok) throw new Error('Generation failed');
+    const data = await response.json();
+
+    if (data.delta) {
+      text += data.delta;
+      if (soapEl) soapEl.value = text;
+      // First text is visible - the loader no longer needs to block the view
+      hideLoader();
+    }
+    offset = data.offset;
+
+    if (data.status === 'complete') return data.result;
+    if (data.status === 'failed') throw new Error(data.error || 'Generation failed');
+
+    await new Promise(resolve => setTimeout(resolve, STREAM_POLL_MS));
+  }
+  throw new Error('Generation timed out');
+}
+
 // ============================================
 // Initialization & Listeners
 // ============================================